@@ -0,0 +1,200 @@
+import math
+import time
+import asyncio
+import httpx
+from config import (
+    logger, DEFAULT_AUTOTUNE_CONCURRENCY_LEVELS, DEFAULT_AUTOTUNE_CONTEXT_SIZES,
+    DEFAULT_AUTOTUNE_REQUESTS_PER_LEVEL, DEFAULT_AUTOTUNE_PROMPT_TOKENS, DEFAULT_AUTOTUNE_NUM_PREDICT,
+    DEFAULT_AUTOTUNE_P95_TARGET
+)
+
+# Прирост пропускной способности, ниже которого дальнейшее увеличение параллельности не имеет смысла
+MIN_THROUGHPUT_GAIN = 0.05
+
+# Больший контекст выбирается, если его пропускная способность не ниже этой доли от лучшей
+CONTEXT_THROUGHPUT_TOLERANCE = 0.9
+
+# Синтетический текст: около одного токена на слово
+SYNTHETIC_WORDS = ("market", "order", "price", "delivery", "quality", "review", "customer", "product")
+
+
+def percentile(values, fraction):
+    """
+    Значение перцентиля (метод ближайшего ранга)
+    
+    :param values: Список значений
+    :param fraction: Доля от 0 до 1
+    :return: Значение перцентиля или 0 для пустого списка
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def make_prompt(tokens, seed):
+    """
+    Синтетический запрос заданного размера
+    
+    :param tokens: Примерный размер в токенах
+    :param seed: Номер запроса, чтобы запросы не совпадали между собой
+    :return: Текст запроса
+    """
+    words = [SYNTHETIC_WORDS[(seed + i) % len(SYNTHETIC_WORDS)] for i in range(tokens)]
+    return f"Request {seed}. Summarize: " + " ".join(words)
+
+
+class TuneResult:
+    """Результат замера одного сочетания параметров"""
+    
+    def __init__(self, num_ctx, concurrency, latencies, tokens, errors, wall_time):
+        self.num_ctx = num_ctx
+        self.concurrency = concurrency
+        self.latencies = latencies
+        self.tokens = tokens
+        self.errors = errors
+        self.wall_time = wall_time
+    
+    @property
+    def throughput(self):
+        """Суммарная скорость генерации в токенах в секунду"""
+        return self.tokens / self.wall_time if self.wall_time > 0 else 0.0
+    
+    @property
+    def p95(self):
+        return percentile(self.latencies, 0.95)
+    
+    def __str__(self):
+        return (f"num_ctx={self.num_ctx:<6} параллельность={self.concurrency:<3} "
+                f"{self.throughput:8.1f} токенов/сек  p95={self.p95:6.2f} сек  ошибок={self.errors}")
+
+
+class CapacityTuner:
+    """Подбор параллельности, размера контекста и таймаутов замерами на локальной Ollama"""
+    
+    def __init__(self, ollama_client, concurrency_levels=DEFAULT_AUTOTUNE_CONCURRENCY_LEVELS,
+                 context_sizes=DEFAULT_AUTOTUNE_CONTEXT_SIZES, requests_per_level=DEFAULT_AUTOTUNE_REQUESTS_PER_LEVEL,
+                 prompt_tokens=DEFAULT_AUTOTUNE_PROMPT_TOKENS, num_predict=DEFAULT_AUTOTUNE_NUM_PREDICT,
+                 p95_target=DEFAULT_AUTOTUNE_P95_TARGET):
+        """
+        :param ollama_client: Клиент OllamaClient, настроенный на проверяемый бэкенд
+        :param concurrency_levels: Проверяемые уровни параллельности
+        :param context_sizes: Проверяемые размеры контекста (num_ctx)
+        :param requests_per_level: Количество запросов на каждый уровень параллельности
+        :param prompt_tokens: Примерный размер синтетического запроса в токенах
+        :param num_predict: Количество токенов ответа в синтетических запросах
+        :param p95_target: Допустимая p95 задержка запроса в секундах
+        """
+        self.ollama_client = ollama_client
+        self.concurrency_levels = sorted(set(concurrency_levels))
+        self.context_sizes = sorted(set(context_sizes))
+        self.requests_per_level = requests_per_level
+        self.prompt_tokens = prompt_tokens
+        self.num_predict = num_predict
+        self.p95_target = p95_target
+        self.results = []
+    
+    def make_request(self, num_ctx, seed):
+        """Данные синтетического запроса"""
+        request_data = self.ollama_client.prepare_request_data(make_prompt(self.prompt_tokens, seed))
+        request_data["options"].update({"num_ctx": num_ctx, "num_predict": self.num_predict})
+        return request_data
+    
+    async def run_request(self, client, url, request_data):
+        """
+        Выполнение одного запроса
+        
+        :return: (задержка в секундах, количество токенов ответа) или None при ошибке
+        """
+        start = time.perf_counter()
+        try:
+            response = await client.post(url, json=request_data, timeout=self.ollama_client.request_timeout)
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"Ошибка замера: {str(e) or type(e).__name__}")
+            return None
+        return time.perf_counter() - start, data.get("eval_count") or 0
+    
+    async def measure(self, num_ctx, concurrency):
+        """
+        Замер одного сочетания размера контекста и параллельности
+        
+        :return: Объект TuneResult
+        """
+        client = await self.ollama_client.open()
+        url = self.ollama_client.get_api_url("generate")
+        semaphore = asyncio.Semaphore(concurrency)
+        total = max(self.requests_per_level, concurrency)
+        
+        async def limited(seed):
+            async with semaphore:
+                return await self.run_request(client, url, self.make_request(num_ctx, seed))
+        
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(limited(seed) for seed in range(total)))
+        wall_time = time.perf_counter() - start
+        
+        succeeded = [outcome for outcome in outcomes if outcome is not None]
+        result = TuneResult(
+            num_ctx, concurrency,
+            latencies=[latency for latency, _ in succeeded],
+            tokens=sum(tokens for _, tokens in succeeded),
+            errors=len(outcomes) - len(succeeded),
+            wall_time=wall_time
+        )
+        self.results.append(result)
+        logger.info(f"Автонастройка: {result}")
+        print(result)
+        return result
+    
+    async def sweep_context(self, num_ctx):
+        """
+        Увеличение параллельности, пока растет пропускная способность и соблюдается p95
+        
+        :return: Лучший результат для размера контекста или None
+        """
+        # Первый запрос с новым num_ctx перезагружает модель, не учитываем его в замерах
+        await self.run_request(await self.ollama_client.open(), self.ollama_client.get_api_url("generate"),
+                               self.make_request(num_ctx, -1))
+        best = None
+        for concurrency in self.concurrency_levels:
+            result = await self.measure(num_ctx, concurrency)
+            if result.errors or result.p95 > self.p95_target:
+                break
+            if best and result.throughput < best.throughput * (1 + MIN_THROUGHPUT_GAIN):
+                break
+            best = result
+        return best
+    
+    async def run(self):
+        """
+        Полный перебор параметров
+        
+        :return: Словарь рекомендуемых настроек для config.json или None, если подходящих нет
+        """
+        best_by_context = []
+        for num_ctx in self.context_sizes:
+            best = await self.sweep_context(num_ctx)
+            if best:
+                best_by_context.append(best)
+        if not best_by_context:
+            return None
+        
+        # Из вариантов с почти лучшей пропускной способностью берем больший контекст
+        top = max(result.throughput for result in best_by_context)
+        chosen = max((r for r in best_by_context if r.throughput >= top * CONTEXT_THROUGHPUT_TOLERANCE),
+                     key=lambda result: result.num_ctx)
+        
+        # Таймаут с запасом на полный ответ (num_predict обычных запросов больше, чем при замерах)
+        scale = max(1.0, self.ollama_client.num_predict / max(1, self.num_predict))
+        timeout = max(60.0, math.ceil(percentile(chosen.latencies, 1.0) * scale * 1.5))
+        
+        return {
+            "max_concurrent_requests": chosen.concurrency,
+            "num_ctx": chosen.num_ctx,
+            "ollama_request_timeout": timeout,
+            "autotune_throughput": round(chosen.throughput, 1),
+            "autotune_p95": round(chosen.p95, 3)
+        }
@@ -0,0 +1,252 @@
+"""
+Бенчмарк: сквозная нагрузка на OllamaProxyClient с локальными заменителями серверов
+
+Запускает настоящий OllamaProxyClient против заменителя WebSocket-сервера
+(buyer_message с заданной частотой) и заменителя Ollama (NDJSON-токены с
+заданной скоростью) и сообщает запросы/сек, время до первого фрагмента,
+фреймы/сек, процессорное время на токен и память. Заменители работают в
+отдельном потоке со своим циклом событий, поэтому процессорное время потока
+клиента не включает их работу.
+
+    python benchmarks/bench_e2e.py --requests 200 --rate 50 --tokens 64 --token-delay 0.002
+"""
+import os
+import json
+import sys
+import socket
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import set_console_log_level, stop_logging
+from client import OllamaProxyClient
+from benchmarks.fake_ollama import FakeOllamaServer
+from benchmarks.fake_proxy import FakeProxyServer
+
+
+class BackgroundLoop:
+    """Цикл событий в отдельном потоке для заменителей серверов"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="fake-servers", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def run(self, coro):
+        """Выполнение корутины в фоновом цикле, результат ожидается из текущего цикла"""
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def closed_port():
+    """Порт, на котором никто не принимает соединения"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def current_rss():
+    """Текущий размер резидентной памяти процесса в байтах (0, если недоступно)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+async def run_e2e(requests=50, rate=0.0, stream=True, tokens=32, token_delay=0.0, first_token_delay=0.0,
+                  max_concurrent=4, coalesce_ms=0, timeout=60.0, extra_config=None, drop_after_frames=0,
+                  models=None, load_delay=0.0, stall_after_frames=0, same_prompt=False, cancel_message_id=None,
+                  cancel_after_frames=0, message_overrides=None, config_update=None, config_update_after_frames=0,
+                  drain_after_frames=0, dead_backends=0):
+    """
+    Сквозной прогон клиента
+    
+    :param requests: Количество запросов покупателей
+    :param rate: Частота запросов в секунду (0 - все сразу)
+    :param stream: Потоковый режим
+    :param tokens: Токенов в каждом ответе
+    :param token_delay: Пауза между токенами в секундах
+    :param first_token_delay: Задержка первого токена в секундах
+    :param max_concurrent: Лимит параллельных запросов клиента
+    :param coalesce_ms: Окно объединения фрагментов в мс
+    :param timeout: Максимальное время прогона в секундах
+    :param extra_config: Дополнительные параметры конфигурации клиента
+    :param drop_after_frames: Разорвать соединение после стольких фреймов ответа (0 - не разрывать)
+    :param models: Модели, которые запросы указывают по очереди (Ollama держит в памяти только одну)
+    :param load_delay: Время загрузки модели в Ollama в секундах
+    :param stall_after_frames: Перестать отвечать после стольких фреймов ответа, не закрывая соединение
+    :param same_prompt: Отправлять во всех запросах одинаковый текст
+    :param cancel_message_id: ID сообщения, генерацию которого нужно отменить
+    :param cancel_after_frames: Отменить генерацию после стольких фреймов ее ответа
+    :param message_overrides: Поля, заменяемые в отдельных запросах, по messageId
+    :param config_update: Параметры, которые записываются в файл конфигурации во время прогона
+        (клиент читает конфигурацию из файла и следит за его изменениями)
+    :param config_update_after_frames: Изменить файл конфигурации после стольких фреймов ответов
+    :param drain_after_frames: Начать штатную остановку клиента после стольких фреймов ответов
+        (прогон длится, пока клиент не завершится сам)
+    :param dead_backends: Сколько недоступных экземпляров Ollama указать в ollama_backends перед рабочим
+    :return: Словарь с результатами
+    """
+    with BackgroundLoop() as background, tempfile.TemporaryDirectory() as log_dir:
+        ollama = FakeOllamaServer(tokens=tokens, token_delay=token_delay, first_token_delay=first_token_delay,
+                                  load_delay=load_delay)
+        proxy = FakeProxyServer(requests=requests, rate=rate, stream=stream, token="bench",
+                                drop_after_frames=drop_after_frames, models=models,
+                                stall_after_frames=stall_after_frames, same_prompt=same_prompt,
+                                cancel_message_id=cancel_message_id, cancel_after_frames=cancel_after_frames,
+                                message_overrides=message_overrides)
+        await background.run(ollama.start())
+        await background.run(proxy.start())
+
+        config = {
+            "token": "bench",
+            "model": ollama.model,
+            "ollama_host": "127.0.0.1",
+            "ollama_port": ollama.port,
+            "server_url": proxy.url,
+            "max_concurrent_requests": max_concurrent,
+            "stream_coalesce_ms": coalesce_ms,
+            "model_warmup": False,
+            "log_level": "INFO",
+            "log_file": os.path.join(log_dir, "client.log"),
+        }
+        if models:
+            config["allowed_models"] = list(models)
+        if dead_backends:
+            config["ollama_backends"] = [f"127.0.0.1:{closed_port()}" for _ in range(dead_backends)]
+            config["ollama_backends"].append(f"127.0.0.1:{ollama.port}")
+        config.update(extra_config or {})
+        set_console_log_level(logging.CRITICAL)
+        if config_update:
+            config_file = os.path.join(log_dir, "config.json")
+            with open(config_file, "w") as f:
+                json.dump(config, f)
+            client = OllamaProxyClient(config_file=config_file)
+        else:
+            client = OllamaProxyClient(config=config)
+
+        async def run_actions():
+            # Действия во время прогона по числу полученных фреймов ответов
+            updated = not config_update
+            drained = not drain_after_frames
+            while not (updated and drained):
+                await asyncio.sleep(0.005)
+                if not updated and proxy.frames >= config_update_after_frames:
+                    with open(config_file, "w") as f:
+                        json.dump(dict(config, **config_update), f)
+                    updated = True
+                if not drained and proxy.frames >= drain_after_frames:
+                    client.start_drain()
+                    drained = True
+
+        rss_before = current_rss()
+        cpu_before = time.thread_time()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            task = asyncio.create_task(client.run())
+            actions = asyncio.create_task(run_actions())
+            try:
+                if drain_after_frames:
+                    await asyncio.wait_for(asyncio.shield(task), timeout)
+                else:
+                    await asyncio.wait_for(asyncio.shield(background.run(proxy.wait_complete())), timeout)
+            finally:
+                wall_time = time.perf_counter() - start
+                cpu_time = time.thread_time() - cpu_before
+                client_exited = task.done()
+                actions.cancel()
+                task.cancel()
+                await asyncio.gather(task, actions, return_exceptions=True)
+        rss_after = current_rss()
+
+        await background.run(proxy.stop())
+        await background.run(ollama.stop())
+        stop_logging()
+
+    traces = list(proxy.traces.values())
+    ttfts = [trace.ttft for trace in traces if trace.ttft is not None]
+    latencies = [trace.latency for trace in traces if trace.latency is not None]
+    total_tokens = requests * tokens
+    return {
+        "requests": len(latencies),
+        "wall_time": wall_time,
+        "requests_per_second": len(latencies) / wall_time,
+        "ttft_p50": percentile(ttfts, 0.5),
+        "ttft_p95": percentile(ttfts, 0.95),
+        "latency_p95": percentile(latencies, 0.95),
+        "frames": proxy.frames,
+        "bytes_received": proxy.bytes_received,
+        "wire_format": proxy.wire_format,
+        "connections": proxy.connections,
+        "resumed_frames": proxy.resumed_frames,
+        "gaps": sum(1 for trace in traces if trace.seqs and trace.next_seq != len(trace.seqs)),
+        "frames_per_second": proxy.frames / wall_time,
+        "cpu_seconds": cpu_time,
+        "cpu_us_per_token": cpu_time / total_tokens * 1e6,
+        "rss_bytes": rss_after,
+        "rss_growth_bytes": rss_after - rss_before,
+        "ollama_connections": ollama.connections,
+        "model_loads": ollama.loads,
+        "ollama_generations": ollama.generations,
+        "ollama_options": ollama.generation_options,
+        "cancelled": sum(1 for trace in traces if trace.cancelled),
+        "errors": sum(1 for trace in traces if trace.error),
+        "frames_per_request": {trace.message_id: trace.frames for trace in traces},
+        "rtt_samples": len(client.websocket_handler.rtt_history),
+        "client_exited": client_exited,
+    }
+
+
+def print_report(name, result):
+    print(f"{name}:")
+    print(f"  запросов: {result['requests']} за {result['wall_time']:.2f} сек "
+          f"({result['requests_per_second']:.1f} запр/сек)")
+    print(f"  TTFT p50/p95: {result['ttft_p50'] * 1000:.1f} / {result['ttft_p95'] * 1000:.1f} мс, "
+          f"время ответа p95: {result['latency_p95'] * 1000:.1f} мс")
+    print(f"  фреймов: {result['frames']} ({result['frames_per_second']:.0f} фреймов/сек)")
+    print(f"  CPU клиента: {result['cpu_seconds']:.3f} сек, {result['cpu_us_per_token']:.1f} мкс/токен")
+    print(f"  память: {result['rss_bytes'] / 2**20:.1f} МБ (прирост {result['rss_growth_bytes'] / 2**20:+.1f} МБ), "
+          f"соединений с Ollama: {result['ollama_connections']}")
+
+
+async def main(args):
+    result = await run_e2e(
+        requests=args.requests, rate=args.rate, stream=not args.non_stream, tokens=args.tokens,
+        token_delay=args.token_delay, first_token_delay=args.first_token_delay,
+        max_concurrent=args.concurrency, coalesce_ms=args.coalesce_ms
+    )
+    print_report("потоковый режим" if not args.non_stream else "непотоковый режим", result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="Количество запросов покупателей")
+    parser.add_argument("--rate", type=float, default=0.0, help="Частота запросов в секунду (0 - все сразу)")
+    parser.add_argument("--tokens", type=int, default=64, help="Токенов в каждом ответе")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Пауза между токенами в секундах")
+    parser.add_argument("--first-token-delay", type=float, default=0.0, help="Задержка первого токена в секундах")
+    parser.add_argument("--concurrency", type=int, default=4, help="Лимит параллельных запросов клиента")
+    parser.add_argument("--coalesce-ms", type=int, default=0, help="Окно объединения фрагментов в мс")
+    parser.add_argument("--non-stream", action="store_true", help="Непотоковый режим")
+    asyncio.run(main(parser.parse_args()))
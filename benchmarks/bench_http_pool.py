@@ -0,0 +1,73 @@
+"""
+Бенчмарк: общий пул соединений против нового httpx.AsyncClient на каждый запрос
+
+Запускает локальный заменитель Ollama и сравнивает накладные расходы на запрос
+для прежнего поведения (новый клиент и TCP-соединение на каждый вызов) и для
+общего пула OllamaClient.
+
+    python benchmarks/bench_http_pool.py --requests 500 --concurrency 8
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import logger
+from ollama_client import OllamaClient
+from benchmarks.fake_ollama import FakeOllamaServer
+
+
+async def run_batch(call, requests, concurrency):
+    """Выполнение requests вызовов call() с заданной параллельностью, возвращает время в секундах"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await call()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return time.perf_counter() - start
+
+
+async def main(args):
+    logger.setLevel(logging.WARNING)
+    async with FakeOllamaServer(tokens=1) as server:
+        ollama = OllamaClient("127.0.0.1", server.port, max_connections=args.concurrency)
+        url = ollama.get_api_url("generate")
+        payload = ollama.prepare_request_data("ping", stream_mode=False)
+
+        async def per_request_client():
+            async with httpx.AsyncClient() as client:
+                response = await client.post(url, json=payload, timeout=30.0)
+                response.raise_for_status()
+
+        async def shared_pool():
+            await ollama.generate("ping", stream_mode=False)
+
+        results = {}
+        for name, call in (("новый клиент на запрос", per_request_client), ("общий пул", shared_pool)):
+            connections_before = server.connections
+            await run_batch(call, args.warmup, args.concurrency)
+            elapsed = await run_batch(call, args.requests, args.concurrency)
+            results[name] = elapsed
+            print(f"{name:>24}: {elapsed:.3f} сек, {elapsed / args.requests * 1000:.3f} мс/запрос, "
+                  f"{args.requests / elapsed:.0f} запр/сек, TCP-соединений: {server.connections - connections_before}")
+        await ollama.close()
+
+    old, new = results["новый клиент на запрос"], results["общий пул"]
+    print(f"Экономия накладных расходов: {(old - new) / args.requests * 1000:.3f} мс на запрос ({old / new:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500, help="Количество измеряемых запросов")
+    parser.add_argument("--warmup", type=int, default=20, help="Количество запросов для прогрева")
+    parser.add_argument("--concurrency", type=int, default=4, help="Число параллельных запросов")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,81 @@
+"""
+Микробенчмарк: кодек JSON в горячем пути потоковой передачи
+
+Сравнивает разбор фрагментов потока Ollama и сериализацию фреймов WebSocket
+стандартным модулем json, orjson и msgspec (если установлены), а также быстрый
+путь json_codec.parse_chunk, который извлекает только текст токена.
+
+    python benchmarks/bench_json_codec.py --iterations 200000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_codec
+
+CHUNKS = [
+    '{"model":"llama2","created_at":"2024-05-01T12:00:00.123456Z","response":" token","done":false}',
+    '{"model":"llama2","created_at":"2024-05-01T12:00:00.123456Z","response":" Привет","done":false}',
+    '{"model":"llama2","created_at":"2024-05-01T12:00:00.123456Z","response":"\\n\\"quoted\\"","done":false}',
+]
+FRAME = {"type": "from_owner", "content": " token", "messageId": 12345, "timestamp": 1714564800123, "stream": True}
+
+
+def measure(function, argument, iterations):
+    """Время одного вызова в наносекундах (лучшее из трех прогонов)"""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            function(argument)
+        best = min(best, (time.perf_counter_ns() - start) / iterations)
+    return best
+
+
+def decoders():
+    yield "json.loads", json.loads
+    if json_codec.orjson is not None:
+        yield "orjson.loads", json_codec.orjson.loads
+    if json_codec.msgspec is not None:
+        yield "msgspec.json.decode", json_codec.msgspec.json.Decoder().decode
+    yield f"parse_chunk ({json_codec.CODEC_NAME})", json_codec.parse_chunk
+
+
+def encoders():
+    yield "json.dumps", json.dumps
+    if json_codec.orjson is not None:
+        yield "orjson.dumps", lambda obj: json_codec.orjson.dumps(obj).decode("utf-8")
+    if json_codec.msgspec is not None:
+        encoder = json_codec.msgspec.json.Encoder()
+        yield "msgspec.json.encode", lambda obj: encoder.encode(obj).decode("utf-8")
+
+
+def main(args):
+    # Быстрый путь должен давать тот же текст, что и полный разбор
+    for chunk in CHUNKS:
+        assert json_codec.parse_chunk(chunk)[0] == json.loads(chunk)["response"], chunk
+
+    print(f"Кодек по умолчанию: {json_codec.CODEC_NAME}")
+    print("Разбор фрагмента потока Ollama:")
+    baseline = None
+    for name, function in decoders():
+        elapsed = sum(measure(function, chunk, args.iterations) for chunk in CHUNKS) / len(CHUNKS)
+        baseline = baseline or elapsed
+        print(f"  {name:>28}: {elapsed:7.0f} нс ({baseline / elapsed:.2f}x)")
+
+    print("Сериализация фрейма WebSocket:")
+    baseline = None
+    for name, function in encoders():
+        elapsed = measure(function, FRAME, args.iterations)
+        baseline = baseline or elapsed
+        print(f"  {name:>28}: {elapsed:7.0f} нс ({baseline / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200000, help="Количество вызовов на замер")
+    main(parser.parse_args())
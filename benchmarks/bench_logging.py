@@ -0,0 +1,80 @@
+"""
+Бенчмарк: пропускная способность потокового режима при разных настройках журнала
+
+Прогоняет потоковые ответы локального заменителя Ollama через StreamHandler
+и WebSocketHandler (с заглушкой вместо сокета) и сравнивает:
+- синхронную запись в файл на уровне DEBUG (прежнее поведение)
+- запись через очередь в фоновом потоке на уровне DEBUG
+- запись через очередь на уровне INFO (отладочные сообщения отключены)
+
+    python benchmarks/bench_logging.py --tokens 5000 --runs 3
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import LOG_MODE_QUEUE, LOG_MODE_SYNC, setup_logging, set_console_log_level, stop_logging
+from ollama_client import OllamaClient
+from stream_handler import StreamHandler
+from websocket_handler import WebSocketHandler
+from benchmarks.fake_ollama import FakeOllamaServer
+
+
+class NullWebSocket:
+    """Заглушка WebSocket, которая только считает отправленные фреймы"""
+
+    def __init__(self):
+        self.frames = 0
+
+    async def send(self, message):
+        self.frames += 1
+
+
+async def measure(ollama, tokens, runs):
+    """Средняя пропускная способность потокового режима в токенах в секунду"""
+    websocket_handler = WebSocketHandler(port=0, token="bench")
+    websocket_handler.websocket = NullWebSocket()
+    stream_handler = StreamHandler(websocket_handler)
+    best = 0.0
+    for _ in range(runs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            await ollama.prepare_stream_request("benchmark", stream_handler, message_id=1)
+        best = max(best, tokens / (time.perf_counter() - start))
+    return best
+
+
+async def main(args):
+    configurations = (
+        ("sync, DEBUG (прежнее поведение)", LOG_MODE_SYNC, "DEBUG"),
+        ("queue, DEBUG", LOG_MODE_QUEUE, "DEBUG"),
+        ("queue, INFO", LOG_MODE_QUEUE, "INFO"),
+    )
+    async with FakeOllamaServer(tokens=args.tokens) as server:
+        ollama = OllamaClient("127.0.0.1", server.port)
+        with tempfile.TemporaryDirectory() as log_dir:
+            results = {}
+            for name, mode, level in configurations:
+                setup_logging(mode=mode, file_level=level, log_file=os.path.join(log_dir, "client.log"))
+                set_console_log_level(logging.CRITICAL)
+                results[name] = await measure(ollama, args.tokens, args.runs)
+                stop_logging()
+        await ollama.close()
+
+    baseline = results[configurations[0][0]]
+    for name, tokens_per_second in results.items():
+        print(f"{name:>34}: {tokens_per_second:8.0f} токенов/сек ({tokens_per_second / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=5000, help="Количество токенов в ответе")
+    parser.add_argument("--runs", type=int, default=3, help="Количество прогонов (берется лучший)")
+    asyncio.run(main(parser.parse_args()))
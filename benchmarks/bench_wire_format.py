@@ -0,0 +1,92 @@
+"""
+Бенчмарк: байты на токен в канале WebSocket при разных форматах и сжатии
+
+Кодирует потоковые фрагменты ответа так, как их отправляет WebSocketHandler
+(JSON или MessagePack с короткими кодами), и считает размер фреймов на проводе
+с учетом заголовка и маски клиентского фрейма. Сжатие permessage-deflate
+моделируется так же, как в websockets: общий контекст zlib для всех сообщений
+соединения и Z_SYNC_FLUSH после каждого сообщения.
+
+    python benchmarks/bench_wire_format.py --tokens 2000
+"""
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire_format
+
+
+SAMPLE_TEXT = (
+    "Этот товар отлично подходит для ежедневного использования. Корпус выполнен из прочного "
+    "алюминия, а аккумулятор держит заряд до двух дней. The package includes a charger, "
+    "a cable and a quick start guide. Доставка занимает от одного до трех дней. "
+)
+
+CLIENT_FRAME_OVERHEAD = 2 + 4  # Заголовок короткого фрейма и маска клиента
+
+
+def make_tokens(count):
+    """Токены примерно как у Ollama: слово с ведущим пробелом в случайном порядке"""
+    words = SAMPLE_TEXT.split()
+    rng = random.Random(42)
+    return [(" " if i else "") + rng.choice(words) for i in range(count)]
+
+
+def frame_overhead(size):
+    if size < 126:
+        return CLIENT_FRAME_OVERHEAD
+    return CLIENT_FRAME_OVERHEAD + (2 if size < 65536 else 8)
+
+
+def measure(codec, tokens, deflate):
+    """
+    :return: (байт на токен на проводе, мкс CPU на токен)
+    """
+    compressor = None
+    if deflate is not None:
+        compressor = zlib.compressobj(deflate["level"], zlib.DEFLATED, -deflate["window_bits"], deflate["mem_level"])
+    total = 0
+    start = time.process_time()
+    for index, token in enumerate(tokens):
+        frame = codec.encode({
+            "type": "from_owner", "content": token, "messageId": 123456,
+            "timestamp": 1714564800123 + index * 23, "stream": True
+        })
+        if isinstance(frame, str):
+            frame = frame.encode("utf-8")
+        if compressor is not None:
+            frame = (compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        total += len(frame) + frame_overhead(len(frame))
+    cpu = time.process_time() - start
+    return total / len(tokens), cpu / len(tokens) * 1e6
+
+
+def main(args):
+    tokens = make_tokens(args.tokens)
+    text_bytes = sum(len(token.encode("utf-8")) for token in tokens) / len(tokens)
+    print(f"Токенов: {len(tokens)}, в среднем {text_bytes:.1f} байт текста на токен")
+
+    codecs = [wire_format.JsonWireCodec]
+    if wire_format.msgpack is not None:
+        codecs.append(wire_format.MsgpackWireCodec)
+    else:
+        print("Пакет msgpack не установлен, формат msgpack пропущен")
+
+    baseline = None
+    for codec in codecs:
+        for preset in ("none", "default", "tuned"):
+            size, cpu = measure(codec, tokens, wire_format.DEFLATE_PRESETS[preset])
+            baseline = baseline or size
+            print(f"{codec.name:>8} + сжатие {preset:<8}: {size:6.1f} байт/токен ({baseline / size:4.2f}x), "
+                  f"{cpu:5.2f} мкс CPU/токен")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=2000, help="Количество токенов")
+    main(parser.parse_args())
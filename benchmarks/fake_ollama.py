@@ -0,0 +1,211 @@
+"""
+Локальный заменитель Ollama API для бенчмарков
+
+Минимальный HTTP/1.1 сервер на asyncio с поддержкой keep-alive. Отвечает на
+POST /api/generate (обычный и потоковый NDJSON режим), GET /api/ps и
+GET /api/tags. Скорость генерации, задержка первого токена и время загрузки
+модели настраиваются; длина ответа ограничивается options.num_predict запроса.
+"""
+import json
+import asyncio
+
+
+class FakeOllamaServer:
+    """Имитация Ollama API, работающая без сети и GPU"""
+
+    def __init__(self, host="127.0.0.1", port=0, tokens=32, token_delay=0.0,
+                 first_token_delay=0.0, token_text=" token", model="llama2",
+                 load_delay=0.0, loaded=True, max_loaded_models=1):
+        """
+        :param host: Адрес для прослушивания
+        :param port: Порт (0 - выбрать свободный)
+        :param tokens: Количество токенов в ответе
+        :param token_delay: Пауза между токенами в секундах
+        :param first_token_delay: Задержка перед первым токеном в секундах
+        :param token_text: Текст одного токена
+        :param model: Имя модели, которую сервер считает загруженной
+        :param load_delay: Время загрузки модели в секундах (если она выгружена)
+        :param loaded: Загружена ли модель при старте
+        :param max_loaded_models: Сколько моделей помещается в память одновременно
+        """
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        self.token_text = token_text
+        self.model = model
+        self.load_delay = load_delay
+        self.max_loaded_models = max(1, max_loaded_models)
+        # Загруженные модели в порядке загрузки: при нехватке памяти выгружается первая
+        self.resident = [model] if loaded else []
+        self.loads = 0
+        self.server = None
+        self.writers = set()
+        self.connections = 0
+        self.requests = 0
+        self.generations = 0
+        # Параметры options запросов на генерацию в порядке поступления
+        self.generation_options = []
+
+    async def start(self):
+        """Запуск сервера, возвращает фактический порт"""
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        """Остановка сервера"""
+        if self.server:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = b""
+                length = int(headers.get("content-length", 0))
+                if length:
+                    body = await reader.readexactly(length)
+                self.requests += 1
+                await self._dispatch(method, path, body, writer)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    @property
+    def loaded(self):
+        """Загружена ли модель по умолчанию"""
+        return self.model in self.resident
+
+    def unload(self):
+        """Имитация выгрузки всех моделей из памяти"""
+        self.resident.clear()
+
+    async def _load_model(self, model=None):
+        """Загрузка модели, возвращает load_duration в наносекундах"""
+        model = model or self.model
+        if model in self.resident:
+            return 0
+        await asyncio.sleep(self.load_delay)
+        if model in self.resident:
+            # Модель загрузил параллельный запрос
+            return 0
+        self.resident.append(model)
+        del self.resident[:-self.max_loaded_models]
+        self.loads += 1
+        return int(self.load_delay * 1e9) or 1
+
+    async def _dispatch(self, method, path, body, writer):
+        if method == "POST" and path == "/api/generate":
+            request = json.loads(body or b"{}")
+            if str(request.get("keep_alive")) in ("0", "0s"):
+                if request.get("model", self.model) in self.resident:
+                    self.resident.remove(request.get("model", self.model))
+                self._write_json(writer, {"model": request.get("model", self.model), "response": "",
+                                          "done": True, "done_reason": "unload"})
+            elif not request.get("prompt"):
+                load_duration = await self._load_model(request.get("model"))
+                self._write_json(writer, {"model": request.get("model", self.model), "response": "",
+                                          "done": True, "done_reason": "load",
+                                          "load_duration": load_duration})
+            elif request.get("stream", True):
+                await self._stream_generate(request, writer)
+            else:
+                await self._generate(request, writer)
+        elif method == "GET" and path == "/api/ps":
+            models = [{"name": model, "model": model} for model in self.resident]
+            self._write_json(writer, {"models": models})
+        elif method == "GET" and path == "/api/tags":
+            self._write_json(writer, {"models": [{"name": self.model, "model": self.model}]})
+        else:
+            self._write_json(writer, {"error": "not found"}, status="404 Not Found")
+        await writer.drain()
+
+    def _tokens(self, request):
+        """Количество токенов ответа с учетом num_predict"""
+        num_predict = (request.get("options") or {}).get("num_predict")
+        if num_predict and num_predict > 0:
+            return min(self.tokens, num_predict)
+        return self.tokens
+
+    def _final_stats(self, request, load_duration=0):
+        tokens = self._tokens(request)
+        eval_duration = int(max(self.token_delay, 1e-6) * tokens * 1e9)
+        prompt_eval_count = max(1, len(request.get("prompt", "")) // 4)
+        # Контекст растет на токены нового запроса и ответа, как у Ollama
+        context = list(request.get("context") or []) + [0] * (prompt_eval_count + tokens)
+        return {
+            "model": request.get("model", self.model),
+            "done": True,
+            "context": context,
+            "total_duration": eval_duration,
+            "load_duration": load_duration,
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": 1000000,
+            "eval_count": tokens,
+            "eval_duration": eval_duration,
+        }
+
+    async def _generate(self, request, writer):
+        self.generations += 1
+        self.generation_options.append(request.get("options") or {})
+        tokens = self._tokens(request)
+        load_duration = await self._load_model(request.get("model"))
+        await asyncio.sleep(self.first_token_delay + self.token_delay * tokens)
+        data = self._final_stats(request, load_duration)
+        data["response"] = self.token_text * tokens
+        self._write_json(writer, data)
+
+    async def _stream_generate(self, request, writer):
+        self.generations += 1
+        self.generation_options.append(request.get("options") or {})
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\n\r\n")
+        load_duration = await self._load_model(request.get("model"))
+        await asyncio.sleep(self.first_token_delay)
+        model = request.get("model", self.model)
+        for _ in range(self._tokens(request)):
+            line = json.dumps({"model": model, "response": self.token_text, "done": False}) + "\n"
+            self._write_chunk(writer, line.encode())
+            await writer.drain()
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        final = self._final_stats(request, load_duration)
+        final["response"] = ""
+        self._write_chunk(writer, (json.dumps(final) + "\n").encode())
+        writer.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _write_chunk(writer, payload):
+        writer.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+
+    @staticmethod
+    def _write_json(writer, data, status="200 OK"):
+        payload = json.dumps(data).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
@@ -0,0 +1,250 @@
+"""
+Локальный заменитель WebSocket-сервера bober.app для бенчмарков
+
+Принимает подключение клиента, отправляет buyer_message с заданной частотой
+и записывает время отправки, первого фрагмента ответа и завершения для
+каждого запроса. Подтверждает формат msgpack, если клиент его запросил и
+пакет msgpack установлен. Может разорвать соединение посреди ответов, чтобы
+проверить возобновление потоков после переподключения клиента.
+"""
+import json
+import time
+import asyncio
+import websockets
+
+import wire_format
+from stream_replay import STREAM_RESUME_QUERY_PARAM, STREAM_RESUME_HEADER
+
+
+class RequestTrace:
+    """Временные отметки одного запроса покупателя"""
+
+    __slots__ = ("message_id", "sent_at", "first_chunk_at", "finished_at", "frames", "chars", "seqs", "cancelled",
+                 "error")
+
+    def __init__(self, message_id, sent_at):
+        self.message_id = message_id
+        self.sent_at = sent_at
+        self.first_chunk_at = None
+        self.finished_at = None
+        self.frames = 0
+        self.chars = 0
+        self.seqs = set()
+        self.cancelled = False
+        self.error = None
+
+    @property
+    def ttft(self):
+        """Время до первого фрагмента ответа в секундах"""
+        if self.first_chunk_at is None:
+            return None
+        return self.first_chunk_at - self.sent_at
+
+    @property
+    def next_seq(self):
+        """Номер первого фрейма, который еще не получен"""
+        seq = 0
+        while seq in self.seqs:
+            seq += 1
+        return seq
+
+    @property
+    def latency(self):
+        """Полное время ответа в секундах"""
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.sent_at
+
+
+class FakeProxyServer:
+    """Имитация сервера, раздающего запросы покупателей"""
+
+    def __init__(self, host="127.0.0.1", port=0, path="/auth-proxy", requests=10, rate=0.0,
+                 stream=True, prompt="Расскажи о преимуществах товара", token=None, drop_after_frames=0,
+                 models=None, stall_after_frames=0, same_prompt=False, cancel_message_id=None,
+                 cancel_after_frames=0, message_overrides=None, resume=True):
+        """
+        :param host: Адрес для прослушивания
+        :param port: Порт (0 - выбрать свободный)
+        :param path: Путь подключения
+        :param requests: Количество запросов, которые будут отправлены клиенту
+        :param rate: Частота запросов в секунду (0 - отправить все сразу)
+        :param stream: Запрашивать потоковый ответ
+        :param prompt: Текст запроса покупателя
+        :param token: Ожидаемый токен (None - принимать любой)
+        :param drop_after_frames: Разорвать первое соединение после стольких фреймов ответа (0 - не разрывать)
+        :param models: Модели, которые запросы указывают в поле model по очереди (None - поле не передается)
+        :param stall_after_frames: Перестать читать первое соединение после стольких фреймов ответа,
+            не закрывая его (имитация обрыва без закрытия TCP); 0 - не останавливать
+        :param same_prompt: Отправлять во всех запросах одинаковый текст
+        :param cancel_message_id: ID сообщения, генерацию которого нужно отменить (None - не отменять)
+        :param cancel_after_frames: Отменить генерацию после стольких фреймов ее ответа
+        :param message_overrides: Поля, заменяемые в отдельных запросах, по messageId
+        :param resume: Подтверждать возобновление ответов, если клиент его запрашивает
+        """
+        self.host = host
+        self.port = port
+        self.path = path
+        self.requests = requests
+        self.rate = rate
+        self.stream = stream
+        self.prompt = prompt
+        self.token = token
+        self.drop_after_frames = drop_after_frames
+        self.models = models
+        self.stall_after_frames = stall_after_frames
+        self.stalled = None
+        self.same_prompt = same_prompt
+        self.cancel_message_id = cancel_message_id
+        self.cancel_after_frames = cancel_after_frames
+        self.message_overrides = message_overrides or {}
+        self.resume = resume
+        self.connections = 0
+        self.resumed_frames = 0
+        self.server = None
+        self.traces = {}
+        self.frames = 0
+        self.bytes_received = 0
+        self.wire_format = wire_format.WIRE_FORMAT_JSON
+        self.started_at = None
+        self.completed = asyncio.Event()
+
+    @property
+    def url(self):
+        """Адрес для подключения клиента (без токена)"""
+        return f"ws://{self.host}:{self.port}{self.path}"
+
+    async def start(self):
+        """Запуск сервера, возвращает фактический порт"""
+        self.server = await websockets.serve(
+            self._handle_connection, self.host, self.port, extra_headers=self._negotiate
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        """Остановка сервера"""
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def wait_complete(self, timeout=None):
+        """Ожидание ответов на все отправленные запросы"""
+        await asyncio.wait_for(self.completed.wait(), timeout)
+
+    def make_message(self, message_id):
+        message = {
+            "type": "buyer_message",
+            "content": self.prompt if self.same_prompt else f"{self.prompt} #{message_id}",
+            "messageId": message_id,
+            "stream": self.stream,
+        }
+        if self.models:
+            message["model"] = self.models[message_id % len(self.models)]
+        message.update(self.message_overrides.get(message_id, {}))
+        return message
+
+    def _negotiate(self, path, request_headers):
+        """Заголовки ответа с подтвержденным форматом сообщений и возобновлением ответов"""
+        headers = {}
+        requested = f"{wire_format.WIRE_FORMAT_QUERY_PARAM}={wire_format.WIRE_FORMAT_MSGPACK}"
+        if requested in path and wire_format.is_available(wire_format.WIRE_FORMAT_MSGPACK):
+            headers[wire_format.WIRE_FORMAT_HEADER] = wire_format.WIRE_FORMAT_MSGPACK
+        if self.resume and f"{STREAM_RESUME_QUERY_PARAM}=1" in path:
+            headers[STREAM_RESUME_HEADER] = "1"
+        return headers
+
+    async def _handle_connection(self, websocket, path=None):
+        path = path or websocket.path
+        if self.token is not None and f"token={self.token}" not in path:
+            await websocket.close(code=4001, reason="invalid token")
+            return
+        self.wire_format = websocket.response_headers.get(wire_format.WIRE_FORMAT_HEADER, wire_format.WIRE_FORMAT_JSON)
+        self.connections += 1
+        if self.stalled is not None:
+            # Клиент переподключился: старое соединение дочитывает разрыв и завершается
+            self.stalled.transport.resume_reading()
+            self.stalled = None
+        receiver = asyncio.create_task(self._receive(websocket))
+        try:
+            # После переподключения клиент только досылает ответы
+            if self.connections == 1:
+                await self._send_requests(websocket)
+            await receiver
+        except websockets.ConnectionClosed:
+            # Клиент разорвал соединение, которое перестало отвечать
+            pass
+        finally:
+            receiver.cancel()
+
+    async def _send_requests(self, websocket):
+        self.started_at = time.perf_counter()
+        interval = 1.0 / self.rate if self.rate > 0 else 0.0
+        for message_id in range(self.requests):
+            if interval:
+                # Отправка по расписанию, без накопления задержек
+                delay = self.started_at + message_id * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.traces[message_id] = RequestTrace(message_id, time.perf_counter())
+            await websocket.send(json.dumps(self.make_message(message_id)))
+
+    async def _receive(self, websocket):
+        async for raw in websocket:
+            now = time.perf_counter()
+            self.bytes_received += len(raw)
+            data = wire_format.MsgpackWireCodec.decode(raw) if isinstance(raw, bytes) else json.loads(raw)
+            if data.get("type") == "resume_streams":
+                await self._request_missing(websocket, data.get("streams", []))
+                continue
+            trace = self.traces.get(data.get("messageId"))
+            if trace is None:
+                continue
+            seq = data.get("seq")
+            if seq is not None:
+                if seq in trace.seqs:
+                    continue
+                trace.seqs.add(seq)
+                if self.connections > 1:
+                    self.resumed_frames += 1
+            self.frames += 1
+            if data.get("type") == "from_owner":
+                trace.frames += 1
+                trace.chars += len(data.get("content", ""))
+                if trace.first_chunk_at is None:
+                    trace.first_chunk_at = now
+                # Непотоковый ответ приходит одним сообщением
+                if not data.get("stream"):
+                    trace.finished_at = now
+                elif trace.message_id == self.cancel_message_id and trace.frames == self.cancel_after_frames:
+                    await websocket.send(json.dumps({"type": "cancel_message", "messageId": trace.message_id}))
+            elif data.get("type") == "finished_message_stream":
+                trace.finished_at = now
+                trace.cancelled = bool(data.get("cancelled"))
+                trace.error = data.get("error")
+            if len(self.traces) == self.requests and all(t.finished_at for t in self.traces.values()):
+                self.completed.set()
+            elif self.connections == 1 and self.drop_after_frames and self.frames >= self.drop_after_frames:
+                await websocket.close()
+                return
+            elif self.connections == 1 and self.stall_after_frames and self.frames >= self.stall_after_frames:
+                # Ни сообщений, ни pong: соединение выглядит живым, но не отвечает
+                self.stalled = websocket
+                websocket.transport.pause_reading()
+
+    async def _request_missing(self, websocket, streams):
+        """Запрос фреймов, не полученных до разрыва соединения"""
+        for stream in streams:
+            trace = self.traces.get(stream.get("messageId"))
+            if trace is not None and trace.next_seq <= stream.get("lastSeq", -1):
+                await websocket.send(json.dumps({
+                    "type": "resume_request", "messageId": trace.message_id, "fromSeq": trace.next_seq
+                }))
@@ -0,0 +1,52 @@
+"""
+Проверки объединения токенов потокового ответа ChunkCoalescer
+
+    python -m pytest -q benchmarks/test_chunk_coalescer.py
+"""
+import asyncio
+
+from chunk_coalescer import ChunkCoalescer
+
+
+def test_window_flush_in_progress_is_stopped_by_discard():
+    async def scenario():
+        delivered = []
+        started = asyncio.Event()
+
+        async def send_chunk(text, message_id):
+            if delivered:
+                # Отправка по таймеру ждет освобождения соединения
+                started.set()
+                await asyncio.sleep(1)
+            delivered.append(text)
+            return True
+
+        coalescer = ChunkCoalescer(send_chunk, message_id=1, window_ms=10, max_bytes=1024)
+        await coalescer.add("первый")
+        await coalescer.add(" второй")
+        await asyncio.wait_for(started.wait(), 1)
+        await coalescer.discard()
+        # После discard фрагмент уже не может прийти, даже если дать циклу поработать
+        await asyncio.sleep(0.05)
+        return delivered
+
+    assert asyncio.run(scenario()) == ["первый"]
+
+
+def test_tokens_are_joined_within_window():
+    async def scenario():
+        delivered = []
+
+        async def send_chunk(text, message_id):
+            delivered.append(text)
+            return True
+
+        coalescer = ChunkCoalescer(send_chunk, message_id=1, window_ms=10, max_bytes=1024)
+        for token in ["а", "б", "в", "г"]:
+            await coalescer.add(token)
+        await asyncio.sleep(0.05)
+        await coalescer.close()
+        return delivered, coalescer.frames_saved
+
+    # Первый токен отправляется сразу, остальные - одним фреймом по окончании окна
+    assert asyncio.run(scenario()) == (["а", "бвг"], 2)
@@ -0,0 +1,189 @@
+"""
+Сквозные проверки клиента на локальных заменителях серверов (без сети и GPU)
+
+    python -m pytest -q benchmarks
+
+Пороги производительности заданы с большим запасом и ловят только грубые
+регрессии в горячем пути StreamHandler / WebSocketHandler. Порог процессорного
+времени на токен можно изменить переменной окружения E2E_MAX_CPU_US_PER_TOKEN.
+"""
+import os
+import json
+import asyncio
+
+import pytest
+
+from benchmarks.bench_e2e import run_e2e, closed_port
+from tracing import convert_to_chrome
+
+MAX_CPU_US_PER_TOKEN = float(os.environ.get("E2E_MAX_CPU_US_PER_TOKEN", 2000))
+
+
+def run(**kwargs):
+    return asyncio.run(run_e2e(timeout=30.0, **kwargs))
+
+
+def test_stream_requests_complete():
+    result = run(requests=20, tokens=16, max_concurrent=4)
+    assert result["requests"] == 20
+    # Каждый токен отдельным фреймом плюс сообщение о завершении потока
+    assert result["frames"] == 20 * (16 + 1)
+    assert result["ollama_connections"] <= 4
+
+
+def test_non_stream_requests_complete():
+    result = run(requests=20, tokens=16, stream=False, max_concurrent=4)
+    assert result["requests"] == 20
+    assert result["frames"] == 20
+
+
+def test_stream_error_finishes_buyer_stream():
+    # Ошибка генерации завершает поток покупателя сообщением с описанием ошибки
+    result = run(requests=3, tokens=8, max_concurrent=3, extra_config={"ollama_port": closed_port()})
+    assert result["requests"] == 3
+    assert result["errors"] == 3
+    assert result["frames"] == 3
+
+
+def test_unreachable_backend_is_ejected_by_stream_failures():
+    # Фоновая проверка бэкендов отключена: недоступный бэкенд исключают ошибки самих запросов
+    result = run(requests=6, tokens=8, max_concurrent=1, dead_backends=1,
+                 extra_config={"ollama_routing": "least_in_flight", "ollama_health_check_interval": 0})
+    assert result["requests"] == 6
+    # Два запроса подряд (порог исключения) попадают на недоступный бэкенд, остальные - на рабочий
+    assert result["errors"] == 2
+    assert result["ollama_generations"] == 4
+
+
+def test_coalescing_reduces_frames_and_keeps_ttft():
+    plain = run(requests=5, tokens=40, token_delay=0.002, max_concurrent=5)
+    coalesced = run(requests=5, tokens=40, token_delay=0.002, max_concurrent=5, coalesce_ms=20)
+    assert coalesced["requests"] == 5
+    assert coalesced["frames"] < plain["frames"] / 2
+    # Первый токен отправляется сразу, без ожидания окна объединения
+    assert coalesced["ttft_p95"] < plain["ttft_p95"] + 0.05
+
+
+def test_concurrency_overlaps_slow_generations():
+    result = run(requests=8, tokens=10, token_delay=0.02, max_concurrent=8)
+    # Последовательная обработка заняла бы не меньше 8 * 10 * 0.02 = 1.6 сек
+    assert result["wall_time"] < 1.0
+
+
+def test_stream_cpu_per_token_budget():
+    result = run(requests=50, tokens=64, max_concurrent=4)
+    assert result["requests"] == 50
+    assert result["cpu_us_per_token"] < MAX_CPU_US_PER_TOKEN
+
+
+def test_msgpack_wire_format_reduces_payload():
+    pytest.importorskip("msgpack")
+    plain = run(requests=10, tokens=32, max_concurrent=4)
+    packed = run(requests=10, tokens=32, max_concurrent=4, extra_config={"wire_format": "msgpack"})
+    assert plain["wire_format"] == "json"
+    assert packed["wire_format"] == "msgpack"
+    assert packed["requests"] == 10
+    assert packed["frames"] == plain["frames"]
+    assert packed["bytes_received"] < plain["bytes_received"] * 0.6
+
+
+def test_streams_resume_after_reconnect():
+    result = run(requests=4, tokens=50, token_delay=0.002, max_concurrent=4, drop_after_frames=40,
+                 extra_config={"reconnect_base_delay": 0.05})
+    assert result["connections"] == 2
+    assert result["requests"] == 4
+    # Каждый фрейм получен ровно один раз и без пропусков номеров
+    assert result["frames"] == 4 * (50 + 1)
+    assert result["gaps"] == 0
+    assert result["resumed_frames"] > 0
+
+
+def test_dead_link_detected_by_heartbeat():
+    # Задержка переподключения по умолчанию не уложилась бы в таймаут: после обнаружения
+    # мертвого соединения клиент переподключается сразу
+    result = run(requests=4, tokens=50, token_delay=0.005, max_concurrent=4, stall_after_frames=40,
+                 extra_config={"heartbeat_interval": 0.05, "heartbeat_timeout": 0.2, "reconnect_base_delay": 30})
+    assert result["connections"] == 2
+    assert result["requests"] == 4
+    assert result["frames"] == 4 * (50 + 1)
+    assert result["gaps"] == 0
+    assert result["rtt_samples"] > 0
+    assert result["wall_time"] < 5
+
+
+def test_model_affinity_reduces_swaps():
+    options = dict(requests=24, tokens=8, token_delay=0.002, max_concurrent=2, models=["llama2", "mistral"],
+                   load_delay=0.05)
+    mixed = run(extra_config={"scheduler_model_affinity": False}, **options)
+    grouped = run(**options)
+    assert mixed["requests"] == grouped["requests"] == 24
+    # Запросы к загруженной модели выдаются первыми: вторая модель загружается один раз
+    assert grouped["model_loads"] == 1
+    assert mixed["model_loads"] > grouped["model_loads"]
+
+
+def test_identical_prompts_share_one_generation():
+    # Запросы приходят во время генерации и догоняют уже отправленные фрагменты;
+    # отмена первого запроса не прерывает генерацию для остальных
+    result = run(requests=4, rate=50, tokens=40, token_delay=0.005, max_concurrent=4, same_prompt=True,
+                 cancel_message_id=0, cancel_after_frames=5)
+    assert result["requests"] == 4
+    assert result["ollama_generations"] == 1
+    assert result["cancelled"] == 1
+    assert [result["frames_per_request"][message_id] for message_id in (1, 2, 3)] == [40, 40, 40]
+    assert result["gaps"] == 0
+
+
+def test_trace_spans_cover_request_phases(tmp_path):
+    trace_file = tmp_path / "client.trace.jsonl"
+    result = run(requests=4, tokens=8, max_concurrent=2, extra_config={"trace_file": str(trace_file)})
+    assert result["requests"] == 4
+    spans = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    phases = {}
+    for span in spans:
+        phases.setdefault(span["messageId"], set()).add(span["name"])
+    assert sorted(phases) == [0, 1, 2, 3]
+    for names in phases.values():
+        assert {"queue", "http_request", "prompt_eval", "generation", "ws_send", "request"} <= names
+    assert convert_to_chrome(trace_file, tmp_path / "client.trace.json") == len(spans)
+
+
+def test_context_and_output_sized_per_request():
+    # Слишком длинный запрос отклоняется без генерации, max_tokens покупателя ограничивает ответ,
+    # окно контекста выбирается по размеру запроса и не уменьшается, пока модель загружена
+    overrides = {
+        0: {"content": "слово " * 20000},
+        1: {"max_tokens": 8},
+        2: {"content": "длинный запрос " * 600},
+    }
+    result = run(requests=4, tokens=32, max_concurrent=1, message_overrides=overrides,
+                 extra_config={"num_ctx_buckets": [2048, 8192], "num_predict": 32, "max_tokens_limit": 32})
+    assert result["requests"] == 4
+    assert result["ollama_generations"] == 3
+    assert result["frames_per_request"] == {0: 1, 1: 8, 2: 32, 3: 32}
+    assert [(options["num_ctx"], options["num_predict"]) for options in result["ollama_options"]] == \
+        [(2048, 8), (8192, 32), (8192, 32)]
+
+
+def test_config_reload_applies_to_new_requests_only():
+    # Изменение файла конфигурации подхватывается на лету: начатые запросы дописываются
+    # прежними параметрами, следующие получают новые
+    result = run(requests=6, rate=25, tokens=32, token_delay=0.005, max_concurrent=6,
+                 extra_config={"num_predict": 32, "config_watch_interval": 0.02},
+                 config_update={"num_predict": 8}, config_update_after_frames=20)
+    assert result["requests"] == 6
+    assert result["gaps"] == 0
+    num_predict = [options["num_predict"] for options in result["ollama_options"]]
+    assert 32 in num_predict and 8 in num_predict
+    assert num_predict == sorted(num_predict, reverse=True)
+    assert sorted(result["frames_per_request"].values()) == sorted(num_predict)
+
+
+def test_drain_finishes_in_flight_streams_and_exits():
+    # После начала штатной остановки новые запросы отклоняются, а выполняющиеся дописываются
+    result = run(requests=6, rate=25, tokens=32, token_delay=0.01, max_concurrent=6, drain_after_frames=5)
+    assert result["client_exited"]
+    assert result["cancelled"] == 0
+    frames = list(result["frames_per_request"].values())
+    assert set(frames) == {32, 1}
+    assert frames.count(32) == result["ollama_generations"]
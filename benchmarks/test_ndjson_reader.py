@@ -0,0 +1,52 @@
+"""
+Проверки построчного чтения NDJSON-потока
+
+    python -m pytest -q benchmarks/test_ndjson_reader.py
+"""
+import asyncio
+
+import pytest
+
+from ndjson_reader import iter_lines, LineTooLongError
+
+
+def read_lines(chunks, **kwargs):
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [line async for line in iter_lines(source(), **kwargs)]
+
+    return asyncio.run(collect())
+
+
+def test_lines_within_one_buffer():
+    assert read_lines([b'{"a":1}\n{"b":2}\n']) == [b'{"a":1}', b'{"b":2}']
+
+
+def test_line_split_across_two_buffers():
+    assert read_lines([b'{"a":', b'1}\n{"b":2}\n']) == [b'{"a":1}', b'{"b":2}']
+
+
+def test_line_split_across_many_buffers():
+    line = b'{"response":"' + b"x" * 100 + b'"}'
+    chunks = [line[i:i + 7] for i in range(0, len(line), 7)] + [b"\n"]
+    assert read_lines(chunks) == [line]
+
+
+def test_trailing_line_without_newline():
+    assert read_lines([b'{"a":1}\n{"done":', b"true}"]) == [b'{"a":1}', b'{"done":true}']
+
+
+def test_empty_lines_and_carriage_returns_are_skipped():
+    assert read_lines([b"\n\r\n", b'{"a":1}\r\n', b"  \n\n", b'{"b":2}\n']) == [b'{"a":1}', b'{"b":2}']
+
+
+def test_line_longer_than_limit_is_rejected():
+    # Строка без перевода строки прерывается до склейки накопленных частей
+    with pytest.raises(LineTooLongError):
+        read_lines([b"x" * 10] * 5, max_line_bytes=32)
+    with pytest.raises(LineTooLongError):
+        read_lines([b"x" * 20, b"x" * 20 + b"\n"], max_line_bytes=32)
+    assert read_lines([b"x" * 16, b"x" * 16 + b"\n"], max_line_bytes=32) == [b"x" * 32]
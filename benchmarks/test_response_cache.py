@@ -0,0 +1,102 @@
+"""
+Проверки кэша ответов ResponseCache
+
+    python -m pytest -q benchmarks/test_response_cache.py
+"""
+import json
+import asyncio
+
+import response_cache
+from response_cache import ResponseCache
+
+
+def make_cache(tmp_path, **kwargs):
+    return ResponseCache(str(tmp_path / "responses.json"), **kwargs)
+
+
+class Clock:
+    """Подменяемое время для проверки срока жизни записей"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_entries=2)
+    cache.put("a", "ответ a")
+    cache.put("b", "ответ b")
+    # Обращение к "a" делает самой давно неиспользуемой запись "b"
+    assert cache.get("a") == "ответ a"
+    cache.put("c", "ответ c")
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.get("b") is None
+
+
+def test_expired_entry_is_dropped_on_get(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock.time)
+    cache = make_cache(tmp_path, ttl=10)
+    cache.put("a", "ответ")
+    clock.now += 5
+    assert cache.get("a") == "ответ"
+    clock.now += 6
+    assert cache.get("a") is None
+    assert "a" not in cache.entries
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_expired_entries_are_skipped_on_load(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "time", clock.time)
+    path = tmp_path / "responses.json"
+    path.write_text(json.dumps({"entries": [["old", clock.now - 20, "старый"], ["new", clock.now - 5, "новый"]]}))
+    cache = make_cache(tmp_path, ttl=10)
+    assert list(cache.entries) == ["new"]
+
+
+def test_only_deterministic_requests_are_cacheable(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.is_cacheable({"prompt": "p", "options": {"temperature": 0}})
+    assert cache.is_cacheable({"prompt": "p", "options": {"seed": 42, "temperature": 0.8}})
+    assert not cache.is_cacheable({"prompt": "p", "options": {"seed": -1, "temperature": 0.8}})
+    assert not cache.is_cacheable({"prompt": "p", "options": {"temperature": 0.8}})
+    assert not cache.is_cacheable({"prompt": "p", "options": {}})
+    # Продолжение беседы не кэшируется даже при temperature 0
+    assert not cache.is_cacheable({"prompt": "p", "context": [1, 2], "options": {"temperature": 0}})
+    sampled = make_cache(tmp_path, allow_sampled=True)
+    assert sampled.is_cacheable({"prompt": "p", "options": {"temperature": 0.8}})
+
+
+def test_put_does_not_write_and_stop_saves(tmp_path):
+    async def scenario():
+        cache = make_cache(tmp_path, save_interval=3600)
+        cache.start()
+        cache.put("a", "ответ")
+        await asyncio.sleep(0)
+        # Запись на диск выполняет только фоновая задача
+        assert not (tmp_path / "responses.json").exists()
+        await cache.stop()
+
+    asyncio.run(scenario())
+    reloaded = make_cache(tmp_path)
+    assert reloaded.get("a") == "ответ"
+
+
+def test_background_task_saves_changes(tmp_path):
+    async def scenario():
+        cache = make_cache(tmp_path, save_interval=0.01)
+        cache.start()
+        cache.put("a", "ответ")
+        for _ in range(100):
+            if (tmp_path / "responses.json").exists():
+                break
+            await asyncio.sleep(0.01)
+        assert not cache.dirty
+        await cache.stop()
+
+    asyncio.run(scenario())
+    assert make_cache(tmp_path).get("a") == "ответ"
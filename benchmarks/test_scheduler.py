@@ -0,0 +1,124 @@
+"""
+Проверки планировщика запросов и адаптивного ограничителя параллельности
+
+    python -m pytest -q benchmarks/test_scheduler.py
+"""
+import asyncio
+
+from scheduler import (
+    RequestScheduler, FifoPolicy, FairPolicy, PriorityPolicy, ShortestPromptFirstPolicy,
+    AdaptiveConcurrencyLimiter
+)
+
+
+def message(message_id, buyer="a", priority=0, content="запрос"):
+    return {"type": "buyer_message", "messageId": message_id, "buyerId": buyer, "priority": priority,
+            "content": content}
+
+
+def dispatch_order(policy, messages, prepare=None, **kwargs):
+    """
+    Порядок обработки запросов, поставленных в очередь одновременно, при одном слоте
+
+    :param prepare: Функция (список QueuedRequest), вызываемая до начала выдачи
+    """
+    async def scenario():
+        order = []
+        done = asyncio.Event()
+
+        async def processor(data):
+            order.append(data["messageId"])
+            if len(order) == len(messages):
+                done.set()
+
+        scheduler = RequestScheduler(processor, policy, max_concurrent_requests=1, **kwargs)
+        requests = [scheduler.submit(data) for data in messages]
+        if prepare:
+            prepare(requests)
+        await asyncio.wait_for(done.wait(), 5)
+        await scheduler.stop()
+        return order
+
+    return asyncio.run(scenario())
+
+
+def test_fifo_keeps_arrival_order():
+    assert dispatch_order(FifoPolicy(), [message(i) for i in range(4)]) == [0, 1, 2, 3]
+
+
+def test_priority_policy_prefers_higher_priority():
+    messages = [message(0, priority=0), message(1, priority=5), message(2, priority=1), message(3, priority=5)]
+    assert dispatch_order(PriorityPolicy(), messages) == [1, 3, 2, 0]
+
+
+def test_shortest_prompt_goes_first():
+    messages = [message(0, content="x" * 30), message(1, content="x" * 10), message(2, content="x" * 20)]
+    assert dispatch_order(ShortestPromptFirstPolicy(), messages) == [1, 2, 0]
+
+
+def test_fair_policy_alternates_buyers():
+    messages = [message(0, "a"), message(1, "a"), message(2, "a"), message(3, "b"), message(4, "b")]
+    assert dispatch_order(FairPolicy(), messages) == [0, 3, 1, 4, 2]
+
+
+def test_fair_policy_respects_weights():
+    messages = [message(i, "a") for i in range(4)] + [message(i, "b") for i in range(4, 8)]
+    order = dispatch_order(FairPolicy({"a": 3}), messages)
+    # Покупатель с весом 3 получает три слота на каждый слот покупателя с весом 1
+    assert order[:4] == [0, 1, 2, 4]
+
+
+def test_starving_request_bypasses_policy():
+    messages = [message(0, priority=0), message(1, priority=5), message(2, priority=5)]
+
+    def age_first(requests):
+        requests[0].enqueued_at -= 10
+
+    assert dispatch_order(PriorityPolicy(), messages, prepare=age_first, max_wait=5) == [0, 1, 2]
+    assert dispatch_order(PriorityPolicy(), messages, prepare=age_first, max_wait=0) == [1, 2, 0]
+
+
+def test_rate_limited_buyer_waits_for_tokens():
+    messages = [message(0, "a"), message(1, "a"), message(2, "b")]
+    # Покупатель "a" исчерпал пачку из одного запроса, поэтому запрос "b" обгоняет его второй запрос
+    assert dispatch_order(FifoPolicy(), messages, rate_limit=50, rate_burst=1) == [0, 2, 1]
+
+
+def test_idle_rate_buckets_are_evicted():
+    scheduler = RequestScheduler(rate_limit=10, rate_burst=2)
+    now = scheduler.buckets_checked_at
+    scheduler._get_bucket("idle").consume(now)
+    scheduler._get_bucket("busy").consume(now)
+    # Пока не прошло время наполнения корзины, проверка не выполняется
+    assert scheduler._evict_idle_buckets(now + 0.1) == 0
+    later = now + 0.3
+    scheduler._get_bucket("busy").consume(later)
+    scheduler._get_bucket("busy").consume(later)
+    assert scheduler._evict_idle_buckets(later) == 1
+    assert list(scheduler.buckets) == ["busy"]
+
+
+def test_limiter_grows_additively_and_shrinks_multiplicatively():
+    limiter = AdaptiveConcurrencyLimiter(4, min_limit=1, max_limit=8, latency_target=1.0, cooldown=3600)
+    for _ in range(5):
+        limiter.observe(0.1, in_flight=limiter.current)
+    # Примерно +1 за поколение из limit запросов (прибавка 1/limit за каждый запрос)
+    assert limiter.current == 5
+    # Пока слоты заняты не полностью, лимит не растет
+    limiter.observe(0.1, in_flight=1)
+    assert limiter.current == 5
+    limiter.observe(2.0, in_flight=5)
+    assert limiter.current == 3
+    # Повторное превышение в пределах cooldown лимит не уменьшает
+    limiter.observe(2.0, in_flight=3)
+    assert limiter.current == 3
+
+
+def test_limiter_stays_within_bounds():
+    limiter = AdaptiveConcurrencyLimiter(2, min_limit=2, max_limit=3, latency_target=1.0, cooldown=0)
+    for _ in range(20):
+        limiter.observe(0.1, in_flight=limiter.current)
+    assert limiter.current == 3
+    for _ in range(20):
+        limiter.observe(5.0, in_flight=limiter.current)
+    assert limiter.current == 2
@@ -0,0 +1,60 @@
+"""
+Проверки переиспользования контекста бесед SessionStore
+
+    python -m pytest -q benchmarks/test_session_store.py
+"""
+from session_store import SessionStore, SessionTurn
+
+NUM_CTX = 4096
+HISTORY = "Покупатель: Расскажите о доставке в другие города и сроках отправки заказов\n"
+RESPONSE = "Доставляем по всей стране за 3-5 дней."
+
+
+def completed_session(store):
+    """Беседа после одного хода: сохранены запрос, ответ и context"""
+    session = store.get("беседа")
+    turn = store.prepare_turn(session, HISTORY, NUM_CTX, "llama2")
+    store.complete_turn(turn, RESPONSE, {"context": [1, 2, 3]}, "llama2", "stream")
+    return session
+
+
+def test_continuation_sends_only_new_reply_with_context():
+    store = SessionStore()
+    session = completed_session(store)
+    prompt = f"{HISTORY}Продавец: {RESPONSE}\nПокупатель: А самовывоз есть?"
+    turn = store.prepare_turn(session, prompt, NUM_CTX, "llama2")
+    assert turn.context == [1, 2, 3]
+    assert turn.prompt == "Покупатель: А самовывоз есть?"
+    assert turn.full_prompt == prompt
+
+
+def test_changed_history_resets_context():
+    store = SessionStore()
+    session = completed_session(store)
+    # Начало истории то же, но предыдущий запрос отредактирован
+    prompt = HISTORY[:70] + " и стоимости\n"
+    turn = store.prepare_turn(session, prompt, NUM_CTX, "llama2")
+    assert turn.context is None
+    assert turn.prompt == prompt
+    assert session.context is None
+    assert store.total_tokens == 0
+
+
+def test_unrelated_prompt_does_not_reuse_context():
+    store = SessionStore()
+    session = completed_session(store)
+    prompt = "Покупатель: Какая гарантия на товар?"
+    turn = store.prepare_turn(session, prompt, NUM_CTX, "llama2")
+    assert isinstance(turn, SessionTurn)
+    assert turn.context is None
+    assert turn.prompt == prompt
+    assert session.context is None
+
+
+def test_other_model_does_not_reuse_context():
+    store = SessionStore()
+    session = completed_session(store)
+    prompt = f"{HISTORY}Продавец: {RESPONSE}\nПокупатель: А самовывоз есть?"
+    turn = store.prepare_turn(session, prompt, NUM_CTX, "mistral")
+    assert turn.context is None
+    assert turn.prompt == prompt
@@ -0,0 +1,40 @@
+"""
+Проверки объединения одинаковых запросов SingleFlight в OllamaClient
+
+    python -m pytest -q benchmarks/test_single_flight.py
+"""
+import asyncio
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from ollama_client import OllamaClient
+from single_flight import SingleFlight
+
+
+def test_identical_requests_share_one_generation():
+    async def scenario():
+        async with FakeOllamaServer(tokens=8, token_delay=0.01) as ollama:
+            flights = SingleFlight()
+            client = OllamaClient("127.0.0.1", ollama.port, single_flight=flights)
+            prepared = []
+            prepare_request_data = client.prepare_request_data
+
+            def counting_prepare(*args, **kwargs):
+                request_data = prepare_request_data(*args, **kwargs)
+                prepared.append(request_data)
+                return request_data
+
+            client.prepare_request_data = counting_prepare
+            try:
+                responses = await asyncio.gather(client.generate("запрос", message_id=1),
+                                                 client.generate("запрос", message_id=2))
+            finally:
+                await client.close()
+            return responses, prepared, flights.joins, ollama.generations, ollama.generation_options
+
+    responses, prepared, joins, generations, options = asyncio.run(scenario())
+    assert responses[0] == responses[1]
+    assert joins == 1
+    assert generations == 1
+    # Данные запроса готовятся один раз на каждого покупателя, и в Ollama уходят те же данные, по которым считан ключ
+    assert len(prepared) == 2
+    assert options == [prepared[0]["options"]]
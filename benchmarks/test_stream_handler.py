@@ -0,0 +1,46 @@
+"""
+Проверки завершения потоковых ответов StreamHandler
+
+    python -m pytest -q benchmarks/test_stream_handler.py
+"""
+import asyncio
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from stream_handler import StreamHandler
+
+
+class RecordingSender:
+    """Получатель фрагментов, запоминающий завершающие фреймы"""
+
+    def __init__(self):
+        self.chunks = 0
+        self.finished = []
+
+    async def send_stream_chunk(self, text, message_id):
+        self.chunks += 1
+        return True
+
+    async def send_stream_finished(self, message_id, cancelled=False, error=None):
+        self.finished.append(error)
+        return True
+
+
+def test_failing_on_complete_does_not_send_second_finished_frame():
+    def failing_on_complete(full_response, final_data):
+        raise RuntimeError("ошибка сохранения")
+
+    async def scenario():
+        async with FakeOllamaServer(tokens=3) as ollama:
+            sender = RecordingSender()
+            handler = StreamHandler(sender)
+            result = await handler.process_stream(
+                f"http://127.0.0.1:{ollama.port}/api/generate",
+                {"model": ollama.model, "prompt": "запрос", "stream": True},
+                message_id=1, on_complete=failing_on_complete, collect_response=True
+            )
+            return result, sender
+
+    result, sender = asyncio.run(scenario())
+    # Поток завершен одним штатным фреймом, ответ покупателю не заменяется текстом ошибки
+    assert result == " token" * 3
+    assert sender.finished == [None]
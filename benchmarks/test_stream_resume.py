@@ -0,0 +1,189 @@
+"""
+Проверки поведения потоков при потере соединения с сервером
+
+    python -m pytest -q benchmarks/test_stream_resume.py
+"""
+import time
+import asyncio
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from benchmarks.fake_proxy import FakeProxyServer
+from stream_handler import StreamHandler
+from stream_replay import FRAME_BUFFERED
+import websocket_handler
+from websocket_handler import WebSocketHandler
+
+
+class OfflineSender:
+    """Получатель фрагментов, у которого нет соединения: все фреймы только сохраняются в буфере"""
+
+    def __init__(self):
+        self.chunks = 0
+        self.finished = []
+
+    async def send_stream_chunk(self, text, message_id):
+        self.chunks += 1
+        return FRAME_BUFFERED
+
+    async def send_stream_finished(self, message_id, cancelled=False, error=None):
+        self.finished.append(error)
+        return FRAME_BUFFERED
+
+
+def test_generation_stops_when_link_stays_down():
+    async def scenario():
+        async with FakeOllamaServer(tokens=1000, token_delay=0.005) as ollama:
+            sender = OfflineSender()
+            handler = StreamHandler(sender, stall_timeout=0.1)
+            started = time.perf_counter()
+            result = await handler.process_stream(
+                f"http://127.0.0.1:{ollama.port}/api/generate",
+                {"model": ollama.model, "prompt": "запрос", "stream": True},
+                message_id=1
+            )
+            return result, sender, time.perf_counter() - started
+
+    result, sender, elapsed = asyncio.run(scenario())
+    # Полная генерация заняла бы 5 сек
+    assert elapsed < 2
+    assert 0 < sender.chunks < 1000
+    assert sender.finished == [result]
+    assert "Нет соединения с сервером" in result
+
+
+def make_handler(proxy):
+    handler = WebSocketHandler(port=0, token="bench", url=proxy.url, heartbeat_interval=0)
+    handler.replay.record(1, {"type": "from_owner", "content": "фрагмент", "messageId": 1, "stream": True})
+    return handler
+
+
+def test_connect_resends_buffered_frames():
+    async def scenario():
+        async with FakeProxyServer(requests=0) as proxy:
+            handler = make_handler(proxy)
+            assert await handler.connect()
+            connected = handler.is_connected
+            unsent = handler.replay.unsent()
+            await handler.disconnect()
+            return connected, unsent
+
+    connected, unsent = asyncio.run(scenario())
+    assert connected
+    assert unsent == []
+
+
+def test_resume_failure_triggers_reconnect():
+    async def scenario():
+        async with FakeProxyServer(requests=0) as proxy:
+            handler = make_handler(proxy)
+
+            async def failing_resume():
+                raise RuntimeError("ошибка возобновления")
+
+            handler.resume_streams = failing_resume
+            await handler.connect()
+            # Транспорт уже разорван, закрывать соединение не нужно
+            return (handler.is_connected, handler.resuming, handler.next_reconnect_delay(1),
+                    len(handler.replay.unsent()))
+
+    connected, resuming, delay, unsent = asyncio.run(scenario())
+    assert not connected
+    assert not resuming
+    # Соединение устанавливается заново сразу, фрейм остается в буфере
+    assert delay == 0.0
+    assert unsent == 1
+
+
+def test_repeated_resume_failures_back_off(monkeypatch):
+    monkeypatch.setattr(websocket_handler.random, "uniform", lambda low, high: high)
+
+    async def scenario():
+        async with FakeProxyServer(requests=0) as proxy:
+            handler = make_handler(proxy)
+
+            async def failing_resume():
+                raise RuntimeError("ошибка возобновления")
+
+            handler.resume_streams = failing_resume
+            delays = []
+            for attempt in range(1, 4):
+                await handler.connect()
+                delays.append(handler.next_reconnect_delay(attempt))
+            return delays
+
+    # Сразу переподключается только первая попытка, дальше задержка растет вдвое
+    assert asyncio.run(scenario()) == [0.0, 2.0, 4.0]
+
+
+def test_resume_is_off_unless_server_confirms():
+    async def scenario():
+        async with FakeProxyServer(requests=0, resume=False) as proxy:
+            handler = make_handler(proxy)
+            await handler.connect()
+            frame = {"type": "from_owner", "content": "ответ", "messageId": 2}
+            sent = await handler.send_frame(2, frame, final=True)
+            await handler.disconnect()
+            return handler.resume_confirmed, sent, frame, handler.replay.streams
+
+    confirmed, sent, frame, streams = asyncio.run(scenario())
+    assert not confirmed
+    assert sent is True
+    # Без подтверждения фреймы не нумеруются, а хранившиеся в буфере отброшены
+    assert "seq" not in frame
+    assert not streams
+
+
+def test_frames_without_message_id_are_not_buffered():
+    async def scenario():
+        async with FakeProxyServer(requests=0) as proxy:
+            handler = make_handler(proxy)
+            await handler.connect()
+            sent = await handler.send_response("ответ без запроса")
+            await handler.disconnect()
+            return handler.resume_confirmed, sent, list(handler.replay.streams)
+
+    confirmed, sent, streams = asyncio.run(scenario())
+    assert confirmed
+    assert sent
+    assert -1 not in streams
+
+
+class FlakySender(OfflineSender):
+    """Получатель, соединение которого восстанавливается после первого фрагмента"""
+
+    async def send_stream_chunk(self, text, message_id):
+        self.chunks += 1
+        return FRAME_BUFFERED if self.chunks == 1 else True
+
+
+def test_slow_first_token_does_not_count_as_stall():
+    async def scenario():
+        async with FakeOllamaServer(tokens=5, first_token_delay=0.3) as ollama:
+            sender = FlakySender()
+            handler = StreamHandler(sender, stall_timeout=0.1)
+            result = await handler.process_stream(
+                f"http://127.0.0.1:{ollama.port}/api/generate",
+                {"model": ollama.model, "prompt": "запрос", "stream": True},
+                message_id=1
+            )
+            return result, sender
+
+    result, sender = asyncio.run(scenario())
+    # Ожидание первого токена дольше stall_timeout и кратковременный разрыв не прерывают генерацию
+    assert sender.chunks == 5
+    assert sender.finished == [None]
+    assert result == " token" * 5
+
+
+def test_send_response_reports_full_replay_buffer():
+    async def scenario():
+        async with FakeProxyServer(requests=0) as proxy:
+            handler = WebSocketHandler(port=0, token="bench", url=proxy.url, heartbeat_interval=0, replay_frames=1)
+            await handler.connect()
+            handler.is_connected = False
+            results = [await handler.send_response("ответ", 3), await handler.send_response("ответ", 3)]
+            await handler.disconnect()
+            return results
+
+    # Второй фрейм не помещается в буфер, где ждет отправки первый
+    assert asyncio.run(scenario()) == [FRAME_BUFFERED, False]
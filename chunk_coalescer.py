@@ -0,0 +1,113 @@
+import asyncio
+from config import logger
+
+class ChunkCoalescer:
+    """Класс для объединения токенов потокового ответа в более крупные фрагменты"""
+    
+    def __init__(self, send_chunk, message_id, window_ms, max_bytes):
+        """
+        Инициализация буфера объединения фрагментов
+        
+        Первый непустой токен отправляется сразу, чтобы не увеличивать время до
+        первого токена. Последующие токены накапливаются и отправляются одним
+        фреймом по истечении временного окна или при превышении порога по размеру,
+        в зависимости от того, что наступит раньше.
+        
+        :param send_chunk: Корутина отправки фрагмента (text, message_id)
+        :param message_id: ID сообщения
+        :param window_ms: Временное окно накопления в миллисекундах
+        :param max_bytes: Порог размера буфера в байтах
+        """
+        self.send_chunk = send_chunk
+        self.message_id = message_id
+        self.window = window_ms / 1000.0
+        self.max_bytes = max_bytes
+        
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.first_sent = False
+        self.tokens_in = 0
+        self.frames_out = 0
+        
+        self._lock = asyncio.Lock()
+        self._flush_task = None
+        # Все задачи отложенной отправки, включая уже начавшие отправку
+        self._timers = set()
+    
+    @property
+    def frames_saved(self):
+        """Количество фреймов, сэкономленных по сравнению с отправкой каждого токена"""
+        return max(0, self.tokens_in - self.frames_out)
+    
+    async def add(self, text):
+        """
+        Добавление токена в буфер
+        
+        :param text: Текст токена
+        """
+        if not text:
+            return
+        
+        # Пробельные токены раньше не отправлялись отдельными фреймами,
+        # поэтому учитываем только токены с текстом
+        if text.strip():
+            self.tokens_in += 1
+        
+        self.buffer.append(text)
+        self.buffered_bytes += len(text.encode('utf-8'))
+        
+        if not self.first_sent and text.strip():
+            self.first_sent = True
+            await self.flush()
+        elif self.buffered_bytes >= self.max_bytes:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_window())
+            self._timers.add(self._flush_task)
+            self._flush_task.add_done_callback(self._timers.discard)
+    
+    async def _flush_after_window(self):
+        """Отправка накопленного буфера по истечении временного окна"""
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        await self.flush()
+    
+    def _cancel_timer(self):
+        """Отмена отложенной отправки, если она запланирована"""
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        self._flush_task = None
+    
+    async def flush(self):
+        """Отправка накопленного буфера одним фреймом"""
+        self._cancel_timer()
+        async with self._lock:
+            if not self.buffer:
+                return
+            text = "".join(self.buffer)
+            self.buffer.clear()
+            self.buffered_bytes = 0
+            if text.strip():
+                self.frames_out += 1
+            await self.send_chunk(text, self.message_id)
+    
+    async def close(self):
+        """Отправка остатка буфера в конце потока"""
+        await self.flush()
+        logger.debug("Объединение фрагментов (messageId: %s): токенов %d, фреймов %d, сэкономлено %d",
+                     self.message_id, self.tokens_in, self.frames_out, self.frames_saved)
+    
+    async def discard(self):
+        """
+        Сброс буфера без отправки (например, при отмене запроса или ошибке)
+        
+        Отложенная отправка, которая уже началась, прерывается и завершается до
+        возврата, чтобы фрагмент не пришел после завершающего фрейма.
+        """
+        self._cancel_timer()
+        self.buffer.clear()
+        self.buffered_bytes = 0
+        timers = [task for task in self._timers if task is not asyncio.current_task()]
+        for task in timers:
+            task.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
@@ -3,6 +3,8 @@ import json
 import argparse
 import asyncio
 import time
+import math
+import signal
 import logging
 import traceback
 from getpass import getpass
@@ -14,17 +16,71 @@ import uuid
 from websocket_handler import WebSocketHandler
 from ollama_client import OllamaClient
 from stream_handler import StreamHandler
+from response_cache import ResponseCache
+from ollama_pool import parse_backends
+from scheduler import RequestScheduler, AdaptiveConcurrencyLimiter, create_policy
+from autotune import CapacityTuner
+from model_warmer import ModelWarmer
+from session_store import SessionStore, get_conversation_id
+from supervisor import Supervisor
+from single_flight import SingleFlight
+from context_sizing import ContextSizer, get_max_tokens
+from tracing import tracer
+from profiler import run_profile
+from metrics import (
+    metrics, MetricsServer, MODE_STREAM, MODE_NON_STREAM, IN_FLIGHT_REQUESTS, QUEUED_REQUESTS,
+    REQUESTS_TOTAL, REQUEST_DURATION_SECONDS, WEBSOCKET_SEND_SECONDS,
+    RESPONSE_CACHE_LOOKUPS, RESPONSE_CACHE_ENTRIES, SESSIONS_ACTIVE, SESSION_CONTEXT_TOKENS,
+    WEBSOCKET_RTT_RECENT_SECONDS, REQUESTS_REJECTED, CONFIG_RELOADS
+)
 from config import (
     logger, CONFIG_DIR, CONFIG_FILE, LOGS_DIR, LOG_FILE, 
     DEFAULT_HOST, DEFAULT_PORT, DEFAULT_PATH, RECONNECT_TIMEOUT, 
     DEFAULT_MODEL, DEFAULT_OLLAMA_HOST, DEFAULT_OLLAMA_PORT, DEFAULT_STREAM_MODE,
-    setup_logging, set_console_log_level, debug_json_error
+    DEFAULT_DISPATCH_MODE, DEFAULT_MAX_CONCURRENT_REQUESTS, DISPATCH_MODE_INLINE,
+    DEFAULT_OLLAMA_MAX_CONNECTIONS, DEFAULT_OLLAMA_KEEPALIVE_EXPIRY, DEFAULT_OLLAMA_HTTP2,
+    DEFAULT_STREAM_COALESCE_MS, DEFAULT_STREAM_COALESCE_BYTES, DEFAULT_DISCONNECT_ABORT_GRACE,
+    DEFAULT_STREAM_MAX_RESPONSE_CHARS, DEFAULT_SINGLE_FLIGHT, DEFAULT_STREAM_QUEUE_HIGH_WATERMARK, DEFAULT_STREAM_QUEUE_LOW_WATERMARK,
+    DEFAULT_STREAM_STALL_TIMEOUT, DEFAULT_STREAM_MAX_LINE_BYTES, DEFAULT_STREAM_RESUME, DEFAULT_STREAM_REPLAY_FRAMES, DEFAULT_STREAM_REPLAY_TTL,
+    DEFAULT_RECONNECT_BASE_DELAY, DEFAULT_RECONNECT_MAX_DELAY, DEFAULT_WORKERS,
+    DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_HEARTBEAT_TIMEOUT, DEFAULT_WS_SEND_TIMEOUT, DEFAULT_RTT_HISTORY,
+    DEFAULT_SCHEDULER_POLICY, DEFAULT_SCHEDULER_MAX_WAIT, DEFAULT_SCHEDULER_MODEL_AFFINITY, DEFAULT_ALLOWED_MODELS, DEFAULT_BUYER_RATE_LIMIT, DEFAULT_BUYER_RATE_BURST,
+    DEFAULT_OLLAMA_KEEP_ALIVE, DEFAULT_MODEL_WARMUP, DEFAULT_MODEL_WATCH_INTERVAL, DEFAULT_MODEL_UNLOAD_ON_EXIT,
+    DEFAULT_SESSIONS, DEFAULT_SESSION_MAX_SESSIONS, DEFAULT_SESSION_MAX_TOKENS, DEFAULT_SESSION_TTL,
+    DEFAULT_NUM_CTX, DEFAULT_NUM_PREDICT, DEFAULT_OLLAMA_REQUEST_TIMEOUT, DEFAULT_OLLAMA_STREAM_TIMEOUT,
+    DEFAULT_CONTEXT_SIZING, DEFAULT_NUM_CTX_BUCKETS, DEFAULT_MAX_TOKENS_LIMIT,
+    DEFAULT_CONFIG_WATCH_INTERVAL, DEFAULT_DRAIN_TIMEOUT,
+    DEFAULT_ADAPTIVE_CONCURRENCY, DEFAULT_ADAPTIVE_MIN_CONCURRENCY, DEFAULT_ADAPTIVE_MAX_CONCURRENCY,
+    DEFAULT_ADAPTIVE_LATENCY_TARGET, DEFAULT_AUTOTUNE_CONCURRENCY_LEVELS, DEFAULT_AUTOTUNE_CONTEXT_SIZES,
+    DEFAULT_AUTOTUNE_REQUESTS_PER_LEVEL, DEFAULT_AUTOTUNE_PROMPT_TOKENS, DEFAULT_AUTOTUNE_NUM_PREDICT,
+    DEFAULT_AUTOTUNE_P95_TARGET, DEFAULT_WIRE_FORMAT, DEFAULT_WS_COMPRESSION,
+    DEFAULT_WS_COMPRESSION_LEVEL, DEFAULT_WS_COMPRESSION_WINDOW_BITS,
+    RESPONSE_CACHE_FILE, DEFAULT_RESPONSE_CACHE, DEFAULT_RESPONSE_CACHE_MAX_ENTRIES,
+    DEFAULT_RESPONSE_CACHE_TTL, DEFAULT_RESPONSE_CACHE_ALLOW_SAMPLED,
+    DEFAULT_OLLAMA_ROUTING, DEFAULT_HEALTH_CHECK_INTERVAL,
+    DEFAULT_METRICS_HOST, DEFAULT_METRICS_PORT, DEFAULT_TRACE_FILE,
+    DEFAULT_PROFILE_DURATION, DEFAULT_PROFILE_INTERVAL, DEFAULT_PROFILE_MEMORY_FRAMES,
+    DEFAULT_LOG_MODE, DEFAULT_LOG_LEVEL, DEFAULT_LOG_ROTATION, DEFAULT_LOG_MAX_BYTES,
+    DEFAULT_LOG_BACKUP_COUNT, DEFAULT_LOG_ROTATION_WHEN,
+    setup_logging, set_console_log_level, stop_logging, debug_json_error
+)
+
+# Параметры, изменения которых применяются без перезапуска: из них собирается клиент Ollama
+RELOADABLE_KEYS = (
+    "model", "allowed_models", "ollama_host", "ollama_port", "ollama_backends", "ollama_routing",
+    "ollama_health_check_interval", "ollama_max_connections", "ollama_keepalive_expiry", "ollama_http2",
+    "ollama_keep_alive", "ollama_options", "num_ctx", "num_predict", "ollama_request_timeout",
+    "ollama_stream_timeout", "context_sizing", "num_ctx_buckets", "max_tokens_limit", "model_watch_interval",
 )
+# Параметры, которые клиент записывает сам или которые задаются и командной строкой
+IGNORED_RELOAD_KEYS = ("autotune", "trace_file")
 
 class OllamaProxyClient:
     """Главный класс приложения Ollama Proxy Client"""
     
-    def __init__(self, port=5050, host='bober.app', path='auth-proxy', debug=False):
+    def __init__(self, port=5050, host='bober.app', path='auth-proxy', debug=False,
+                 max_concurrent_requests=None, dispatch_mode=None, metrics_port=None, warmup=None,
+                 config=None, trace_file=None, profile_duration=None, config_file=None):
         """
         Инициализация основного клиента
         
@@ -32,40 +88,98 @@ class OllamaProxyClient:
         :param host: Хост WebSocket сервера
         :param path: Путь WebSocket подключения
         :param debug: Режим отладки
+        :param max_concurrent_requests: Лимит параллельных запросов (переопределяет конфигурацию)
+        :param dispatch_mode: Режим обработки запросов (переопределяет конфигурацию)
+        :param metrics_port: Порт локального сервера метрик (переопределяет конфигурацию, 0 - отключен)
+        :param warmup: Загружать модель до подключения к серверу (переопределяет конфигурацию)
+        :param config: Готовая конфигурация вместо config.json (для тестов и бенчмарков)
+        :param trace_file: Файл трассировки этапов запросов (переопределяет конфигурацию)
+        :param profile_duration: Профилировать процесс столько секунд после запуска (None - не профилировать)
+        :param config_file: Файл конфигурации, изменения которого применяются на лету
+            (по умолчанию config.json, если конфигурация не передана готовой)
         """
         # Устанавливаем базовые параметры
         self.port = port
         self.host = host
         self.path = path
         
+        # Загружаем настройки из конфигурационного файла
+        self.config_file = config_file or (CONFIG_FILE if config is None else None)
+        self.config = self.load_config() if config is None else dict(config)
+        # Функция, которую рабочий процесс применяет к перечитанной конфигурации (свой токен, свои бэкенды)
+        self.config_transform = None
+        
+        # Настраиваем журнал в соответствии с конфигурацией
+        setup_logging(
+            mode=self.config.get('log_mode', DEFAULT_LOG_MODE),
+            file_level=self.config.get('log_level', DEFAULT_LOG_LEVEL),
+            rotation=self.config.get('log_rotation', DEFAULT_LOG_ROTATION),
+            max_bytes=self.config.get('log_max_bytes', DEFAULT_LOG_MAX_BYTES),
+            backup_count=self.config.get('log_backup_count', DEFAULT_LOG_BACKUP_COUNT),
+            rotation_when=self.config.get('log_rotation_when', DEFAULT_LOG_ROTATION_WHEN),
+            log_file=self.config.get('log_file', LOG_FILE)
+        )
+        
         # Устанавливаем уровень логирования
         if debug:
             set_console_log_level(logging.DEBUG)
             logger.info("Включен режим отладки")
         
-        # Загружаем настройки из конфигурационного файла
-        self.config = self.load_config()
-        
         # Инициализируем параметры из конфигурации или значений по умолчанию
         self.token = self.config.get('token', None)
         self.model = self.config.get('model', DEFAULT_MODEL)
         self.ollama_host = self.config.get('ollama_host', DEFAULT_OLLAMA_HOST)
         self.ollama_port = self.config.get('ollama_port', DEFAULT_OLLAMA_PORT)
+        self.ollama_backends = self.config.get('ollama_backends', [])
+        self.dispatch_mode = dispatch_mode or self.config.get('dispatch_mode', DEFAULT_DISPATCH_MODE)
+        self.max_concurrent_requests = max_concurrent_requests or self.config.get(
+            'max_concurrent_requests', DEFAULT_MAX_CONCURRENT_REQUESTS
+        )
+        
+        self.metrics_host = self.config.get('metrics_host', DEFAULT_METRICS_HOST)
+        self.metrics_port = metrics_port if metrics_port is not None else self.config.get('metrics_port', DEFAULT_METRICS_PORT)
+        self.warmup = warmup if warmup is not None else self.config.get('model_warmup', DEFAULT_MODEL_WARMUP)
+        self.trace_file = trace_file or self.config.get('trace_file', DEFAULT_TRACE_FILE)
+        self.profile_duration = profile_duration
+        self.profile_task = None
         
         # Устанавливаем компоненты как None - будут инициализированы позже
         self.websocket_handler = None
         self.ollama_client = None
         self.stream_handler = None
+        self.metrics_server = None
+        self.model_warmer = None
+        
+        # Выполняющиеся генерации по messageId (для отмены)
+        self.active_requests = {}
+        
+        # Перезагрузка конфигурации и штатная остановка
+        self.reload_lock = asyncio.Lock()
+        self.retired_clients = set()
+        self.background_tasks = set()
+        self.draining = False
+        self.drain_task = None
+        self.listen_task = None
+        self.listen_stopped = False
         
         logger.info("Инициализирован клиент OllamaProxyClient")
         
     def load_config(self):
         """Загрузка конфигурации из файла"""
         try:
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
+            return self.read_config()
         except (FileNotFoundError, json.JSONDecodeError):
             return {}
+    
+    def read_config(self):
+        """
+        Чтение файла конфигурации
+        
+        :return: Словарь конфигурации
+        :raises FileNotFoundError, json.JSONDecodeError: Если файл отсутствует или поврежден
+        """
+        with open(self.config_file or CONFIG_FILE, 'r') as f:
+            return json.load(f)
 
     def save_config(self):
         """Сохранение конфигурации в файл"""
@@ -79,26 +193,162 @@ class OllamaProxyClient:
         """Инициализация компонентов приложения"""
         # Создаем обработчик WebSocket
         if not self.websocket_handler:
+            limiter = None
+            if self.config.get('adaptive_concurrency', DEFAULT_ADAPTIVE_CONCURRENCY):
+                limiter = AdaptiveConcurrencyLimiter(
+                    initial_limit=self.max_concurrent_requests,
+                    min_limit=self.config.get('adaptive_min_concurrency', DEFAULT_ADAPTIVE_MIN_CONCURRENCY),
+                    max_limit=self.config.get('adaptive_max_concurrency', DEFAULT_ADAPTIVE_MAX_CONCURRENCY),
+                    latency_target=self.config.get('adaptive_latency_target', DEFAULT_ADAPTIVE_LATENCY_TARGET)
+                )
+            scheduler = RequestScheduler(
+                policy=create_policy(
+                    self.config.get('scheduler_policy', DEFAULT_SCHEDULER_POLICY),
+                    buyer_weights=self.config.get('buyer_weights')
+                ),
+                max_concurrent_requests=self.max_concurrent_requests,
+                max_wait=self.config.get('scheduler_max_wait', DEFAULT_SCHEDULER_MAX_WAIT),
+                rate_limit=self.config.get('buyer_rate_limit', DEFAULT_BUYER_RATE_LIMIT),
+                rate_burst=self.config.get('buyer_rate_burst', DEFAULT_BUYER_RATE_BURST),
+                default_model=self.model,
+                limiter=limiter,
+                model_affinity=self.config.get('scheduler_model_affinity', DEFAULT_SCHEDULER_MODEL_AFFINITY)
+            )
             self.websocket_handler = WebSocketHandler(
                 port=self.port,
                 token=self.token,
-                message_processor=self.process_incoming_message
+                message_processor=self.process_incoming_message,
+                dispatch_mode=self.dispatch_mode,
+                max_concurrent_requests=self.max_concurrent_requests,
+                on_connection_lost=self.cancel_all_requests,
+                disconnect_abort_grace=self.config.get('disconnect_abort_grace', DEFAULT_DISCONNECT_ABORT_GRACE),
+                scheduler=scheduler,
+                url=self.config.get('server_url'),
+                wire_format=self.config.get('wire_format', DEFAULT_WIRE_FORMAT),
+                compression=self.config.get('ws_compression', DEFAULT_WS_COMPRESSION),
+                compression_level=self.config.get('ws_compression_level', DEFAULT_WS_COMPRESSION_LEVEL),
+                compression_window_bits=self.config.get('ws_compression_window_bits', DEFAULT_WS_COMPRESSION_WINDOW_BITS),
+                resume=self.config.get('stream_resume', DEFAULT_STREAM_RESUME),
+                replay_frames=self.config.get('stream_replay_frames', DEFAULT_STREAM_REPLAY_FRAMES),
+                replay_ttl=self.config.get('stream_replay_ttl', DEFAULT_STREAM_REPLAY_TTL),
+                reconnect_base_delay=self.config.get('reconnect_base_delay', DEFAULT_RECONNECT_BASE_DELAY),
+                reconnect_max_delay=self.config.get('reconnect_max_delay', DEFAULT_RECONNECT_MAX_DELAY),
+                heartbeat_interval=self.config.get('heartbeat_interval', DEFAULT_HEARTBEAT_INTERVAL),
+                heartbeat_timeout=self.config.get('heartbeat_timeout', DEFAULT_HEARTBEAT_TIMEOUT),
+                send_timeout=self.config.get('ws_send_timeout', DEFAULT_WS_SEND_TIMEOUT),
+                rtt_history=self.config.get('rtt_history', DEFAULT_RTT_HISTORY)
             )
             
         # Создаем клиент Ollama API
         if not self.ollama_client:
-            self.ollama_client = OllamaClient(
-                host=self.ollama_host,
-                port=self.ollama_port,
-                model=self.model
-            )
+            self.use_ollama_client(self.create_ollama_client())
             
         # Создаем обработчик потоковых данных
         if not self.stream_handler:
             self.stream_handler = StreamHandler(
-                websocket_handler=self.websocket_handler
+                websocket_handler=self.websocket_handler,
+                coalesce_ms=self.config.get('stream_coalesce_ms', DEFAULT_STREAM_COALESCE_MS),
+                coalesce_bytes=self.config.get('stream_coalesce_bytes', DEFAULT_STREAM_COALESCE_BYTES),
+                max_response_chars=self.config.get('stream_max_response_chars', DEFAULT_STREAM_MAX_RESPONSE_CHARS),
+                queue_high_watermark=self.config.get('stream_queue_high_watermark', DEFAULT_STREAM_QUEUE_HIGH_WATERMARK),
+                queue_low_watermark=self.config.get('stream_queue_low_watermark', DEFAULT_STREAM_QUEUE_LOW_WATERMARK),
+                stall_timeout=self.config.get('stream_stall_timeout', DEFAULT_STREAM_STALL_TIMEOUT),
+                max_line_bytes=self.config.get('stream_max_line_bytes', DEFAULT_STREAM_MAX_LINE_BYTES)
             )
     
+    def create_ollama_client(self, previous=None):
+        """
+        Создание клиента Ollama API по текущей конфигурации
+        
+        :param previous: Заменяемый клиент: его кэш ответов, беседы и калибровка оценки токенов
+            переходят к новому (None - создать заново)
+        :return: Объект OllamaClient
+        """
+        if previous is not None:
+            response_cache = previous.response_cache
+            session_store = previous.session_store
+        else:
+            response_cache = None
+            if self.config.get('response_cache', DEFAULT_RESPONSE_CACHE):
+                response_cache = ResponseCache(
+                    path=self.config.get('response_cache_file', RESPONSE_CACHE_FILE),
+                    max_entries=self.config.get('response_cache_max_entries', DEFAULT_RESPONSE_CACHE_MAX_ENTRIES),
+                    ttl=self.config.get('response_cache_ttl', DEFAULT_RESPONSE_CACHE_TTL),
+                    allow_sampled=self.config.get('response_cache_allow_sampled', DEFAULT_RESPONSE_CACHE_ALLOW_SAMPLED)
+                )
+            
+            session_store = None
+            if self.config.get('sessions', DEFAULT_SESSIONS):
+                session_store = SessionStore(
+                    max_sessions=self.config.get('session_max_sessions', DEFAULT_SESSION_MAX_SESSIONS),
+                    max_tokens=self.config.get('session_max_tokens', DEFAULT_SESSION_MAX_TOKENS),
+                    ttl=self.config.get('session_ttl', DEFAULT_SESSION_TTL)
+                )
+        
+        # Генерации заменяемого клиента выполняются его пулом соединений, поэтому к ним не присоединяются
+        single_flight = None
+        if self.config.get('single_flight', DEFAULT_SINGLE_FLIGHT):
+            single_flight = SingleFlight(
+                max_history_chars=self.config.get('stream_max_response_chars', DEFAULT_STREAM_MAX_RESPONSE_CHARS)
+            )
+        
+        context_sizer = None
+        if self.config.get('context_sizing', DEFAULT_CONTEXT_SIZING):
+            # Значения из ollama_options имеют приоритет, как и в самих запросах
+            options = self.config.get('ollama_options') or {}
+            num_ctx = options.get('num_ctx') or self.config.get('num_ctx', DEFAULT_NUM_CTX)
+            context_sizer = ContextSizer(
+                buckets=self.config.get('num_ctx_buckets', DEFAULT_NUM_CTX_BUCKETS) or [num_ctx],
+                num_predict=options.get('num_predict') or self.config.get('num_predict', DEFAULT_NUM_PREDICT),
+                max_tokens_limit=self.config.get('max_tokens_limit', DEFAULT_MAX_TOKENS_LIMIT),
+                estimator=previous.context_sizer.estimator if previous and previous.context_sizer else None
+            )
+        
+        return OllamaClient(
+            host=self.ollama_host,
+            port=self.ollama_port,
+            model=self.model,
+            max_connections=self.config.get('ollama_max_connections', DEFAULT_OLLAMA_MAX_CONNECTIONS),
+            keepalive_expiry=self.config.get('ollama_keepalive_expiry', DEFAULT_OLLAMA_KEEPALIVE_EXPIRY),
+            http2=self.config.get('ollama_http2', DEFAULT_OLLAMA_HTTP2),
+            response_cache=response_cache,
+            options=self.config.get('ollama_options'),
+            backends=parse_backends(self.ollama_backends, self.ollama_host, self.ollama_port),
+            routing=self.config.get('ollama_routing', DEFAULT_OLLAMA_ROUTING),
+            health_check_interval=self.config.get('ollama_health_check_interval', DEFAULT_HEALTH_CHECK_INTERVAL),
+            keep_alive=self.config.get('ollama_keep_alive', DEFAULT_OLLAMA_KEEP_ALIVE),
+            session_store=session_store,
+            num_ctx=self.config.get('num_ctx', DEFAULT_NUM_CTX),
+            num_predict=self.config.get('num_predict', DEFAULT_NUM_PREDICT),
+            request_timeout=self.config.get('ollama_request_timeout', DEFAULT_OLLAMA_REQUEST_TIMEOUT),
+            stream_timeout=self.config.get('ollama_stream_timeout', DEFAULT_OLLAMA_STREAM_TIMEOUT),
+            latency_observer=self.websocket_handler.scheduler.observe_latency,
+            allowed_models=self.config.get('allowed_models', DEFAULT_ALLOWED_MODELS),
+            single_flight=single_flight,
+            context_sizer=context_sizer
+        )
+    
+    def use_ollama_client(self, ollama_client):
+        """
+        Передача новых запросов клиенту Ollama API
+        
+        :param ollama_client: Объект OllamaClient
+        """
+        self.ollama_client = ollama_client
+        scheduler = self.websocket_handler.scheduler
+        scheduler.default_model = ollama_client.model
+        # Планировщик выдает первыми запросы к моделям, уже загруженным в Ollama
+        scheduler.model_resident = ollama_client.pool.has_model
+        scheduler.model_resolver = ollama_client.resolve_model
+        # Запросы, которые будут отклонены, не ждут свободного слота
+        scheduler.is_rejected = lambda message: self.get_rejection(message) is not None
+        
+        self.model_warmer = ModelWarmer(
+            ollama_client,
+            keep_alive=ollama_client.keep_alive,
+            watch_interval=self.config.get('model_watch_interval', DEFAULT_MODEL_WATCH_INTERVAL)
+        )
+    
     async def process_incoming_message(self, message):
         """
         Обработка входящего сообщения от сервера
@@ -109,43 +359,13 @@ class OllamaProxyClient:
             # Проверяем тип сообщения
             if message["type"] == "buyer_message":
                 # Обработка запроса от покупателя
-                prompt = message["content"]
-                message_id = message.get("messageId", -1)  # Получаем messageId из входящего сообщения
-                stream = message.get("stream", False)  # Получаем параметр stream из входящего сообщения
-                
-                logger.info(f"Получен запрос от покупателя (messageId: {message_id}, stream: {stream}): {prompt}")
-                print(f"Получен запрос от покупателя (messageId: {message_id}, stream: {stream}): {prompt[:50]}..." if len(prompt) > 50 else prompt)
-                
-                # Обрабатываем запрос в зависимости от режима
-                logger.info(f"Начинаем обработку запроса в режиме {'потоковом' if stream else 'непотоковом'}")
-                print(f"Режим обработки: {'потоковый' if stream else 'обычный'}")
-                
-                if stream:
-                    # В потоковом режиме используем обработчик потоковых данных
-                    logger.debug(f"Отправляем потоковый запрос в Ollama (messageId: {message_id})")
-                    ollama_response = await self.ollama_client.prepare_stream_request(
-                        prompt=prompt,
-                        stream_handler=self.stream_handler,
-                        message_id=message_id
-                    )
-                    logger.info(f"Ответ отправлен покупателю в потоковом режиме (messageId: {message_id})")
-                    print(f"Ответ успешно отправлен в потоковом режиме (messageId: {message_id})")
-                else:
-                    # В непотоковом режиме получаем полный ответ и отправляем его
-                    logger.debug(f"Отправляем обычный запрос в Ollama (messageId: {message_id})")
-                    ollama_response = await self.ollama_client.generate(
-                        prompt=prompt,
-                        stream_mode=False,
-                        message_id=message_id
-                    )
-                    
-                    # Отправляем ответ обратно на сервер
-                    logger.info(f"Отправляем ответ покупателю (messageId: {message_id}): {ollama_response[:100]}...")
-                    await self.websocket_handler.send_response(ollama_response, message_id)
-                    print(f"Ответ успешно отправлен (messageId: {message_id})")
+                await self.handle_buyer_message(message)
+            elif message["type"] == "cancel_message":
+                # Отмена выполняющегося запроса по messageId
+                await self.cancel_request(message.get("messageId", -1))
             else:
                 # Другие типы сообщений (например, system)
-                logger.debug(f"Получено сообщение типа {message['type']}")
+                logger.debug("Получено сообщение типа %s", message['type'])
                 
         except Exception as e:
             error_msg = f"Ошибка при обработке входящего сообщения: {str(e)}"
@@ -154,6 +374,381 @@ class OllamaProxyClient:
             # Выводим трассировку для отладки
             logger.debug(f"Трассировка ошибки:\n{traceback.format_exc()}")
     
+    async def handle_buyer_message(self, message):
+        """
+        Запуск генерации ответа в отдельной задаче, которую можно отменить по messageId
+        
+        :param message: Сообщение buyer_message
+        """
+        message_id = message.get("messageId", -1)
+        labels = self.get_request_labels(message)
+        task = asyncio.create_task(self.generate_response(message))
+        self.active_requests[message_id] = task
+        
+        IN_FLIGHT_REQUESTS.inc(**labels)
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self.active_requests.get(message_id) is task:
+                del self.active_requests[message_id]
+            IN_FLIGHT_REQUESTS.dec(**labels)
+        
+        REQUEST_DURATION_SECONDS.observe(time.perf_counter() - start_time, **labels)
+        if task.cancelled():
+            status = "cancelled"
+        else:
+            status = "error" if task.exception() else "ok"
+        REQUESTS_TOTAL.inc(status=status, **labels)
+        tracer.record("request", message_id, start_time, status=status, **labels)
+        
+        if task.cancelled():
+            logger.info(f"Генерация отменена (messageId: {message_id})")
+            print(f"Генерация отменена (messageId: {message_id})")
+            if self.websocket_handler.is_connected:
+                await self.websocket_handler.send_stream_finished(message_id, cancelled=True)
+        elif task.exception():
+            raise task.exception()
+    
+    def get_request_labels(self, message):
+        """
+        Метки метрик для запроса покупателя
+        
+        :param message: Сообщение buyer_message
+        :return: Словарь меток model и mode
+        """
+        # Поле model задает покупатель, поэтому в метки попадают только разрешенные модели
+        model = self.ollama_client.resolve_model(message.get("model")) if self.ollama_client else None
+        return {
+            "model": model or self.model,
+            "mode": MODE_STREAM if message.get("stream", False) else MODE_NON_STREAM
+        }
+    
+    def get_rejection(self, message):
+        """
+        Проверка запроса покупателя перед генерацией
+        
+        :param message: Сообщение buyer_message
+        :return: Пара (причина, текст ошибки для покупателя) или None, если запрос можно выполнять
+        """
+        if self.draining:
+            return "draining", "Ошибка: клиент владельца завершает работу, повторите запрос позже"
+        model = self.ollama_client.resolve_model(message.get("model"))
+        if model is None:
+            return "model", f"Ошибка: модель {message.get('model')} недоступна"
+        if not self.ollama_client.check_prompt(message.get("content", ""), model):
+            return "context", (f"Ошибка: запрос не помещается в окно контекста модели "
+                               f"({self.ollama_client.context_sizer.largest} токенов)")
+        return None
+    
+    def collect_metrics(self):
+        """Обновление метрик, которые вычисляются в момент запроса"""
+        QUEUED_REQUESTS.clear()
+        if self.websocket_handler:
+            for message in list(self.websocket_handler.queued_messages.values()):
+                QUEUED_REQUESTS.inc(**self.get_request_labels(message))
+            
+            WEBSOCKET_RTT_RECENT_SECONDS.clear()
+            for stat, value in self.websocket_handler.rtt_stats().items():
+                WEBSOCKET_RTT_RECENT_SECONDS.set(value, stat=stat)
+        
+        if self.ollama_client and self.ollama_client.response_cache:
+            stats = self.ollama_client.response_cache.stats()
+            RESPONSE_CACHE_LOOKUPS.set(stats["hits"], result="hit")
+            RESPONSE_CACHE_LOOKUPS.set(stats["misses"], result="miss")
+            RESPONSE_CACHE_ENTRIES.set(stats["entries"])
+        
+        if self.ollama_client and self.ollama_client.session_store:
+            stats = self.ollama_client.session_store.stats()
+            SESSIONS_ACTIVE.set(stats["sessions"])
+            SESSION_CONTEXT_TOKENS.set(stats["tokens"])
+    
+    def start_profile(self, duration=None):
+        """
+        Запуск окна профилирования процессора и памяти
+        
+        :param duration: Длительность окна в секундах (по умолчанию - из конфигурации)
+        """
+        if self.profile_task and not self.profile_task.done():
+            logger.warning("Профилирование уже выполняется, новый запрос пропущен")
+            return
+        self.profile_task = asyncio.create_task(run_profile(
+            duration or self.config.get('profile_duration', DEFAULT_PROFILE_DURATION),
+            output_dir=os.path.dirname(self.config.get('log_file', LOG_FILE)),
+            interval=self.config.get('profile_interval', DEFAULT_PROFILE_INTERVAL),
+            memory_frames=self.config.get('profile_memory_frames', DEFAULT_PROFILE_MEMORY_FRAMES)
+        ))
+    
+    def schedule_reload(self):
+        """Перезагрузка конфигурации в фоне (обработчик SIGHUP)"""
+        task = asyncio.create_task(self.reload_config())
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+    
+    async def reload_config(self):
+        """
+        Перечитывание файла конфигурации и замена клиента Ollama API для новых запросов
+        
+        Выполняющиеся запросы завершаются прежним клиентом, который закрывается после них.
+        Изменения остальных параметров вступают в силу только после перезапуска.
+        
+        :return: True, если клиент Ollama API заменен
+        """
+        if not self.config_file:
+            logger.warning("Конфигурация передана без файла, перезагружать нечего")
+            return False
+        async with self.reload_lock:
+            try:
+                config = self.read_config()
+                if self.config_transform:
+                    config = self.config_transform(config)
+            except (OSError, json.JSONDecodeError) as e:
+                # Файл мог быть прочитан в момент записи: работаем с прежней конфигурацией
+                CONFIG_RELOADS.inc(result="error")
+                logger.error(f"Не удалось перечитать конфигурацию {self.config_file}: {str(e)}")
+                return False
+            
+            changed = {key for key in set(config) | set(self.config)
+                       if key not in IGNORED_RELOAD_KEYS and config.get(key) != self.config.get(key)}
+            reloadable = sorted(changed & set(RELOADABLE_KEYS))
+            restart_required = sorted(changed - set(RELOADABLE_KEYS))
+            if restart_required:
+                logger.warning(f"Изменения параметров {', '.join(restart_required)} вступят в силу после перезапуска")
+            if not reloadable:
+                CONFIG_RELOADS.inc(result="unchanged")
+                logger.info("Конфигурация перечитана, параметры клиента Ollama не изменились")
+                return False
+            
+            previous_config = dict(self.config)
+            for key in reloadable:
+                if key in config:
+                    self.config[key] = config[key]
+                else:
+                    self.config.pop(key, None)
+            previous_model = self.model
+            self.model = self.config.get('model', DEFAULT_MODEL)
+            self.ollama_host = self.config.get('ollama_host', DEFAULT_OLLAMA_HOST)
+            self.ollama_port = self.config.get('ollama_port', DEFAULT_OLLAMA_PORT)
+            self.ollama_backends = self.config.get('ollama_backends', [])
+            
+            previous = self.ollama_client
+            try:
+                ollama_client = self.create_ollama_client(previous)
+                await ollama_client.open()
+            except Exception as e:
+                CONFIG_RELOADS.inc(result="error")
+                logger.error(f"Не удалось применить новую конфигурацию, работаем с прежней: {str(e)}")
+                self.config = previous_config
+                self.model = previous_model
+                self.ollama_host, self.ollama_port = previous.host, previous.port
+                self.ollama_backends = previous_config.get('ollama_backends', [])
+                return False
+            
+            await self.model_warmer.stop()
+            self.use_ollama_client(ollama_client)
+            if self.warmup:
+                if self.model != previous_model:
+                    await self.model_warmer.warm_up()
+                self.model_warmer.start()
+            
+            # Прежний клиент закрывается, когда завершатся начатые им запросы
+            self.retired_clients.add(previous)
+            task = asyncio.create_task(self.retire_ollama_client(previous))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+            
+            CONFIG_RELOADS.inc(result="applied")
+            logger.info(f"Конфигурация перезагружена, изменены: {', '.join(reloadable)} "
+                        f"(выполняющихся запросов у прежнего клиента: {previous.active_requests})")
+            return True
+    
+    async def retire_ollama_client(self, ollama_client):
+        """
+        Закрытие замененного клиента Ollama API после завершения его запросов
+        
+        :param ollama_client: Объект OllamaClient
+        """
+        await ollama_client.idle.wait()
+        self.retired_clients.discard(ollama_client)
+        await ollama_client.close()
+    
+    async def watch_config(self, interval):
+        """
+        Перезагрузка конфигурации при изменении файла
+        
+        :param interval: Интервал проверки времени изменения файла в секундах
+        """
+        def signature():
+            try:
+                stat = os.stat(self.config_file)
+                return stat.st_mtime_ns, stat.st_size
+            except OSError:
+                return None
+        
+        last = signature()
+        while True:
+            await asyncio.sleep(interval)
+            current = signature()
+            if current is not None and current != last:
+                last = current
+                await self.reload_config()
+    
+    def start_drain(self):
+        """Штатная остановка (обработчик SIGTERM); повторный сигнал останавливает клиент сразу"""
+        if self.drain_task is not None:
+            logger.warning("Повторный сигнал остановки: прерываем выполняющиеся запросы")
+            self.stop_listening()
+            return
+        self.drain_task = asyncio.create_task(self.drain())
+    
+    async def drain(self, timeout=None):
+        """
+        Прекращение приема запросов и ожидание выполняющихся перед остановкой
+        
+        Новые buyer_message и запросы из очереди получают ответ с ошибкой, выполняющиеся
+        генерации дописываются в течение drain_timeout секунд. Затем прослушивание
+        останавливается, а недописанные генерации прерываются при закрытии клиента.
+        
+        :param timeout: Сколько секунд ждать выполняющиеся запросы (по умолчанию - из конфигурации)
+        """
+        timeout = timeout if timeout is not None else self.config.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT)
+        self.draining = True
+        logger.info(f"Штатная остановка: новые запросы не принимаются, ожидание {len(self.active_requests)} "
+                    f"выполняющихся запросов до {timeout} сек")
+        print("Штатная остановка: ожидание выполняющихся запросов...")
+        if self.websocket_handler:
+            self.websocket_handler.scheduler.reject_pending()
+        
+        deadline = time.monotonic() + timeout
+        while self.active_requests:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Время ожидания истекло, прерываем {len(self.active_requests)} запросов")
+                break
+            await asyncio.wait(list(self.active_requests.values()), timeout=remaining)
+        else:
+            logger.info("Все выполняющиеся запросы завершены")
+        self.stop_listening()
+    
+    def stop_listening(self):
+        """Остановка прослушивания: run() переходит к закрытию соединений"""
+        self.listen_stopped = True
+        if self.listen_task:
+            self.listen_task.cancel()
+    
+    async def generate_response(self, message):
+        """
+        Генерация ответа на запрос покупателя и отправка его на сервер
+        
+        :param message: Сообщение buyer_message
+        """
+        prompt = message["content"]
+        message_id = message.get("messageId", -1)  # Получаем messageId из входящего сообщения
+        stream = message.get("stream", False)  # Получаем параметр stream из входящего сообщения
+        conversation_id = get_conversation_id(message)
+        max_tokens = get_max_tokens(message)
+        ollama_client = self.ollama_client
+        model = ollama_client.resolve_model(message.get("model"))
+        
+        rejection = self.get_rejection(message)
+        if rejection:
+            reason, error_msg = rejection
+            REQUESTS_REJECTED.inc(reason=reason)
+            logger.warning(f"Запрос отклонен без генерации (messageId: {message_id}): {error_msg}")
+            if stream:
+                await self.stream_handler.replay_response(error_msg, message_id)
+            else:
+                await self.websocket_handler.send_response(error_msg, message_id)
+            return
+        
+        # Запрос до конца выполняется клиентом, выбранным при его начале, даже если конфигурация перезагружена
+        ollama_client.acquire()
+        try:
+            logger.info(f"Получен запрос от покупателя (messageId: {message_id}, stream: {stream}): {prompt}")
+            print(f"Получен запрос от покупателя (messageId: {message_id}, stream: {stream}): {prompt[:50]}..." if len(prompt) > 50 else prompt)
+            
+            # Обрабатываем запрос в зависимости от режима
+            logger.info(f"Начинаем обработку запроса в режиме {'потоковом' if stream else 'непотоковом'}")
+            print(f"Режим обработки: {'потоковый' if stream else 'обычный'}")
+            
+            if stream:
+                # В потоковом режиме используем обработчик потоковых данных
+                logger.debug("Отправляем потоковый запрос в Ollama (messageId: %s)", message_id)
+                ollama_response = await ollama_client.prepare_stream_request(
+                    prompt=prompt,
+                    stream_handler=self.stream_handler,
+                    message_id=message_id,
+                    conversation_id=conversation_id,
+                    model=model,
+                    max_tokens=max_tokens
+                )
+                logger.info(f"Ответ отправлен покупателю в потоковом режиме (messageId: {message_id})")
+                print(f"Ответ успешно отправлен в потоковом режиме (messageId: {message_id})")
+            else:
+                # В непотоковом режиме получаем полный ответ и отправляем его
+                logger.debug("Отправляем обычный запрос в Ollama (messageId: %s)", message_id)
+                ollama_response = await ollama_client.generate(
+                    prompt=prompt,
+                    stream_mode=False,
+                    message_id=message_id,
+                    conversation_id=conversation_id,
+                    model=model,
+                    max_tokens=max_tokens
+                )
+            
+                # Отправляем ответ обратно на сервер
+                logger.info(f"Отправляем ответ покупателю (messageId: {message_id}): {ollama_response[:100]}...")
+                send_start = time.perf_counter()
+                sent = await self.websocket_handler.send_response(ollama_response, message_id)
+                if sent is True:
+                    WEBSOCKET_SEND_SECONDS.observe(time.perf_counter() - send_start, **self.get_request_labels(message))
+                    print(f"Ответ успешно отправлен (messageId: {message_id})")
+                elif sent:
+                    print(f"Ответ сохранен и будет отправлен после переподключения (messageId: {message_id})")
+                else:
+                    logger.error(f"Не удалось отправить ответ покупателю (messageId: {message_id})")
+        finally:
+            ollama_client.release()
+    
+    async def cancel_request(self, message_id):
+        """
+        Отмена запроса по messageId
+        
+        Отмена задачи закрывает HTTP-поток к Ollama, после чего Ollama прекращает
+        генерацию. Покупателю отправляется завершающий фрейм с признаком отмены.
+        
+        :param message_id: ID отменяемого сообщения
+        :return: True, если запрос был найден
+        """
+        task = self.active_requests.get(message_id)
+        if task:
+            logger.info(f"Получен запрос на отмену генерации (messageId: {message_id})")
+            task.cancel()
+            return True
+        
+        # Запрос мог еще ожидать свободного слота
+        if self.websocket_handler.cancel_queued(message_id):
+            logger.info(f"Отменен запрос из очереди (messageId: {message_id})")
+            await self.websocket_handler.send_stream_finished(message_id, cancelled=True)
+            return True
+        
+        logger.warning(f"Запрос на отмену: активный запрос не найден (messageId: {message_id})")
+        return False
+    
+    async def cancel_all_requests(self):
+        """Отмена всех выполняющихся и ожидающих запросов"""
+        tasks = list(self.active_requests.values())
+        if tasks or self.websocket_handler.queued_requests:
+            logger.warning(f"Прерываем {len(tasks)} выполняющихся и {self.websocket_handler.queued_requests} ожидающих запросов")
+        self.websocket_handler.cancel_queued()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+    
     def setup_auth(self, force_token=None, force_model=None, force_ollama_host=None, force_ollama_port=None):
         """
         Настройка аутентификации и параметров
@@ -245,16 +840,113 @@ class OllamaProxyClient:
         print("\nТекущая конфигурация:")
         print(f"Токен аутентификации: {'*' * 8}{self.token[-4:] if self.token else 'Не установлен'}")
         print(f"Модель Ollama: {self.model}")
+        if self.config.get('allowed_models'):
+            print(f"Модели по запросу покупателя: {', '.join(self.config['allowed_models'])}")
         print(f"Сервер: wss://{self.host}:{self.port}/{self.path}")
-        print(f"Сервер Ollama API: http://{self.ollama_host}:{self.ollama_port}")
+        if self.ollama_backends:
+            print(f"Серверы Ollama API: {', '.join(b.name for b in parse_backends(self.ollama_backends, self.ollama_host, self.ollama_port))}")
+        else:
+            print(f"Сервер Ollama API: http://{self.ollama_host}:{self.ollama_port}")
+        print(f"Режим обработки запросов: {self.dispatch_mode} (лимит параллельных запросов: {self.max_concurrent_requests})")
         print()
             
+    async def autotune(self):
+        """
+        Подбор параллельности, размера контекста и таймаутов замерами на Ollama
+        
+        Лучшие найденные значения записываются в config.json.
+        
+        :return: Словарь записанных настроек или None
+        """
+        self.setup_components()
+        tuner = CapacityTuner(
+            self.ollama_client,
+            concurrency_levels=self.config.get('autotune_concurrency_levels', DEFAULT_AUTOTUNE_CONCURRENCY_LEVELS),
+            context_sizes=self.config.get('autotune_context_sizes', DEFAULT_AUTOTUNE_CONTEXT_SIZES),
+            requests_per_level=self.config.get('autotune_requests_per_level', DEFAULT_AUTOTUNE_REQUESTS_PER_LEVEL),
+            prompt_tokens=self.config.get('autotune_prompt_tokens', DEFAULT_AUTOTUNE_PROMPT_TOKENS),
+            num_predict=self.config.get('autotune_num_predict', DEFAULT_AUTOTUNE_NUM_PREDICT),
+            p95_target=self.config.get('autotune_p95_target', DEFAULT_AUTOTUNE_P95_TARGET)
+        )
+        print(f"Автонастройка на {self.ollama_client.get_api_url()} (модель: {self.model})")
+        try:
+            result = await tuner.run()
+        finally:
+            if self.ollama_client.response_cache:
+                await self.ollama_client.response_cache.stop()
+            await self.ollama_client.close()
+        
+        if not result:
+            print("Автонастройка не нашла подходящих параметров: все варианты превысили p95 или завершились ошибками")
+            return None
+        
+        settings = {key: result[key] for key in ("max_concurrent_requests", "num_ctx", "ollama_request_timeout")}
+        self.config.update(settings)
+        # num_ctx из ollama_options имел бы приоритет над подобранным значением
+        options = self.config.get('ollama_options') or {}
+        if 'num_ctx' in options:
+            options['num_ctx'] = settings['num_ctx']
+        self.config['autotune'] = {
+            "throughput": result["autotune_throughput"],
+            "p95": result["autotune_p95"],
+            "timestamp": int(time.time())
+        }
+        self.save_config()
+        
+        logger.info(f"Автонастройка завершена: {settings}")
+        print(f"Записано в {CONFIG_FILE}: {json.dumps(settings)} "
+              f"({result['autotune_throughput']} токенов/сек, p95 {result['autotune_p95']} сек)")
+        return settings
+    
     async def run(self):
         """Запуск клиента"""
         try:
             # Инициализируем компоненты
             self.setup_components()
             
+            # Открываем общий пул соединений с Ollama на время работы клиента
+            await self.ollama_client.open()
+            if self.ollama_client.response_cache:
+                self.ollama_client.response_cache.start()
+            
+            # Загружаем модель до подключения, чтобы первый покупатель не ждал холодной загрузки
+            if self.warmup:
+                print(f"Загрузка модели {self.model}...")
+                if await self.model_warmer.warm_up():
+                    print(f"Модель {self.model} загружена")
+                else:
+                    print(f"Не удалось заранее загрузить модель {self.model}, она будет загружена при первом запросе")
+                self.model_warmer.start()
+            
+            # Трассировка этапов запросов и профилирование по запросу (kill -USR1 <pid>)
+            if self.trace_file:
+                tracer.open(self.trace_file)
+            loop = asyncio.get_running_loop()
+            if hasattr(signal, "SIGUSR1"):
+                loop.add_signal_handler(signal.SIGUSR1, self.start_profile)
+            if self.profile_duration:
+                self.start_profile(self.profile_duration)
+            
+            # Перезагрузка конфигурации (kill -HUP <pid> или изменение файла) и штатная остановка (kill <pid>)
+            if hasattr(signal, "SIGHUP"):
+                loop.add_signal_handler(signal.SIGHUP, self.schedule_reload)
+            try:
+                loop.add_signal_handler(signal.SIGTERM, self.start_drain)
+            except NotImplementedError:
+                # В Windows обработчики сигналов в цикле событий недоступны
+                pass
+            watch_interval = self.config.get('config_watch_interval', DEFAULT_CONFIG_WATCH_INTERVAL)
+            if self.config_file and watch_interval:
+                task = asyncio.create_task(self.watch_config(watch_interval))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+            
+            # Запускаем локальный сервер метрик
+            if self.metrics_port:
+                metrics.add_collector(self.collect_metrics)
+                self.metrics_server = MetricsServer(self.metrics_host, self.metrics_port)
+                await self.metrics_server.start()
+            
             # Подключаемся к серверу
             logger.info("Попытка подключения к серверу...")
             print("Попытка подключения к серверу...")
@@ -263,8 +955,15 @@ class OllamaProxyClient:
             logger.info("Успешно подключено к серверу WebSocket")
             print("Успешно подключено к серверу WebSocket")
             
-            # Запускаем прослушивание сообщений
-            await self.websocket_handler.listen()
+            # Запускаем прослушивание сообщений (его останавливает штатная остановка)
+            self.listen_task = asyncio.create_task(self.websocket_handler.listen())
+            try:
+                await self.listen_task
+            except asyncio.CancelledError:
+                # Отмена самого run() (например, Ctrl+C) передается дальше
+                if not self.listen_stopped:
+                    raise
+                logger.info("Прослушивание остановлено, завершение работы")
                 
         except websockets.InvalidURI as e:
             error_msg = f"Ошибка: Неверный формат URI для WebSocket: {str(e)}"
@@ -288,9 +987,33 @@ class OllamaProxyClient:
             # Корректное закрытие соединений
             try:
                 if self.websocket_handler:
+                    # Прерываем генерации, ответы на которые уже некуда отправить
+                    await self.cancel_all_requests()
+                    await self.websocket_handler.scheduler.stop()
                     await self.websocket_handler.disconnect()
+                if self.model_warmer:
+                    await self.model_warmer.stop()
+                    if self.config.get('model_unload_on_exit', DEFAULT_MODEL_UNLOAD_ON_EXIT):
+                        await self.model_warmer.unload()
+                for task in list(self.background_tasks):
+                    task.cancel()
+                await asyncio.gather(*self.background_tasks, return_exceptions=True)
+                if self.drain_task:
+                    self.drain_task.cancel()
+                    await asyncio.gather(self.drain_task, return_exceptions=True)
+                for ollama_client in list(self.retired_clients):
+                    await ollama_client.close()
                 if self.ollama_client:
+                    if self.ollama_client.response_cache:
+                        await self.ollama_client.response_cache.stop()
                     await self.ollama_client.close()
+                if self.metrics_server:
+                    await self.metrics_server.stop()
+                if self.profile_task:
+                    # Прерванное окно все равно записывается
+                    self.profile_task.cancel()
+                    await asyncio.gather(self.profile_task, return_exceptions=True)
+                tracer.close()
             except Exception as e:
                 logger.error(f"Ошибка при закрытии соединений: {str(e)}")
 
@@ -308,6 +1031,15 @@ def main():
     parser.add_argument('--ollama-host', type=str, help='Хост Ollama API')
     parser.add_argument('--ollama-port', type=int, help='Порт Ollama API')
     parser.add_argument('--show-config', action='store_true', help='Показать текущую конфигурацию')
+    parser.add_argument('--max-concurrent', type=int, help='Максимальное число одновременно обрабатываемых запросов')
+    parser.add_argument('--sequential', action='store_true', help='Обрабатывать запросы строго по одному в цикле прослушивания')
+    parser.add_argument('--metrics-port', type=int, help='Порт локального сервера метрик Prometheus (0 - отключить)')
+    parser.add_argument('--no-warmup', action='store_true', help='Не загружать модель до подключения к серверу')
+    parser.add_argument('--autotune', action='store_true', help='Подобрать параллельность и размер контекста замерами и записать их в конфигурацию')
+    parser.add_argument('--workers', type=int, help='Количество рабочих процессов со своими соединениями (по умолчанию 1)')
+    parser.add_argument('--trace', type=str, metavar='FILE', help='Записывать этапы обработки запросов в файл JSONL')
+    parser.add_argument('--profile', type=float, nargs='?', const=DEFAULT_PROFILE_DURATION, metavar='SECONDS',
+                        help=f'Профилировать процессор и память указанное число секунд после запуска (по умолчанию {DEFAULT_PROFILE_DURATION:.0f})')
     
     args = parser.parse_args()
     
@@ -316,13 +1048,36 @@ def main():
         port=args.port,
         host=args.host,
         path=args.path,
-        debug=args.test or args.debug  # Включаем отладку если указан --test или --debug
+        debug=args.test or args.debug,  # Включаем отладку если указан --test или --debug
+        max_concurrent_requests=args.max_concurrent,
+        dispatch_mode=DISPATCH_MODE_INLINE if args.sequential else None,
+        metrics_port=args.metrics_port,
+        warmup=False if args.no_warmup else None,
+        trace_file=args.trace,
+        profile_duration=args.profile
     )
     
     # Показать конфигурацию, если запрошено
     if args.show_config:
         client.show_config()
         return
+    
+    # Автонастройка по замерам на Ollama
+    if args.autotune:
+        if args.model:
+            client.model = args.model
+        if args.ollama_host:
+            client.ollama_host = args.ollama_host
+        if args.ollama_port:
+            client.ollama_port = args.ollama_port
+        try:
+            asyncio.run(client.autotune())
+        except KeyboardInterrupt:
+            logger.info("Автонастройка прервана пользователем (Ctrl+C)")
+        finally:
+            stop_logging()
+            logging.shutdown()
+        return
 
     # Настройка аутентификации и параметров
     client.setup_auth(
@@ -332,6 +1087,38 @@ def main():
         force_ollama_port=args.ollama_port if args.setup or args.ollama_port else None
     )
     
+    # Несколько рабочих процессов под управлением супервизора
+    workers = args.workers or client.config.get('workers', DEFAULT_WORKERS)
+    if workers > 1:
+        client_options = {
+            "port": args.port,
+            "host": args.host,
+            "path": args.path,
+            "debug": args.test or args.debug,
+            # Общий лимит параллельных запросов делится между процессами
+            "max_concurrent_requests": math.ceil(client.max_concurrent_requests / workers),
+            "dispatch_mode": client.dispatch_mode,
+            "metrics_port": 0,
+            "warmup": client.warmup,
+            "profile_duration": args.profile,
+            "config_file": client.config_file
+        }
+        config = dict(client.config)
+        if client.trace_file:
+            config['trace_file'] = client.trace_file
+        supervisor = Supervisor(config, workers, client_options,
+                                metrics_host=client.metrics_host, metrics_port=client.metrics_port,
+                                config_file=client.config_file)
+        try:
+            asyncio.run(supervisor.run())
+        except KeyboardInterrupt:
+            logger.info("Программа остановлена пользователем (Ctrl+C)")
+        finally:
+            logger.info("Завершение работы приложения")
+            stop_logging()
+            logging.shutdown()
+        return
+    
     # Инициализация компонентов
     client.setup_components()
     
@@ -342,7 +1129,8 @@ def main():
         logger.info("Программа остановлена пользователем (Ctrl+C)")
     finally:
         logger.info("Завершение работы приложения")
-        # Закрываем все обработчики логов перед выходом
+        # Дописываем очередь журнала и закрываем все обработчики логов перед выходом
+        stop_logging()
         logging.shutdown()
 
 if __name__ == "__main__":
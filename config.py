@@ -1,11 +1,16 @@
 import os
+import queue
+import atexit
 import logging
+import logging.handlers
 
 # Директории и файлы конфигурации
 CONFIG_DIR = os.path.expanduser("~/.config/ollama_proxy")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.json")
 LOGS_DIR = os.path.join(CONFIG_DIR, "logs")
 LOG_FILE = os.path.join(LOGS_DIR, "client.log")
+CACHE_DIR = os.path.join(CONFIG_DIR, "cache")
+RESPONSE_CACHE_FILE = os.path.join(CACHE_DIR, "responses.json")
 
 # Настройки WebSocket подключения
 DEFAULT_HOST = "bober.app"
@@ -15,37 +20,254 @@ DEFAULT_PATH = "/auth-proxy"
 # Таймауты и настройки
 RECONNECT_TIMEOUT = 5  # Таймаут для переподключения в секундах
 
+# Настройки обработки запросов покупателей
+DISPATCH_MODE_CONCURRENT = "concurrent"  # Каждый buyer_message обрабатывается в отдельной задаче
+DISPATCH_MODE_INLINE = "inline"          # Запросы обрабатываются по одному прямо в цикле прослушивания
+DEFAULT_DISPATCH_MODE = DISPATCH_MODE_CONCURRENT
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4      # Глобальный лимит одновременно выполняемых запросов
+DEFAULT_DISCONNECT_ABORT_GRACE = 30      # Через сколько секунд без соединения прерывать генерации
+
+# Настройки планировщика запросов
+DEFAULT_SCHEDULER_POLICY = "fifo"        # fifo, fair, priority или shortest_prompt
+DEFAULT_SCHEDULER_MAX_WAIT = 60          # Запросы, ожидающие дольше (сек), обрабатываются первыми (0 - отключено)
+DEFAULT_SCHEDULER_MODEL_AFFINITY = True  # Выдавать первыми запросы к уже загруженным моделям
+DEFAULT_BUYER_RATE_LIMIT = 0             # Запросов в секунду на одного покупателя (0 - без ограничения)
+DEFAULT_BUYER_RATE_BURST = 5             # Допустимая пачка запросов покупателя
+
+# Адаптивный лимит параллельных запросов (AIMD)
+DEFAULT_ADAPTIVE_CONCURRENCY = False     # Подстраивать лимит по наблюдаемой задержке
+DEFAULT_ADAPTIVE_MIN_CONCURRENCY = 1     # Минимальный лимит
+DEFAULT_ADAPTIVE_MAX_CONCURRENCY = 16    # Максимальный лимит
+DEFAULT_ADAPTIVE_LATENCY_TARGET = 5.0    # Целевое время до первого токена в секундах
+DEFAULT_ADAPTIVE_COOLDOWN = 5.0          # Минимальный интервал между уменьшениями лимита в секундах
+
+# Автонастройка (--autotune)
+DEFAULT_AUTOTUNE_CONCURRENCY_LEVELS = [1, 2, 4, 8]
+DEFAULT_AUTOTUNE_CONTEXT_SIZES = [2048, 4096, 8192]
+DEFAULT_AUTOTUNE_REQUESTS_PER_LEVEL = 8  # Запросов на каждый уровень параллельности
+DEFAULT_AUTOTUNE_PROMPT_TOKENS = 256     # Примерный размер синтетического запроса в токенах
+DEFAULT_AUTOTUNE_NUM_PREDICT = 128       # Токенов ответа в синтетических запросах
+DEFAULT_AUTOTUNE_P95_TARGET = 30.0       # Допустимая p95 задержка запроса в секундах
+
 # Настройки Ollama
 DEFAULT_MODEL = "llama2"
+DEFAULT_ALLOWED_MODELS = []              # Модели, которые покупатель может указать в поле model (кроме model)
 DEFAULT_OLLAMA_HOST = "localhost"
 DEFAULT_OLLAMA_PORT = 11434
 DEFAULT_STREAM_MODE = True
 
+# Настройки пула HTTP-соединений к Ollama
+DEFAULT_OLLAMA_MAX_CONNECTIONS = 10      # Максимальное число соединений в пуле
+DEFAULT_OLLAMA_KEEPALIVE_EXPIRY = 30.0   # Время жизни простаивающего соединения в секундах
+DEFAULT_OLLAMA_HTTP2 = False             # Использовать HTTP/2 (требуется пакет h2)
+
+# Настройки маршрутизации между несколькими экземплярами Ollama
+ROUTING_LEAST_IN_FLIGHT = "least_in_flight"  # Бэкенд с наименьшим числом выполняющихся запросов
+ROUTING_MODEL_LOADED = "model_loaded"        # Предпочитать бэкенды, на которых модель уже загружена
+DEFAULT_OLLAMA_ROUTING = ROUTING_MODEL_LOADED
+DEFAULT_HEALTH_CHECK_INTERVAL = 10       # Интервал проверки бэкендов в секундах
+DEFAULT_HEALTH_FAILURE_THRESHOLD = 2     # Неудачных проверок подряд до исключения бэкенда
+
+# Параметры генерации и таймауты запросов к Ollama
+DEFAULT_NUM_CTX = 4096                   # Размер окна контекста модели в токенах
+DEFAULT_NUM_PREDICT = 2048               # Максимальное количество токенов ответа
+DEFAULT_CONTEXT_SIZING = True           # Подбирать num_ctx и num_predict под каждый запрос
+DEFAULT_NUM_CTX_BUCKETS = None           # Допустимые окна контекста (None - только num_ctx, без перезагрузок модели)
+DEFAULT_MAX_TOKENS_LIMIT = None          # Наибольший max_tokens, который может запросить покупатель (None - num_predict)
+DEFAULT_OLLAMA_REQUEST_TIMEOUT = 180.0   # Таймаут обычного запроса в секундах
+DEFAULT_OLLAMA_STREAM_TIMEOUT = 30.0     # Таймаут ожидания очередного фрагмента потока в секундах
+
+# Удержание модели в памяти Ollama
+DEFAULT_OLLAMA_KEEP_ALIVE = "30m"        # Параметр keep_alive запросов к Ollama (-1 - бессрочно)
+DEFAULT_MODEL_WARMUP = True              # Загружать модель до подключения к серверу
+DEFAULT_MODEL_WATCH_INTERVAL = 60        # Интервал проверки /api/ps в секундах (0 - отключено)
+DEFAULT_MODEL_UNLOAD_ON_EXIT = False     # Выгружать модель при завершении работы клиента
+COLD_LOAD_WARNING_SECONDS = 1.0          # Начиная с какого load_duration запрос считается холодным
+MODEL_SWAP_MIN_LOAD_SECONDS = 0.05       # Начиная с какого load_duration считается, что Ollama загружала модель
+
+# Беседы с переиспользованием контекста Ollama
+DEFAULT_SESSIONS = True                  # Переиспользовать context для сообщений с conversationId
+DEFAULT_SESSION_MAX_SESSIONS = 1000      # Максимальное число хранимых бесед
+DEFAULT_SESSION_MAX_TOKENS = 2000000     # Максимальный суммарный размер контекстов в токенах
+DEFAULT_SESSION_TTL = 3600               # Время жизни беседы без обращений в секундах
+
+# Несколько рабочих процессов (--workers)
+DEFAULT_WORKERS = 1                      # Количество рабочих процессов (1 - без супервизора)
+DEFAULT_WORKER_RESTART_DELAY = 1.0       # Начальная задержка перезапуска упавшего процесса в секундах
+DEFAULT_WORKER_RESTART_MAX_DELAY = 60.0  # Максимальная задержка перезапуска в секундах
+DEFAULT_WORKER_STABLE_SECONDS = 60.0     # Сколько секунд процесс должен проработать, чтобы задержка сбросилась
+DEFAULT_WORKER_METRICS_INTERVAL = 5.0    # Интервал передачи метрик рабочего процесса супервизору в секундах
+
+# Переподключение и возобновление ответов
+DEFAULT_RECONNECT_BASE_DELAY = 1.0       # Начальная задержка переподключения в секундах (растет вдвое с каждой попыткой)
+DEFAULT_RECONNECT_MAX_DELAY = 60.0       # Максимальная задержка переподключения в секундах
+DEFAULT_STREAM_RESUME = True             # Запрашивать у сервера нумерацию фреймов и повторную отправку после переподключения
+DEFAULT_STREAM_REPLAY_FRAMES = 512       # Максимальное число хранимых фреймов одного ответа
+DEFAULT_STREAM_REPLAY_TTL = 30.0         # Сколько секунд хранить фреймы ответа после последнего фрейма
+
+# Проверка живости соединения с сервером
+DEFAULT_HEARTBEAT_INTERVAL = 5.0         # Интервал отправки ping в секундах (0 - проверка библиотеки websockets)
+DEFAULT_HEARTBEAT_TIMEOUT = 5.0          # Сколько секунд ждать pong, прежде чем считать соединение мертвым
+DEFAULT_WS_SEND_TIMEOUT = 10.0           # Сколько секунд может длиться отправка одного фрейма (0 - без ограничения)
+DEFAULT_RTT_HISTORY = 120                # Сколько последних измерений RTT хранить
+
+# Перезагрузка конфигурации и штатная остановка
+DEFAULT_CONFIG_WATCH_INTERVAL = 5.0      # Интервал проверки изменений config.json в секундах (0 - только по SIGHUP)
+DEFAULT_DRAIN_TIMEOUT = 60.0             # Сколько секунд после SIGTERM ждать завершения выполняющихся запросов
+
+# Трассировка запросов и профилирование
+DEFAULT_TRACE_FILE = None                # Файл трассировки этапов запросов JSONL (None - отключена)
+DEFAULT_PROFILE_DURATION = 30.0          # Длительность окна профилирования в секундах (--profile, SIGUSR1)
+DEFAULT_PROFILE_INTERVAL = 0.005         # Интервал снятия стека сэмплирующим профилировщиком в секундах
+DEFAULT_PROFILE_MEMORY_FRAMES = 10       # Глубина стека, запоминаемого tracemalloc для выделения памяти
+
+# Формат сообщений и сжатие WebSocket
+DEFAULT_WIRE_FORMAT = "json"             # Формат сообщений ("json" или "msgpack", если сервер его подтвердит)
+DEFAULT_WS_COMPRESSION = "tuned"         # Сжатие permessage-deflate ("none", "default", "tuned")
+DEFAULT_WS_COMPRESSION_LEVEL = None      # Уровень сжатия zlib 1-9 (None - из набора параметров)
+DEFAULT_WS_COMPRESSION_WINDOW_BITS = None  # Размер окна сжатия 9-15 бит (None - из набора параметров)
+
+# Настройки объединения фрагментов потокового ответа
+DEFAULT_STREAM_COALESCE_MS = 0           # Временное окно накопления токенов в мс (0 - отключено)
+DEFAULT_STREAM_COALESCE_BYTES = 512      # Порог размера буфера, при котором фрагмент отправляется сразу
+DEFAULT_STREAM_MAX_RESPONSE_CHARS = 1000000  # Максимальный размер сохраняемого полного ответа (0 - без ограничения)
+DEFAULT_STREAM_MAX_LINE_BYTES = 16 * 2**20  # Максимальная длина строки NDJSON от Ollama в байтах (0 - без ограничения)
+DEFAULT_SINGLE_FLIGHT = True             # Присоединять одинаковые запросы к уже выполняющейся генерации
+
+# Очередь между чтением потока Ollama и отправкой в WebSocket
+DEFAULT_STREAM_QUEUE_HIGH_WATERMARK = 256   # Фрагментов в очереди, при которых чтение Ollama приостанавливается
+DEFAULT_STREAM_QUEUE_LOW_WATERMARK = 64     # Фрагментов в очереди, при которых чтение продолжается
+DEFAULT_STREAM_STALL_TIMEOUT = 15.0         # Сколько секунд отправка может не продвигаться до прерывания генерации
+
+# Настройки кэша ответов
+DEFAULT_RESPONSE_CACHE = False           # Кэширование ответов на точно совпадающие запросы
+DEFAULT_RESPONSE_CACHE_MAX_ENTRIES = 1000
+DEFAULT_RESPONSE_CACHE_TTL = 86400       # Время жизни записи в секундах
+DEFAULT_RESPONSE_CACHE_ALLOW_SAMPLED = False  # Кэшировать ответы со случайной выборкой токенов
+
+# Настройки локального сервера метрик
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 0                 # Порт сервера метрик Prometheus (0 - отключен)
+
+# Настройки журнала
+LOG_MODE_QUEUE = "queue"                 # Запись в файл выполняется в фоновом потоке
+LOG_MODE_SYNC = "sync"                   # Запись в файл прямо в вызывающем потоке
+DEFAULT_LOG_MODE = LOG_MODE_QUEUE
+DEFAULT_LOG_LEVEL = "DEBUG"              # Уровень записей в файле журнала
+LOG_ROTATION_SIZE = "size"
+LOG_ROTATION_TIME = "time"
+LOG_ROTATION_NONE = "none"
+DEFAULT_LOG_ROTATION = LOG_ROTATION_SIZE
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024 # Размер файла журнала для ротации по размеру
+DEFAULT_LOG_BACKUP_COUNT = 5             # Количество хранимых архивных файлов журнала
+DEFAULT_LOG_ROTATION_WHEN = "midnight"   # Момент ротации по времени (см. TimedRotatingFileHandler)
+
+# Фоновый поток записи журнала в режиме очереди
+_queue_listener = None
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Обработчик очереди, откладывающий форматирование сообщения до фонового потока
+    
+    Стандартный QueueHandler форматирует запись в вызывающем потоке. Журнал
+    используется в пределах одного процесса, а аргументы сообщений - строки и числа,
+    поэтому запись можно передать в очередь как есть.
+    """
+    
+    def prepare(self, record):
+        return record
+
+def _create_file_handler(log_file, rotation, max_bytes, backup_count, rotation_when):
+    """Создание обработчика для файла журнала с учетом ротации"""
+    if rotation == LOG_ROTATION_SIZE:
+        return logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+    if rotation == LOG_ROTATION_TIME:
+        return logging.handlers.TimedRotatingFileHandler(
+            log_file, when=rotation_when, backupCount=backup_count, encoding="utf-8"
+        )
+    return logging.FileHandler(log_file, encoding="utf-8")
+
+def _update_logger_level(logger):
+    """
+    Установка уровня логгера по самому подробному из обработчиков
+    
+    Так вызовы logger.debug() при отключенном уровне DEBUG отбрасываются
+    сразу, без создания записи и форматирования сообщения.
+    """
+    levels = [handler.level for handler in logger.handlers if handler.level]
+    logger.setLevel(min(levels) if levels else logging.WARNING)
+
+def stop_logging():
+    """Остановка фонового потока записи журнала с записью оставшихся сообщений"""
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        for handler in _queue_listener.handlers:
+            handler.close()
+        _queue_listener = None
+
+atexit.register(stop_logging)
+
 # Настройка логирования
-def setup_logging():
-    """Настройка системы логирования"""
-    os.makedirs(LOGS_DIR, exist_ok=True)
+def setup_logging(mode=DEFAULT_LOG_MODE, file_level=DEFAULT_LOG_LEVEL, rotation=DEFAULT_LOG_ROTATION,
+                  max_bytes=DEFAULT_LOG_MAX_BYTES, backup_count=DEFAULT_LOG_BACKUP_COUNT,
+                  rotation_when=DEFAULT_LOG_ROTATION_WHEN, log_file=LOG_FILE):
+    """
+    Настройка системы логирования
+    
+    Повторный вызов заменяет обработчики, сохраняя уровень консольного вывода.
+    
+    :param mode: Режим записи в файл ("queue" - в фоновом потоке, "sync" - синхронно)
+    :param file_level: Уровень записей в файле журнала
+    :param rotation: Ротация файла журнала ("size", "time" или "none")
+    :param max_bytes: Размер файла для ротации по размеру
+    :param backup_count: Количество хранимых архивных файлов
+    :param rotation_when: Момент ротации по времени
+    :param log_file: Путь к файлу журнала
+    """
+    global _queue_listener
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
     
     # Настройка форматирования логов
     log_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     
     # Создаем логгер
     logger = logging.getLogger("ollama_proxy")
-    logger.setLevel(logging.DEBUG)
+    
+    # Убираем обработчики предыдущей настройки
+    console_level = logging.INFO
+    stop_logging()
+    for handler in logger.handlers[:]:
+        if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+            console_level = handler.level
+        logger.removeHandler(handler)
+        handler.close()
     
     # Обработчик для файла
-    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler = _create_file_handler(log_file, rotation, max_bytes, backup_count, rotation_when)
     file_handler.setFormatter(log_format)
-    file_handler.setLevel(logging.DEBUG)
+    file_handler.setLevel(file_level)
     
     # Обработчик для консоли
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(log_format)
-    console_handler.setLevel(logging.INFO)
+    console_handler.setLevel(console_level)
     
     # Добавляем обработчики к логгеру
-    logger.addHandler(file_handler)
+    if mode == LOG_MODE_QUEUE:
+        # Запись на диск выполняется фоновым потоком, цикл событий только кладет запись в очередь
+        log_queue = queue.SimpleQueue()
+        queue_handler = DeferredQueueHandler(log_queue)
+        queue_handler.setLevel(file_level)
+        _queue_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+        _queue_listener.start()
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(file_handler)
     logger.addHandler(console_handler)
+    _update_logger_level(logger)
     
     return logger
 
@@ -57,7 +279,29 @@ def set_console_log_level(level):
     for handler in logger.handlers:
         if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
             handler.setLevel(level)
-            logger.info(f"Уровень логирования консоли изменен на {logging.getLevelName(level)}")
+            _update_logger_level(logger)
+            logger.info("Уровень логирования консоли изменен на %s", logging.getLevelName(level))
+
+def setup_worker_logging(log_queue, prefix):
+    """
+    Передача журнала рабочего процесса супервизору
+    
+    Записи форматируются в рабочем процессе (с префиксом процесса) и через
+    межпроцессную очередь попадают в обработчики супервизора, который пишет
+    общий файл журнала и консоль.
+    
+    :param log_queue: Очередь multiprocessing
+    :param prefix: Префикс сообщений рабочего процесса
+    """
+    level = logger.level
+    stop_logging()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.setFormatter(logging.Formatter(f"{prefix}%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
 
 def debug_json_error(text, error):
     """Функция для отладки ошибок при разборе JSON"""
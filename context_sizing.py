@@ -0,0 +1,182 @@
+"""
+Подбор окна контекста и длины ответа для каждого запроса
+
+Размер запроса в токенах оценивается локально по числу символов. Отношение
+символов к токену для каждой модели уточняется по prompt_eval_count из
+предыдущих ответов Ollama. По оценке выбирается наименьшее окно (num_ctx)
+из заданного набора, в котором помещаются запрос и ответ. Покупатель может
+ограничить длину ответа полем max_tokens, но не больше, чем разрешает
+владелец. Запрос, который не помещается даже в наибольшее окно, отклоняется
+до генерации.
+"""
+import math
+from config import logger
+
+# Поля buyer_message, в которых может передаваться ограничение длины ответа
+MAX_TOKENS_FIELDS = ("max_tokens", "maxTokens")
+
+# Символов на токен до первой калибровки: с запасом для кириллицы, которая делится на токены мельче латиницы
+DEFAULT_CHARS_PER_TOKEN = 3.0
+MIN_CHARS_PER_TOKEN = 1.0
+MAX_CHARS_PER_TOKEN = 6.0
+
+# Запас к оценке числа токенов запроса
+ESTIMATE_MARGIN = 1.1
+
+# Токены шаблона модели, которые Ollama добавляет к запросу
+PROMPT_OVERHEAD_TOKENS = 16
+
+# Запросы короче этого числа символов не калибруют оценку: в них велика доля шаблона
+CALIBRATION_MIN_CHARS = 200
+
+# Вес нового измерения: оценка быстро уменьшает отношение символов к токену и медленно увеличивает,
+# потому что заниженное число токенов опаснее завышенного (prompt_eval_count бывает меньше
+# из-за кэша префикса в Ollama)
+CALIBRATION_WEIGHT_DOWN = 0.3
+CALIBRATION_WEIGHT_UP = 0.05
+
+# Сколько токенов ответа должно помещаться в окно, иначе запрос отклоняется
+MIN_RESPONSE_TOKENS = 32
+
+
+def get_max_tokens(message):
+    """
+    Получение ограничения длины ответа из сообщения покупателя
+
+    :param message: Сообщение buyer_message
+    :return: Положительное целое число или None, если ограничение не задано или некорректно
+    """
+    for field in MAX_TOKENS_FIELDS:
+        value = message.get(field)
+        if value is None:
+            continue
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None
+        return value if value > 0 else None
+    return None
+
+
+class TokenEstimator:
+    """Оценка числа токенов запроса по числу символов с калибровкой по ответам Ollama"""
+
+    def __init__(self, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+        """
+        :param chars_per_token: Отношение символов к токену до первой калибровки
+        """
+        self.default_ratio = chars_per_token
+        self.ratios = {}
+        self.samples = {}
+
+    def ratio(self, model):
+        """Текущее отношение символов к токену для модели"""
+        return self.ratios.get(model, self.default_ratio)
+
+    def estimate(self, text, model):
+        """
+        Оценка числа токенов запроса
+
+        :param text: Текст запроса
+        :param model: Имя модели
+        :return: Число токенов с запасом
+        """
+        if not text:
+            return PROMPT_OVERHEAD_TOKENS
+        return math.ceil(len(text) / self.ratio(model) * ESTIMATE_MARGIN) + PROMPT_OVERHEAD_TOKENS
+
+    def observe(self, text, prompt_eval_count, model):
+        """
+        Уточнение отношения символов к токену по фактическому числу токенов запроса
+
+        :param text: Текст запроса, отправленный в Ollama без сохраненного контекста
+        :param prompt_eval_count: Число токенов запроса из ответа Ollama
+        :param model: Имя модели
+        """
+        if not text or len(text) < CALIBRATION_MIN_CHARS or not prompt_eval_count:
+            return
+        measured = len(text) / max(1, prompt_eval_count - PROMPT_OVERHEAD_TOKENS)
+        measured = min(MAX_CHARS_PER_TOKEN, max(MIN_CHARS_PER_TOKEN, measured))
+        current = self.ratio(model)
+        weight = CALIBRATION_WEIGHT_DOWN if measured < current else CALIBRATION_WEIGHT_UP
+        if model not in self.ratios:
+            # Первое измерение сразу заменяет значение по умолчанию, если оно меньше
+            current = min(current, measured)
+        self.ratios[model] = current + (measured - current) * weight
+        self.samples[model] = self.samples.get(model, 0) + 1
+        logger.debug("Калибровка оценки токенов %s: %.2f символа на токен (измерено %.2f)",
+                     model, self.ratios[model], measured)
+
+
+class ContextSizer:
+    """Выбор num_ctx и num_predict для запроса по оценке его размера"""
+
+    def __init__(self, buckets, num_predict, max_tokens_limit=None, estimator=None):
+        """
+        :param buckets: Допустимые размеры окна контекста в токенах
+        :param num_predict: Длина ответа, если покупатель ее не ограничил
+        :param max_tokens_limit: Наибольшая длина ответа, которую может запросить покупатель (None - num_predict)
+        :param estimator: Объект TokenEstimator (по умолчанию создается новый)
+        """
+        self.buckets = sorted({int(bucket) for bucket in buckets if int(bucket) > 0})
+        if not self.buckets:
+            raise ValueError("Не задано ни одного размера окна контекста")
+        self.num_predict = num_predict
+        self.max_tokens_limit = max_tokens_limit or num_predict
+        self.estimator = estimator or TokenEstimator()
+        # Окно последнего запроса к каждой модели
+        self.current = {}
+
+    @property
+    def largest(self):
+        """Наибольшее окно контекста"""
+        return self.buckets[-1]
+
+    def resolve_num_predict(self, max_tokens=None):
+        """
+        Длина ответа с учетом ограничения покупателя и политики владельца
+
+        :param max_tokens: Ограничение из сообщения покупателя (None - не задано)
+        :return: Число токенов ответа
+        """
+        if max_tokens is None:
+            return min(self.num_predict, self.max_tokens_limit)
+        return max(1, min(max_tokens, self.max_tokens_limit))
+
+    def fits(self, prompt, model):
+        """
+        Проверка, помещается ли запрос в наибольшее окно контекста
+
+        :param prompt: Текст запроса
+        :param model: Имя модели
+        :return: Оценка числа токенов запроса или None, если запрос не помещается
+        """
+        prompt_tokens = self.estimator.estimate(prompt, model)
+        if prompt_tokens + MIN_RESPONSE_TOKENS > self.largest:
+            return None
+        return prompt_tokens
+
+    def choose(self, prompt_tokens, model, max_tokens=None, keep_current=False):
+        """
+        Выбор окна контекста и длины ответа
+
+        :param prompt_tokens: Оценка числа токенов запроса вместе с сохраненным контекстом
+        :param model: Имя модели
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
+        :param keep_current: Модель загружена или занята другими запросами: сохранять ее текущее окно, если запрос в него помещается
+        :return: Пара (num_ctx, num_predict)
+        """
+        num_predict = self.resolve_num_predict(max_tokens)
+        needed = prompt_tokens + num_predict
+        current = self.current.get(model)
+        if keep_current and current and current >= needed:
+            # Другое окно заставило бы Ollama перезагрузить модель
+            num_ctx = current
+        else:
+            num_ctx = next((bucket for bucket in self.buckets if bucket >= needed), None)
+            if num_ctx is None:
+                # Полный ответ не помещается: сокращаем его до свободной части наибольшего окна
+                num_ctx = self.largest
+                num_predict = max(MIN_RESPONSE_TOKENS, num_ctx - prompt_tokens)
+        self.current[model] = num_ctx
+        return num_ctx, num_predict
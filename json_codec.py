@@ -0,0 +1,149 @@
+"""
+Кодек JSON для горячего пути потоковой передачи
+
+Использует orjson или msgspec, если они установлены, иначе стандартный модуль
+json. Все модули клиента кодируют и разбирают сообщения через этот модуль.
+"""
+import json
+from json import JSONDecodeError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Окончание промежуточного фрагмента потока Ollama: {"model":...,"response":"...","done":false}
+_RESPONSE_KEY = '"response":"'
+_DONE_FALSE_SUFFIX = '"done":false}'
+_RESPONSE_KEY_BYTES = _RESPONSE_KEY.encode()
+_DONE_FALSE_SUFFIX_BYTES = _DONE_FALSE_SUFFIX.encode()
+
+_stdlib_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+_stdlib_decode_string = json.decoder.scanstring
+
+
+if orjson is not None:
+    CODEC_NAME = "orjson"
+
+    def dumps(obj):
+        """Сериализация в строку JSON"""
+        return orjson.dumps(obj).decode("utf-8")
+
+    def dumps_bytes(obj):
+        """Сериализация в байты JSON (UTF-8)"""
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+
+elif msgspec is not None:
+    CODEC_NAME = "msgspec"
+
+    _msgspec_encoder = msgspec.json.Encoder()
+    _msgspec_decoder = msgspec.json.Decoder()
+
+    def dumps(obj):
+        """Сериализация в строку JSON"""
+        return _msgspec_encoder.encode(obj).decode("utf-8")
+
+    def dumps_bytes(obj):
+        """Сериализация в байты JSON (UTF-8)"""
+        return _msgspec_encoder.encode(obj)
+
+    def loads(data):
+        """Разбор JSON из строки или байтов"""
+        try:
+            return _msgspec_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            # Вызывающий код обрабатывает ошибки стандартного модуля json
+            text = data.decode("utf-8", "replace") if isinstance(data, (bytes, bytearray)) else data
+            raise JSONDecodeError(str(e), text, 0) from None
+
+else:
+    CODEC_NAME = "json"
+
+    def dumps(obj):
+        """Сериализация в строку JSON"""
+        return _stdlib_encoder.encode(obj)
+
+    def dumps_bytes(obj):
+        """Сериализация в байты JSON (UTF-8)"""
+        return _stdlib_encoder.encode(obj).encode("utf-8")
+
+    def loads(data):
+        """Разбор JSON из строки или байтов"""
+        try:
+            return json.loads(data)
+        except UnicodeDecodeError as e:
+            # orjson и msgspec сообщают о некорректном UTF-8 как об ошибке JSON
+            raise JSONDecodeError(str(e), "", 0) from None
+
+
+def parse_chunk(line):
+    """
+    Разбор строки потока Ollama с быстрым путем для промежуточных фрагментов
+
+    Промежуточный фрагмент заканчивается на "done":false, и из него нужен только
+    текст токена, поэтому строка не разбирается целиком: текст берется срезом
+    (а со стандартным модулем json текст с экранированием декодируется как
+    отдельная JSON-строка).
+    Последний фрагмент со статистикой и все нестандартные строки разбираются
+    полностью.
+
+    :param line: Строка NDJSON без перевода строки (str или bytes)
+    :return: (текст токена или None, признак done, полный словарь или None)
+    :raises JSONDecodeError: Если строка не является JSON
+    """
+    if isinstance(line, bytes):
+        return _parse_chunk_bytes(line)
+    if line.endswith(_DONE_FALSE_SUFFIX):
+        start = line.find(_RESPONSE_KEY)
+        if start != -1:
+            start += len(_RESPONSE_KEY)
+            end = line.find('"', start)
+            if end != -1 and "\\" not in line[start:end]:
+                # Закрывающая кавычка должна относиться к полю response
+                if line.startswith(",", end + 1):
+                    return line[start:end], False, None
+            elif CODEC_NAME == "json":
+                # С orjson/msgspec полный разбор строки с экранированием быстрее scanstring
+                try:
+                    text, end = _stdlib_decode_string(line, start)
+                    if line.startswith(",", end):
+                        return text, False, None
+                except ValueError:
+                    pass
+
+    data = loads(line)
+    if not isinstance(data, dict):
+        raise JSONDecodeError("Ожидался объект JSON", line if isinstance(line, str) else "", 0)
+    return data.get("response"), bool(data.get("done")), data
+
+
+def _parse_chunk_bytes(line):
+    """parse_chunk для строки, полученной из байтового буфера транспорта"""
+    if line.endswith(_DONE_FALSE_SUFFIX_BYTES):
+        start = line.find(_RESPONSE_KEY_BYTES)
+        if start != -1:
+            start += len(_RESPONSE_KEY_BYTES)
+            end = line.find(b'"', start)
+            if end != -1 and b"\\" not in line[start:end] and line.startswith(b",", end + 1):
+                try:
+                    return line[start:end].decode("utf-8"), False, None
+                except UnicodeDecodeError:
+                    pass
+            elif CODEC_NAME == "json":
+                # Экранированный текст разбирается строковым путем
+                try:
+                    return parse_chunk(line.decode("utf-8"))
+                except UnicodeDecodeError:
+                    pass
+
+    data = loads(line)
+    if not isinstance(data, dict):
+        raise JSONDecodeError("Ожидался объект JSON", "", 0)
+    return data.get("response"), bool(data.get("done")), data
@@ -0,0 +1,381 @@
+import re
+import asyncio
+from bisect import bisect_left
+from config import logger
+
+MODE_STREAM = "stream"
+MODE_NON_STREAM = "non-stream"
+MODE_WARMUP = "warmup"
+
+# Границы бакетов гистограмм
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FAST_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+QUEUE_DEPTH_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500, 1000, 2500, 5000)
+
+
+def _escape(value):
+    """Экранирование значения метки для текстового формата Prometheus"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    """Форматирование набора меток"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Базовый класс метрики с набором меток"""
+    
+    metric_type = "untyped"
+    
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: Имя метрики
+        :param documentation: Описание метрики
+        :param labelnames: Имена меток
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+    
+    def render(self):
+        """Представление метрики в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    
+    metric_type = "counter"
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Значение, которое может как расти, так и уменьшаться"""
+    
+    metric_type = "gauge"
+    
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными бакетами"""
+    
+    metric_type = "histogram"
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def labels(self, **labels):
+        """
+        Получение функции наблюдения для фиксированного набора меток
+        
+        Используется в горячих циклах, чтобы не вычислять ключ меток на каждое наблюдение.
+        """
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # Счетчики по бакетам (последний - +Inf), сумма и количество наблюдений
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        buckets = self.buckets
+        
+        def observe(value):
+            state[0][bisect_left(buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+        return observe
+    
+    def observe(self, value, **labels):
+        self.labels(**labels)(value)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Реестр метрик клиента"""
+    
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def add_collector(self, collector):
+        """
+        Добавление функции, обновляющей метрики непосредственно перед выдачей
+        
+        :param collector: Функция без аргументов
+        """
+        self.collectors.append(collector)
+    
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрик: {str(e)}")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Общий реестр метрик клиента
+metrics = MetricsRegistry()
+
+REQUEST_LABELS = ("model", "mode")
+
+TIME_TO_FIRST_TOKEN = metrics.histogram(
+    "ollama_proxy_time_to_first_token_seconds", "Время от отправки запроса в Ollama до первого токена",
+    REQUEST_LABELS)
+INTER_TOKEN_LATENCY = metrics.histogram(
+    "ollama_proxy_inter_token_latency_seconds", "Интервал между соседними токенами",
+    REQUEST_LABELS, FAST_LATENCY_BUCKETS)
+GENERATION_TOKENS_PER_SECOND = metrics.histogram(
+    "ollama_proxy_generation_tokens_per_second", "Скорость генерации по eval_count/eval_duration",
+    REQUEST_LABELS, THROUGHPUT_BUCKETS)
+PROMPT_EVAL_TOKENS_PER_SECOND = metrics.histogram(
+    "ollama_proxy_prompt_eval_tokens_per_second", "Скорость обработки запроса по prompt_eval_count/prompt_eval_duration",
+    REQUEST_LABELS, THROUGHPUT_BUCKETS)
+MODEL_LOAD_SECONDS = metrics.histogram(
+    "ollama_proxy_model_load_seconds", "Время загрузки модели (load_duration)",
+    REQUEST_LABELS)
+WEBSOCKET_SEND_SECONDS = metrics.histogram(
+    "ollama_proxy_websocket_send_seconds", "Время отправки одного фрейма через WebSocket",
+    REQUEST_LABELS, FAST_LATENCY_BUCKETS)
+REQUEST_DURATION_SECONDS = metrics.histogram(
+    "ollama_proxy_request_duration_seconds", "Полное время обработки запроса",
+    REQUEST_LABELS)
+STREAM_FRAMES_SAVED = metrics.counter(
+    "ollama_proxy_stream_frames_saved_total", "Фреймы, сэкономленные объединением токенов", ("model",))
+STREAM_QUEUE_DEPTH = metrics.histogram(
+    "ollama_proxy_stream_queue_depth", "Максимальная глубина очереди отправки за запрос",
+    ("model",), QUEUE_DEPTH_BUCKETS)
+STREAM_BACKPRESSURE_SECONDS = metrics.histogram(
+    "ollama_proxy_stream_backpressure_seconds", "Время, на которое чтение Ollama приостанавливалось за запрос",
+    ("model",))
+STREAM_WRITER_STALLS = metrics.counter(
+    "ollama_proxy_stream_writer_stalls_total", "Генерации, прерванные из-за зависшей отправки", ("model",))
+WEBSOCKET_RTT_SECONDS = metrics.histogram(
+    "ollama_proxy_websocket_rtt_seconds", "Время от ping до pong в соединении с сервером")
+WEBSOCKET_RTT_RECENT_SECONDS = metrics.gauge(
+    "ollama_proxy_websocket_rtt_recent_seconds", "RTT по последним измерениям (last, min, avg, p95, max)", ("stat",))
+WEBSOCKET_DEAD_LINKS = metrics.counter(
+    "ollama_proxy_websocket_dead_links_total", "Соединения, признанные мертвыми до ошибки recv()", ("reason",))
+WORKER_RESTARTS = metrics.counter(
+    "ollama_proxy_worker_restarts_total", "Перезапуски упавших рабочих процессов", ("worker",))
+WORKERS_ALIVE = metrics.gauge(
+    "ollama_proxy_workers_alive", "Количество работающих рабочих процессов")
+REQUESTS_TOTAL = metrics.counter(
+    "ollama_proxy_requests_total", "Количество обработанных запросов", REQUEST_LABELS + ("status",))
+IN_FLIGHT_REQUESTS = metrics.gauge(
+    "ollama_proxy_in_flight_requests", "Количество выполняющихся запросов", REQUEST_LABELS)
+QUEUED_REQUESTS = metrics.gauge(
+    "ollama_proxy_queued_requests", "Количество запросов, ожидающих свободного слота", REQUEST_LABELS)
+CONCURRENCY_LIMIT = metrics.gauge(
+    "ollama_proxy_concurrency_limit", "Текущий лимит одновременно выполняемых запросов")
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "ollama_proxy_queue_wait_seconds", "Время ожидания запроса в очереди планировщика",
+    REQUEST_LABELS)
+MODEL_SWAPS = metrics.counter(
+    "ollama_proxy_model_swaps_total", "Запросы, для которых Ollama пришлось загружать модель", ("model",))
+MODEL_SWAP_SECONDS = metrics.histogram(
+    "ollama_proxy_model_swap_seconds", "Время загрузки модели при смене моделей (load_duration)", ("model",))
+MODEL_WARMUPS = metrics.counter(
+    "ollama_proxy_model_warmups_total", "Количество запросов на загрузку и удержание модели",
+    ("model", "reason"))
+SESSION_TURNS = metrics.counter(
+    "ollama_proxy_session_turns_total", "Количество ходов бесед (reused - передан ли сохраненный context)",
+    REQUEST_LABELS + ("reused",))
+SESSION_REUSED_TOKENS = metrics.counter(
+    "ollama_proxy_session_reused_tokens_total", "Количество токенов контекста, которые не пришлось обрабатывать повторно",
+    REQUEST_LABELS)
+SESSION_PROMPT_EVAL_SAVED_SECONDS = metrics.histogram(
+    "ollama_proxy_session_prompt_eval_saved_seconds", "Оценка сэкономленного времени обработки запроса за ход беседы",
+    REQUEST_LABELS)
+SESSIONS_ACTIVE = metrics.gauge(
+    "ollama_proxy_sessions", "Количество хранимых бесед")
+SESSION_CONTEXT_TOKENS = metrics.gauge(
+    "ollama_proxy_session_context_tokens", "Суммарный размер хранимых контекстов в токенах")
+RESPONSE_CACHE_LOOKUPS = metrics.gauge(
+    "ollama_proxy_response_cache_lookups", "Количество обращений к кэшу ответов", ("result",))
+RESPONSE_CACHE_ENTRIES = metrics.gauge(
+    "ollama_proxy_response_cache_entries", "Количество записей в кэше ответов")
+SINGLE_FLIGHT_JOINS = metrics.counter(
+    "ollama_proxy_single_flight_joins_total", "Запросы, присоединенные к такой же выполняющейся генерации", ("mode",))
+CONTEXT_WINDOW_REQUESTS = metrics.counter(
+    "ollama_proxy_context_window_requests_total", "Запросы к Ollama по выбранному окну контекста", ("model", "num_ctx"))
+REQUESTS_REJECTED = metrics.counter(
+    "ollama_proxy_requests_rejected_total", "Запросы, отклоненные без генерации", ("reason",))
+CONFIG_RELOADS = metrics.counter(
+    "ollama_proxy_config_reloads_total", "Перезагрузки конфигурации по результату", ("result",))
+
+
+def observe_generation_stats(final_data, model, mode):
+    """
+    Учет статистики из последнего объекта ответа Ollama
+    
+    :param final_data: Последний объект ответа (done: true)
+    :param model: Имя модели
+    :param mode: Режим запроса (stream / non-stream)
+    """
+    if not final_data:
+        return
+    
+    eval_count = final_data.get("eval_count") or 0
+    eval_duration = (final_data.get("eval_duration") or 0) / 1e9
+    prompt_eval_count = final_data.get("prompt_eval_count") or 0
+    prompt_eval_duration = (final_data.get("prompt_eval_duration") or 0) / 1e9
+    load_duration = (final_data.get("load_duration") or 0) / 1e9
+    
+    if eval_count and eval_duration:
+        GENERATION_TOKENS_PER_SECOND.observe(eval_count / eval_duration, model=model, mode=mode)
+    if prompt_eval_count and prompt_eval_duration:
+        PROMPT_EVAL_TOKENS_PER_SECOND.observe(prompt_eval_count / prompt_eval_duration, model=model, mode=mode)
+    if "load_duration" in final_data:
+        MODEL_LOAD_SECONDS.observe(load_duration, model=model, mode=mode)
+    
+    # В непотоковом режиме отдельные токены не видны, поэтому оцениваем
+    # время до первого токена и интервал между токенами по данным Ollama
+    if mode == MODE_NON_STREAM:
+        TIME_TO_FIRST_TOKEN.observe(load_duration + prompt_eval_duration, model=model, mode=mode)
+        if eval_count and eval_duration:
+            INTER_TOKEN_LATENCY.observe(eval_duration / eval_count, model=model, mode=mode)
+
+
+_SAMPLE_LINE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (.*)$")
+
+
+def merge_expositions(sources, label="worker"):
+    """
+    Объединение метрик нескольких процессов в одну выдачу Prometheus
+    
+    Образцы каждого процесса получают метку с его именем, а образцы одной
+    метрики группируются под общими строками HELP и TYPE.
+    
+    :param sources: Список пар (значение метки или None, текст в формате Prometheus)
+    :param label: Имя добавляемой метки
+    :return: Объединенный текст
+    """
+    families = {}
+    for value, text in sources:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                family = families.setdefault(name, {"help": None, "type": None, "samples": []})
+                key = "help" if line.startswith("# HELP ") else "type"
+                if family[key] is None:
+                    family[key] = line
+                continue
+            match = _SAMPLE_LINE.match(line)
+            if match is None or family is None:
+                continue
+            name, labels, sample = match.groups()
+            if value is not None:
+                extra = f'{label}="{_escape(value)}"'
+                labels = f"{labels},{extra}" if labels else extra
+            family["samples"].append(f"{name}{{{labels}}} {sample}" if labels else f"{name} {sample}")
+    
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family["help"], family["type"]) if line)
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер, отдающий метрики в формате Prometheus"""
+    
+    def __init__(self, host, port, registry=metrics):
+        """
+        :param host: Адрес для прослушивания
+        :param port: Порт для прослушивания
+        :param registry: Реестр метрик
+        """
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.server = None
+    
+    async def start(self):
+        """Запуск сервера метрик"""
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Метрики доступны по адресу http://{self.host}:{self.port}/metrics")
+    
+    async def stop(self):
+        """Остановка сервера метрик"""
+        if self.server:
+            self.server.close()
+            self.server = None
+    
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+            # Заголовки запроса не используются, но их нужно дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5.0)) not in (b"\r\n", b"\n", b""):
+                pass
+            
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+                status, body = "200 OK", self.registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Ошибка при обработке запроса метрик: {str(e)}")
+        finally:
+            writer.close()
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import httpx
+from config import logger, DEFAULT_OLLAMA_KEEP_ALIVE, DEFAULT_MODEL_WATCH_INTERVAL
+from metrics import MODEL_WARMUPS, MODEL_LOAD_SECONDS, MODE_WARMUP
+
+
+class ModelWarmer:
+    """Класс для предварительной загрузки модели и удержания ее в памяти Ollama"""
+    
+    def __init__(self, ollama_client, keep_alive=DEFAULT_OLLAMA_KEEP_ALIVE,
+                 watch_interval=DEFAULT_MODEL_WATCH_INTERVAL):
+        """
+        Инициализация
+        
+        :param ollama_client: Клиент OllamaClient (используются его пул соединений и пул бэкендов)
+        :param keep_alive: Сколько Ollama держит модель в памяти после запроса ("30m", "-1" и т.д.)
+        :param watch_interval: Интервал проверки /api/ps в секундах (0 - без наблюдения)
+        """
+        self.ollama_client = ollama_client
+        self.keep_alive = keep_alive
+        self.watch_interval = watch_interval
+        self._watch_task = None
+    
+    @property
+    def model(self):
+        return self.ollama_client.model
+    
+    async def warm_backend(self, backend, reason="startup"):
+        """
+        Загрузка модели на бэкенде запросом без текста
+        
+        Ollama загружает модель и сразу возвращает ответ с load_duration.
+        
+        :param backend: Объект OllamaBackend
+        :param reason: Причина загрузки для журнала и метрик (startup, unloaded, refresh)
+        :return: Время загрузки модели в секундах или None при ошибке
+        """
+        client = await self.ollama_client.open()
+        # Те же параметры, что и у обычных запросов: другой num_ctx заставил бы Ollama перезагрузить модель
+        request_data = self.ollama_client.prepare_request_data("", stream_mode=False)
+        request_data["keep_alive"] = self.keep_alive
+        start = time.perf_counter()
+        try:
+            response = await client.post(backend.get_api_url("generate"), json=request_data, timeout=600.0)
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"Не удалось загрузить модель {self.model} на {backend.name}: {str(e) or type(e).__name__}")
+            return None
+        
+        load_duration = (data.get("load_duration") or 0) / 1e9
+        backend.loaded_models.add(self.model)
+        MODEL_WARMUPS.inc(model=self.model, reason=reason)
+        if reason != "refresh":
+            MODEL_LOAD_SECONDS.observe(load_duration, model=self.model, mode=MODE_WARMUP)
+            logger.info(f"Модель {self.model} загружена на {backend.name} (причина: {reason}, "
+                        f"load_duration: {load_duration:.2f} сек, всего: {time.perf_counter() - start:.2f} сек, "
+                        f"keep_alive: {self.keep_alive})")
+        return load_duration
+    
+    async def warm_up(self):
+        """
+        Загрузка модели на всех бэкендах перед началом приема запросов
+        
+        :return: True, если модель загружена хотя бы на одном бэкенде
+        """
+        backends = self.ollama_client.pool.backends
+        logger.info(f"Предварительная загрузка модели {self.model} ({len(backends)} бэкенд(ов))...")
+        results = await asyncio.gather(*(self.warm_backend(backend) for backend in backends))
+        return any(result is not None for result in results)
+    
+    async def check_residency(self):
+        """Проверка /api/ps и повторная загрузка модели, если Ollama ее выгрузила"""
+        client = await self.ollama_client.open()
+        pool = self.ollama_client.pool
+        for backend in pool.backends:
+            await pool.check_backend(client, backend)
+            if not backend.healthy:
+                continue
+            if not backend.has_model(self.model):
+                if backend.in_flight:
+                    # Бэкенд занят запросами (возможно, к другим моделям): загрузка помешала бы им
+                    continue
+                logger.warning(f"Модель {self.model} выгружена на {backend.name}, загружаем повторно")
+                await self.warm_backend(backend, reason="unloaded")
+            elif backend.in_flight == 0:
+                # Без запросов таймер keep_alive не продлевается, продлеваем его сами
+                await self.warm_backend(backend, reason="refresh")
+    
+    async def _watch_loop(self):
+        """Фоновое наблюдение за загруженностью модели"""
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await self.check_residency()
+            except Exception as e:
+                logger.error(f"Ошибка при проверке загруженности модели: {str(e)}")
+    
+    def start(self):
+        """Запуск фонового наблюдения за моделью"""
+        if self._watch_task is None and self.watch_interval > 0:
+            self._watch_task = asyncio.create_task(self._watch_loop())
+            logger.info(f"Запущено наблюдение за моделью {self.model} (интервал: {self.watch_interval} сек)")
+    
+    async def stop(self):
+        """Остановка фонового наблюдения"""
+        if self._watch_task:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+    
+    async def unload(self):
+        """Выгрузка модели на всех бэкендах (keep_alive: 0)"""
+        client = await self.ollama_client.open()
+        request_data = {"model": self.model, "prompt": "", "stream": False, "keep_alive": 0}
+        for backend in self.ollama_client.pool.backends:
+            try:
+                await client.post(backend.get_api_url("generate"), json=request_data, timeout=30.0)
+                backend.loaded_models.discard(self.model)
+                logger.info(f"Модель {self.model} выгружена на {backend.name}")
+            except httpx.HTTPError as e:
+                logger.warning(f"Не удалось выгрузить модель {self.model} на {backend.name}: {str(e) or type(e).__name__}")
@@ -0,0 +1,71 @@
+"""
+Построчное чтение NDJSON-потока Ollama из байтовых буферов транспорта
+
+Строки выделяются прямо из буферов aiter_bytes, без промежуточного
+декодирования всего потока в текст. Части строки, разорванной между
+буферами, накапливаются списком и склеиваются один раз. Длина строки
+ограничена, чтобы поток без перевода строки не занимал память без предела.
+"""
+from config import DEFAULT_STREAM_MAX_LINE_BYTES
+
+_NEWLINE = b"\n"
+_CARRIAGE_RETURN = b"\r"
+
+
+class LineTooLongError(ValueError):
+    """Строка NDJSON длиннее допустимого размера"""
+
+    def __init__(self, max_line_bytes):
+        super().__init__(f"строка потока Ollama длиннее {max_line_bytes} байт")
+        self.max_line_bytes = max_line_bytes
+
+
+def _complete_line(line):
+    """Строка без завершающего \\r или None, если она пустая"""
+    if line.endswith(_CARRIAGE_RETURN):
+        line = line[:-1]
+    if not line or line.isspace():
+        return None
+    return line
+
+
+async def iter_lines(chunks, max_line_bytes=DEFAULT_STREAM_MAX_LINE_BYTES):
+    """
+    Выделение строк NDJSON из последовательности байтовых буферов
+
+    :param chunks: Асинхронный итератор буферов (например, response.aiter_bytes())
+    :param max_line_bytes: Максимальная длина строки в байтах (0 - без ограничения)
+    :return: Асинхронный генератор непустых строк (bytes) без перевода строки
+    :raises LineTooLongError: Если строка длиннее max_line_bytes
+    """
+    pending = []  # Части строки, начавшейся в предыдущих буферах
+    pending_size = 0
+    async for chunk in chunks:
+        start = 0
+        end = chunk.find(_NEWLINE)
+        while end != -1:
+            if max_line_bytes and pending_size + end - start > max_line_bytes:
+                raise LineTooLongError(max_line_bytes)
+            if pending:
+                pending.append(chunk[start:end])
+                line = b"".join(pending)
+                pending.clear()
+                pending_size = 0
+            else:
+                line = chunk[start:end]
+            line = _complete_line(line)
+            if line is not None:
+                yield line
+            start = end + 1
+            end = chunk.find(_NEWLINE, start)
+        if start < len(chunk):
+            # Незавершенная строка проверяется до склейки, а не после
+            pending_size += len(chunk) - start
+            if max_line_bytes and pending_size > max_line_bytes:
+                raise LineTooLongError(max_line_bytes)
+            pending.append(chunk[start:] if start else chunk)
+
+    if pending:
+        line = _complete_line(b"".join(pending))
+        if line is not None:
+            yield line
@@ -1,29 +1,147 @@
-import json
+import time
+import asyncio
 import httpx
+import json_codec
+import logging
 import traceback
-from config import logger, DEFAULT_MODEL, debug_json_error
+from config import (
+    logger, DEFAULT_MODEL, debug_json_error,
+    DEFAULT_OLLAMA_MAX_CONNECTIONS, DEFAULT_OLLAMA_KEEPALIVE_EXPIRY, DEFAULT_OLLAMA_HTTP2,
+    DEFAULT_OLLAMA_ROUTING, DEFAULT_HEALTH_CHECK_INTERVAL, DEFAULT_OLLAMA_KEEP_ALIVE,
+    COLD_LOAD_WARNING_SECONDS, MODEL_SWAP_MIN_LOAD_SECONDS, DEFAULT_NUM_CTX, DEFAULT_NUM_PREDICT,
+    DEFAULT_OLLAMA_REQUEST_TIMEOUT, DEFAULT_OLLAMA_STREAM_TIMEOUT
+)
+from ollama_pool import OllamaBackend, OllamaBackendPool
+from metrics import (
+    MODE_STREAM, MODE_NON_STREAM, MODEL_SWAPS, MODEL_SWAP_SECONDS, CONTEXT_WINDOW_REQUESTS, observe_generation_stats
+)
+from tracing import tracer
 
 class OllamaClient:
     """Класс для работы с Ollama API"""
     
-    def __init__(self, host, port, model=DEFAULT_MODEL):
+    def __init__(self, host, port, model=DEFAULT_MODEL,
+                 max_connections=DEFAULT_OLLAMA_MAX_CONNECTIONS,
+                 keepalive_expiry=DEFAULT_OLLAMA_KEEPALIVE_EXPIRY,
+                 http2=DEFAULT_OLLAMA_HTTP2, response_cache=None, options=None,
+                 backends=None, routing=DEFAULT_OLLAMA_ROUTING,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 keep_alive=DEFAULT_OLLAMA_KEEP_ALIVE, session_store=None,
+                 num_ctx=DEFAULT_NUM_CTX, num_predict=DEFAULT_NUM_PREDICT,
+                 request_timeout=DEFAULT_OLLAMA_REQUEST_TIMEOUT, stream_timeout=DEFAULT_OLLAMA_STREAM_TIMEOUT,
+                 latency_observer=None, allowed_models=None, single_flight=None, context_sizer=None):
         """
         Инициализация клиента Ollama
         
         :param host: Хост API Ollama
         :param port: Порт API Ollama
         :param model: Модель по умолчанию
+        :param max_connections: Максимальное число соединений в пуле
+        :param keepalive_expiry: Время жизни простаивающего соединения в секундах
+        :param http2: Использовать HTTP/2, если установлен пакет h2
+        :param response_cache: Кэш ответов ResponseCache (None - кэширование отключено)
+        :param options: Параметры генерации, перекрывающие значения по умолчанию
+        :param backends: Список объектов OllamaBackend (если не задан, используется host:port)
+        :param routing: Стратегия маршрутизации запросов между бэкендами
+        :param health_check_interval: Интервал фоновой проверки бэкендов в секундах
+        :param keep_alive: Сколько Ollama держит модель в памяти после запроса
+        :param session_store: Хранилище бесед SessionStore (None - беседы не поддерживаются)
+        :param num_ctx: Размер окна контекста модели в токенах
+        :param num_predict: Максимальное количество токенов ответа
+        :param request_timeout: Таймаут обычного запроса в секундах
+        :param stream_timeout: Таймаут ожидания очередного фрагмента потокового ответа в секундах
+        :param latency_observer: Функция (секунды), получающая время до первого токена каждого запроса
+        :param allowed_models: Модели, которые покупатель может запросить помимо модели по умолчанию
+        :param single_flight: Реестр SingleFlight для объединения одинаковых запросов (None - не объединять)
+        :param context_sizer: Объект ContextSizer для подбора num_ctx и num_predict (None - всегда num_ctx и num_predict)
         """
         self.host = host
         self.port = port
         self.model = model
-        self.client = httpx.AsyncClient()
-        self.base_url = f"http://{self.host}:{self.port}/api"
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.response_cache = response_cache
+        self.options = options or {}
+        self.keep_alive = keep_alive
+        self.session_store = session_store
+        self.num_ctx = num_ctx
+        self.num_predict = num_predict
+        self.request_timeout = request_timeout
+        self.stream_timeout = stream_timeout
+        self.latency_observer = latency_observer
+        self.allowed_models = [model for model in allowed_models or [] if model != self.model]
+        self.single_flight = single_flight
+        self.context_sizer = context_sizer
+        # Общий пул соединений создается в open() и закрывается в close()
+        self.client = None
+        self.http2_enabled = False
+        # Запросы покупателей, которые выполняет этот клиент: заменённый при перезагрузке
+        # конфигурации клиент закрывается, когда они завершатся
+        self.active_requests = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        
+        # Пул бэкендов используется и обычными, и потоковыми запросами
+        self.pool = OllamaBackendPool(
+            backends or [OllamaBackend(host, port)],
+            routing=routing,
+            health_check_interval=health_check_interval
+        )
+    
+    def _create_http_client(self):
+        """
+        Создание долгоживущего пула HTTP-соединений к Ollama
+        
+        :return: Экземпляр httpx.AsyncClient
+        """
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Пакет h2 не установлен, HTTP/2 отключен (pip install httpx[http2])")
+                http2 = False
+        self.http2_enabled = http2
+        
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+        return httpx.AsyncClient(limits=limits, http2=http2)
+    
+    async def open(self):
+        """Открытие общего пула соединений с Ollama API"""
+        if self.client is None:
+            self.client = self._create_http_client()
+            logger.info(f"Открыт пул соединений с Ollama API (max_connections: {self.max_connections}, "
+                        f"keepalive_expiry: {self.keepalive_expiry} сек, http2: {self.http2_enabled})")
+            # Загруженные модели отслеживаются, если есть из чего выбирать
+            if len(self.pool.backends) > 1 or self.allowed_models:
+                self.pool.start(self.client)
+        return self.client
+    
+    def acquire(self):
+        """Отметка о начале запроса покупателя, выполняемого этим клиентом"""
+        self.active_requests += 1
+        self.idle.clear()
+    
+    def release(self):
+        """Отметка о завершении запроса покупателя"""
+        self.active_requests -= 1
+        if self.active_requests <= 0:
+            self.idle.set()
     
     async def close(self):
         """Закрытие клиента"""
+        if self.response_cache:
+            # Сохраняет кэш его владелец (OllamaProxyClient): кэш переходит к клиенту, заменяющему этот
+            logger.info(f"Статистика кэша ответов: {self.response_cache.stats()}")
+        await self.pool.stop()
         if self.client:
             await self.client.aclose()
+            self.client = None
             logger.info("Соединение с Ollama API закрыто")
     
     def get_api_url(self, endpoint="generate"):
@@ -31,17 +149,137 @@ class OllamaClient:
         Получение URL API для запроса
         
         :param endpoint: API эндпоинт
-        :return: Полный URL API
+        :return: Полный URL API на бэкенде, который был бы выбран для модели по умолчанию
+        """
+        return self.pool.select(self.model).get_api_url(endpoint)
+    
+    def resolve_model(self, requested=None):
+        """
+        Выбор модели для запроса покупателя
+        
+        :param requested: Модель из поля model сообщения (None - модель по умолчанию)
+        :return: Имя модели или None, если запрошенная модель не разрешена
+        """
+        if not requested or requested == self.model:
+            return self.model
+        return requested if requested in self.allowed_models else None
+    
+    def report_generation_stats(self, data, model, mode, message_id=-1, elapsed=None, backend=None, prompt=None):
         """
-        return f"{self.base_url}/{endpoint}"
+        Учет статистики генерации и предупреждение о холодной загрузке модели
+        
+        :param data: Последний объект ответа Ollama
+        :param model: Имя модели
+        :param mode: Режим запроса (stream / non-stream)
+        :param message_id: ID сообщения для журнала
+        :param elapsed: Полное время запроса в секундах (для оценки времени до первого токена)
+        :param backend: Бэкенд, выполнивший запрос
+        :param prompt: Текст запроса без сохраненного контекста для калибровки оценки токенов (None - не калибровать)
+        """
+        data = data or {}
+        observe_generation_stats(data, model, mode)
+        if self.context_sizer and prompt is not None:
+            self.context_sizer.estimator.observe(prompt, data.get("prompt_eval_count"), model)
+        load_duration = (data.get("load_duration") or 0) / 1e9
+        if backend is not None and load_duration >= MODEL_SWAP_MIN_LOAD_SECONDS:
+            # Ollama загрузила модель для этого запроса
+            MODEL_SWAPS.inc(model=model)
+            MODEL_SWAP_SECONDS.observe(load_duration, model=model)
+            logger.info(f"Смена модели на {backend.name}: {model} загружена за {load_duration:.2f} сек (messageId: {message_id})")
+            # Ollama могла выгрузить другие модели, чтобы освободить память
+            if self.client is not None:
+                self.pool.schedule_check(self.client, backend)
+        if load_duration >= COLD_LOAD_WARNING_SECONDS:
+            logger.warning(f"Холодная загрузка модели {model}: load_duration {load_duration:.2f} сек (messageId: {message_id})")
+        if self.latency_observer and elapsed is not None:
+            # Время до первого токена включает ожидание в очереди Ollama и растет при перегрузке
+            eval_duration = (data.get("eval_duration") or 0) / 1e9
+            self.latency_observer(max(0.0, elapsed - eval_duration))
     
-    def prepare_request_data(self, prompt, stream_mode=False, model=None):
+    def get_session(self, conversation_id):
+        """
+        Получение беседы по идентификатору
+        
+        :param conversation_id: Идентификатор беседы из сообщения покупателя
+        :return: Объект Session или None, если беседы не используются
+        """
+        if not self.session_store or conversation_id is None:
+            return None
+        return self.session_store.get(conversation_id)
+    
+    def apply_session(self, request_data, session, max_tokens=None):
+        """
+        Замена запроса на его необработанную часть и передача сохраненного контекста
+        
+        :param request_data: Данные запроса к Ollama API
+        :param session: Объект Session или None
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
+        :return: Объект SessionTurn или None
+        """
+        if session is None:
+            return None
+        if self.context_sizer:
+            # Контекст беседы сбрасывается, только если не помещается в наибольшее окно
+            num_ctx = self.context_sizer.largest
+        else:
+            num_ctx = request_data["options"].get("num_ctx") or DEFAULT_NUM_CTX
+        turn = self.session_store.prepare_turn(session, request_data["prompt"], num_ctx, request_data["model"])
+        request_data["prompt"] = turn.prompt
+        if turn.context:
+            request_data["context"] = turn.context
+            if self.context_sizer:
+                self.size_context(request_data, max_tokens, context_tokens=len(turn.context))
+        return turn
+    
+    def check_prompt(self, prompt, model):
+        """
+        Проверка, помещается ли запрос в окно контекста модели
+        
+        :param prompt: Текст запроса покупателя
+        :param model: Имя модели
+        :return: True, если запрос можно отправить в Ollama
+        """
+        return not self.context_sizer or self.context_sizer.fits(prompt, model) is not None
+    
+    def size_context(self, request_data, max_tokens=None, context_tokens=0):
+        """
+        Выбор окна контекста и длины ответа по оценке размера запроса
+        
+        :param request_data: Данные запроса к Ollama API (options изменяются на месте)
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
+        :param context_tokens: Размер передаваемого сохраненного контекста в токенах
+        """
+        model = request_data["model"]
+        prompt_tokens = self.context_sizer.estimator.estimate(request_data["prompt"], model) + context_tokens
+        num_ctx, num_predict = self.context_sizer.choose(prompt_tokens, model, max_tokens,
+                                                         keep_current=self.pool.has_model(model))
+        request_data["options"]["num_ctx"] = num_ctx
+        request_data["options"]["num_predict"] = num_predict
+    
+    def count_context_window(self, request_data):
+        """Учет окна контекста, с которым запрос отправляется в Ollama"""
+        if self.context_sizer:
+            CONTEXT_WINDOW_REQUESTS.inc(model=request_data["model"], num_ctx=str(request_data["options"]["num_ctx"]))
+    
+    def get_cache_key(self, request_data):
+        """
+        Получение ключа кэша для запроса, если ответ на него можно кэшировать
+        
+        :param request_data: Данные запроса к Ollama API
+        :return: Ключ кэша или None
+        """
+        if not self.response_cache or not self.response_cache.is_cacheable(request_data):
+            return None
+        return self.response_cache.make_key(request_data)
+    
+    def prepare_request_data(self, prompt, stream_mode=False, model=None, max_tokens=None):
         """
         Подготовка данных для запроса к Ollama API
         
         :param prompt: Текст запроса
         :param stream_mode: Режим потоковой передачи
         :param model: Модель (если отличается от установленной по умолчанию)
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
         :return: Словарь с данными запроса
         """
         # Базовые параметры запроса
@@ -50,14 +288,15 @@ class OllamaClient:
             "prompt": prompt,
             "stream": stream_mode,
             "raw": False,                   # Не используем raw-режим для обработки маркеров
-            "keep_alive": "5m",             # Держим модель в памяти для быстрых ответов
+            "keep_alive": self.keep_alive,  # Держим модель в памяти для быстрых ответов
             "keep_alive_timeout": 300       # Увеличиваем таймаут для загрузки модели
         }
         
         # Добавляем опции для улучшения генерации текста
         options = {
             # Основные параметры качества генерации
-            "num_predict": 2048,           # Максимальное количество токенов для генерации
+            "num_predict": self.num_predict,  # Максимальное количество токенов для генерации
+            "num_ctx": self.num_ctx,       # Размер контекста (одинаковый для обоих режимов, иначе Ollama перезагружает модель)
             "temperature": 0.7,            # Температура (креативность) генерации
             "top_k": 40,                   # Количество лучших токенов для выборки
             "top_p": 0.9,                  # Вероятность следующего токена (nucleus sampling)
@@ -69,10 +308,8 @@ class OllamaClient:
         
         # Настройки для потокового режима
         if stream_mode:
-            # Оптимизируем для быстрой потоковой передачи в режиме стриминга
+            # num_gpu не задаем: это число слоев на GPU, и Ollama подбирает его сама
             streaming_options = {
-                "num_ctx": 4096,           # Максимальный размер контекста
-                "num_gpu": 1,              # Использовать GPU для ускорения
                 "tfs_z": 1.0,              # Параметр tail free sampling
                 "seed": -1,                # Случайный seed для воспроизводимости
                 "ignore_eos": False        # Не игнорировать токен конца последовательности
@@ -80,76 +317,147 @@ class OllamaClient:
             # Обновляем основные настройки
             options.update(streaming_options)
         
-        # Добавляем опции в запрос
-        request_data.update(options)
+        # Параметры из конфигурации имеют приоритет над значениями по умолчанию
+        options.update(self.options)
+        
+        # Ollama читает параметры генерации только из поля options
+        request_data["options"] = options
+        
+        if self.context_sizer:
+            # Окно и длина ответа подбираются под запрос
+            self.size_context(request_data, max_tokens)
         
         return request_data
         
-    async def generate(self, prompt, stream_mode=False, message_id=-1):
+    async def generate(self, prompt, stream_mode=False, message_id=-1, conversation_id=None, model=None,
+                       max_tokens=None):
         """
         Запрос к Ollama API без потоковой передачи
         
         :param prompt: Текст запроса
         :param stream_mode: Режим потоковой передачи
         :param message_id: ID сообщения для отслеживания
+        :param conversation_id: Идентификатор беседы для переиспользования контекста
+        :param model: Модель (если отличается от установленной по умолчанию)
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
         :return: Ответ от API или сообщение об ошибке
         """
         if stream_mode:
             logger.error("Для потоковой передачи используйте метод stream_generate")
             return "Ошибка: неверный метод для потоковой передачи"
-            
+        
+        session = self.get_session(conversation_id)
+        if session is None:
+            if self.single_flight:
+                # Продолжения бесед зависят от контекста сессии и не объединяются.
+                # Ключ считается по тем же данным, что отправляются в Ollama
+                request_data = self.prepare_request_data(prompt, stream_mode=False, model=model, max_tokens=max_tokens)
+                key = self.single_flight.make_key(request_data)
+                return await self.single_flight.run(
+                    key, message_id, lambda: self._generate(prompt, message_id, request_data=request_data))
+            return await self._generate(prompt, message_id, model=model, max_tokens=max_tokens)
+        async with session.lock:
+            return await self._generate(prompt, message_id, session, model, max_tokens)
+    
+    async def _generate(self, prompt, message_id=-1, session=None, model=None, max_tokens=None, request_data=None):
+        """
+        Выполнение запроса без потоковой передачи
+        
+        :param prompt: Текст запроса
+        :param message_id: ID сообщения для отслеживания
+        :param session: Объект Session или None
+        :param model: Модель (если отличается от установленной по умолчанию)
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
+        :param request_data: Уже подготовленные данные запроса (None - подготовить здесь)
+        :return: Ответ от API или сообщение об ошибке
+        """
+        backend = None
         try:
-            # Получаем URL и подготавливаем данные запроса
-            ollama_url = self.get_api_url("generate")
-            request_data = self.prepare_request_data(prompt, stream_mode=False)
+            # Подготавливаем данные запроса
+            if request_data is None:
+                request_data = self.prepare_request_data(prompt, stream_mode=False, model=model, max_tokens=max_tokens)
+            turn = self.apply_session(request_data, session, max_tokens)
+            
+            # Проверяем кэш ответов
+            cache_key = self.get_cache_key(request_data)
+            if cache_key:
+                cached_response = self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    logger.info(f"Ответ найден в кэше (messageId: {message_id})")
+                    return cached_response
+            
+            logger.info(f"Отправка запроса к Ollama API ({request_data['model']}): {request_data['prompt'][:100]}...")
+            self.count_context_window(request_data)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Параметры запроса: %s", json_codec.dumps(request_data))
+            
+            # Отправляем запрос через общий пул соединений на выбранный бэкенд
+            client = await self.open()
+            request_start = time.perf_counter()
+            async with self.pool.lease(request_data["model"]) as backend:
+                self.pool.use_model(backend, request_data["model"])
+                ollama_url = backend.get_api_url("generate")
+                try:
+                    response = await client.post(ollama_url, json=request_data, timeout=self.request_timeout)
+                    response_at = time.perf_counter()
+                    tracer.record("http_request", message_id, request_start, response_at, status=response.status_code)
+                finally:
+                    self.pool.release_model(backend, request_data["model"])
             
-            logger.info(f"Отправка запроса к Ollama API ({self.model}): {prompt[:100]}...")
-            logger.debug(f"Параметры запроса: {json.dumps(request_data)}")
+            if response.status_code != 200:
+                error_msg = f"Ollama API вернул ошибку {response.status_code}: {response.text}"
+                logger.error(error_msg)
+                return f"Ошибка API: {response.status_code} - {response.text}"
             
-            # Отправляем запрос
-            async with httpx.AsyncClient() as client:
-                # Увеличиваем таймаут для длинных запросов
-                response = await client.post(ollama_url, json=request_data, timeout=180.0)
+            # Обрабатываем ответ
+            try:
+                # Получаем текстовый ответ
+                text_response = response.text
+                logger.debug("Сырой ответ от Ollama API: %s", text_response)
                 
-                if response.status_code != 200:
-                    error_msg = f"Ollama API вернул ошибку {response.status_code}: {response.text}"
-                    logger.error(error_msg)
-                    return f"Ошибка API: {response.status_code} - {response.text}"
+                # Пытаемся разобрать JSON
+                data = json_codec.loads(response.content)
+                response_text = data.get("response", "")
                 
-                # Обрабатываем ответ
-                try:
-                    # Получаем текстовый ответ
-                    text_response = response.text
-                    logger.debug(f"Сырой ответ от Ollama API: {text_response}")
-                    
-                    # Пытаемся разобрать JSON
-                    data = json.loads(text_response)
-                    response_text = data.get("response", "")
-                    
-                    if not response_text:
-                        error_msg = "Пустой ответ от Ollama API"
-                        logger.error(error_msg)
-                        return error_msg
-                        
-                    logger.info(f"Получен ответ от Ollama API, длина: {len(response_text)} символов")
-                    
-                    return response_text
-                    
-                except json.JSONDecodeError as e:
-                    error_details = debug_json_error(text_response, e)
-                    error_msg = f"Ошибка декодирования JSON в ответе Ollama: {e}\n{error_details}"
+                if not response_text:
+                    error_msg = "Пустой ответ от Ollama API"
                     logger.error(error_msg)
-                    return f"Ошибка обработки ответа: {error_details}"
+                    return error_msg
+                    
+                logger.info(f"Получен ответ от Ollama API, длина: {len(response_text)} символов")
+                self.pool.mark_success(backend)
+                tracer.record_generation(message_id, data, response_at)
+                self.report_generation_stats(data, request_data["model"], MODE_NON_STREAM, message_id,
+                                             elapsed=time.perf_counter() - request_start, backend=backend,
+                                             prompt=None if turn and turn.context else request_data["prompt"])
+                if turn:
+                    self.session_store.complete_turn(turn, response_text, data, request_data["model"], MODE_NON_STREAM)
+                
+                if cache_key:
+                    self.response_cache.put(cache_key, response_text)
+                
+                return response_text
                 
-        except httpx.TimeoutException:
+            except json_codec.JSONDecodeError as e:
+                error_details = debug_json_error(text_response, e)
+                error_msg = f"Ошибка декодирования JSON в ответе Ollama: {e}\n{error_details}"
+                logger.error(error_msg)
+                return f"Ошибка обработки ответа: {error_details}"
+            
+        except httpx.TimeoutException as e:
+            if backend:
+                self.pool.mark_failure(backend, str(e) or type(e).__name__)
             error_msg = "Время ожидания ответа от Ollama API истекло"
             logger.error(error_msg)
             return "Ошибка: таймаут при ожидании ответа от Ollama. Проверьте работу сервера и повторите запрос."
         
-        except httpx.ConnectError:
-            error_msg = f"Не удалось подключиться к Ollama API по адресу http://{self.host}:{self.port}"
+        except httpx.ConnectError as e:
+            address = backend.name if backend else f"{self.host}:{self.port}"
+            if backend:
+                self.pool.mark_failure(backend, str(e))
+            error_msg = f"Не удалось подключиться к Ollama API по адресу http://{address}"
             logger.error(error_msg)
-            return f"Ошибка подключения к Ollama API. Убедитесь, что сервер Ollama запущен по адресу {self.host}:{self.port}."
+            return f"Ошибка подключения к Ollama API. Убедитесь, что сервер Ollama запущен по адресу {address}."
         
         except Exception as e:
             error_msg = f"Неожиданная ошибка при обработке запроса к Ollama API: {str(e)}"
@@ -157,32 +465,104 @@ class OllamaClient:
             logger.debug(f"Трассировка ошибки:\n{traceback.format_exc()}")
             return f"Произошла ошибка при обработке запроса: {str(e)}"
             
-    async def prepare_stream_request(self, prompt, stream_handler, message_id=-1):
+    async def prepare_stream_request(self, prompt, stream_handler, message_id=-1, conversation_id=None, model=None,
+                                     max_tokens=None):
         """
         Подготовка и отправка потокового запроса к Ollama API
         
         :param prompt: Текст запроса
         :param stream_handler: Обработчик потокового режима для обработки данных
         :param message_id: ID сообщения для отслеживания
+        :param conversation_id: Идентификатор беседы для переиспользования контекста
+        :param model: Модель (если отличается от установленной по умолчанию)
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
+        :return: Полный собранный ответ
+        """
+        session = self.get_session(conversation_id)
+        if session is None:
+            if self.single_flight:
+                request_data = self.prepare_request_data(prompt, stream_mode=True, model=model, max_tokens=max_tokens)
+                key = self.single_flight.make_key(request_data)
+                return await self.single_flight.stream(
+                    key, message_id, stream_handler.websocket_handler,
+                    lambda sender: self._stream_request(prompt, stream_handler, message_id, sender=sender,
+                                                        request_data=request_data)
+                )
+            return await self._stream_request(prompt, stream_handler, message_id, model=model, max_tokens=max_tokens)
+        async with session.lock:
+            return await self._stream_request(prompt, stream_handler, message_id, session, model, max_tokens)
+    
+    async def _stream_request(self, prompt, stream_handler, message_id=-1, session=None, model=None, max_tokens=None,
+                              sender=None, request_data=None):
+        """
+        Выполнение потокового запроса
+        
+        :param prompt: Текст запроса
+        :param stream_handler: Обработчик потокового режима для обработки данных
+        :param message_id: ID сообщения для отслеживания
+        :param session: Объект Session или None
+        :param model: Модель (если отличается от установленной по умолчанию)
+        :param max_tokens: Ограничение длины ответа из сообщения покупателя
+        :param sender: Получатель фрагментов вместо websocket_handler (рассылка общей генерации)
+        :param request_data: Уже подготовленные данные запроса (None - подготовить здесь)
         :return: Полный собранный ответ
         """
         try:
-            # Получаем URL API и подготавливаем запрос для потокового режима
-            ollama_url = self.get_api_url("generate")
-            request_data = self.prepare_request_data(prompt, stream_mode=True)
+            # Подготавливаем запрос для потокового режима
+            if request_data is None:
+                request_data = self.prepare_request_data(prompt, stream_mode=True, model=model, max_tokens=max_tokens)
+            turn = self.apply_session(request_data, session, max_tokens)
+            
+            # Ответ из кэша отправляем через обычный путь потоковых фрагментов
+            cache_key = self.get_cache_key(request_data)
+            if cache_key:
+                cached_response = self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    logger.info(f"Ответ найден в кэше (messageId: {message_id})")
+                    return await stream_handler.replay_response(cached_response, message_id, sender)
             
-            logger.info(f"Отправка потокового запроса к Ollama API ({self.model}): {prompt[:100]}...")
-            logger.debug(f"Параметры запроса: {json.dumps(request_data)}")
+            def on_complete(full_response, final_data):
+                # Статистика генерации и сохранение ответа в кэш
+                self.pool.mark_success(backend)
+                self.report_generation_stats(final_data, request_data["model"], MODE_STREAM, message_id,
+                                             elapsed=time.perf_counter() - request_start, backend=backend,
+                                             prompt=None if turn and turn.context else request_data["prompt"])
+                if turn:
+                    self.session_store.complete_turn(turn, full_response, final_data, request_data["model"], MODE_STREAM)
+                if cache_key and full_response is not None:
+                    self.response_cache.put(cache_key, full_response)
             
-            # Вызываем обработчик потокового режима
-            return await stream_handler.process_stream(
-                ollama_url=ollama_url,
-                request_data=request_data,
-                message_id=message_id
-            )
+            logger.info(f"Отправка потокового запроса к Ollama API ({request_data['model']}): {request_data['prompt'][:100]}...")
+            self.count_context_window(request_data)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Параметры запроса: %s", json_codec.dumps(request_data))
+            
+            # Вызываем обработчик потокового режима на выбранном бэкенде
+            http_client = await self.open()
+            request_start = time.perf_counter()
+            async with self.pool.lease(request_data["model"]) as backend:
+                self.pool.use_model(backend, request_data["model"])
+                try:
+                    return await stream_handler.process_stream(
+                        ollama_url=backend.get_api_url("generate"),
+                        request_data=request_data,
+                        message_id=message_id,
+                        http_client=http_client,
+                        on_complete=on_complete,
+                        timeout=self.stream_timeout,
+                        # Полный текст нужен только беседам и кэшу ответов
+                        collect_response=bool(turn or cache_key),
+                        sender=sender,
+                        # Недоступный бэкенд исключается из маршрутизации, как и в непотоковом режиме
+                        on_failure=lambda reason: self.pool.mark_failure(backend, reason)
+                    )
+                finally:
+                    self.pool.release_model(backend, request_data["model"])
             
         except Exception as e:
             error_msg = f"Ошибка при подготовке потокового запроса: {str(e)}"
             logger.error(error_msg)
             logger.debug(f"Трассировка ошибки:\n{traceback.format_exc()}")
-            return f"Ошибка подготовки потокового запроса: {str(e)}" 
\ No newline at end of file
+            error_text = f"Ошибка подготовки потокового запроса: {str(e)}"
+            await stream_handler.send_stream_error(error_text, message_id, sender)
+            return error_text
\ No newline at end of file
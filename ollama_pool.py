@@ -0,0 +1,263 @@
+import asyncio
+import httpx
+from collections import Counter
+from contextlib import asynccontextmanager
+from config import (
+    logger, ROUTING_LEAST_IN_FLIGHT, ROUTING_MODEL_LOADED, DEFAULT_OLLAMA_ROUTING,
+    DEFAULT_HEALTH_CHECK_INTERVAL, DEFAULT_HEALTH_FAILURE_THRESHOLD
+)
+
+class OllamaBackend:
+    """Класс, описывающий один экземпляр Ollama API"""
+    
+    def __init__(self, host, port):
+        """
+        Инициализация описания бэкенда
+        
+        :param host: Хост API Ollama
+        :param port: Порт API Ollama
+        """
+        self.host = host
+        self.port = int(port)
+        self.base_url = f"http://{self.host}:{self.port}/api"
+        
+        self.in_flight = 0           # Количество выполняющихся запросов
+        self.healthy = True          # Бэкенд участвует в маршрутизации
+        self.failures = 0            # Количество неудачных проверок подряд
+        self.loaded_models = set()   # Модели, загруженные в память (по данным /api/ps)
+        self.active_models = Counter()  # Модели выполняющихся запросов
+    
+    @property
+    def name(self):
+        """Имя бэкенда в виде host:port"""
+        return f"{self.host}:{self.port}"
+    
+    def get_api_url(self, endpoint="generate"):
+        """
+        Получение URL API для запроса
+        
+        :param endpoint: API эндпоинт
+        :return: Полный URL API
+        """
+        return f"{self.base_url}/{endpoint}"
+    
+    def has_model(self, model):
+        """
+        Проверка, загружена ли модель на бэкенде
+        
+        :param model: Имя модели
+        :return: True, если модель загружена
+        """
+        # Модель выполняющегося запроса загружена или загружается, даже если /api/ps этого еще не показал
+        if self.active_models[model] > 0:
+            return True
+        # Ollama добавляет тег :latest к имени модели без тега
+        return model in self.loaded_models or f"{model}:latest" in self.loaded_models
+
+
+def parse_backends(value, default_host, default_port):
+    """
+    Разбор списка бэкендов из конфигурации
+    
+    Поддерживаются строки вида "host:port" и словари {"host": ..., "port": ...}.
+    
+    :param value: Значение ollama_backends из конфигурации
+    :param default_host: Хост, используемый при пустом списке
+    :param default_port: Порт по умолчанию
+    :return: Список объектов OllamaBackend
+    """
+    backends = []
+    for item in value or []:
+        if isinstance(item, dict):
+            backends.append(OllamaBackend(item.get("host", default_host), item.get("port", default_port)))
+        else:
+            host, _, port = str(item).rpartition(":")
+            if not host:
+                host, port = port, default_port
+            backends.append(OllamaBackend(host, port or default_port))
+    
+    if not backends:
+        backends.append(OllamaBackend(default_host, default_port))
+    return backends
+
+
+class OllamaBackendPool:
+    """Класс для маршрутизации запросов между несколькими экземплярами Ollama"""
+    
+    def __init__(self, backends, routing=DEFAULT_OLLAMA_ROUTING,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 failure_threshold=DEFAULT_HEALTH_FAILURE_THRESHOLD):
+        """
+        Инициализация пула бэкендов
+        
+        :param backends: Список объектов OllamaBackend
+        :param routing: Стратегия маршрутизации ("least_in_flight" или "model_loaded")
+        :param health_check_interval: Интервал фоновой проверки бэкендов в секундах
+        :param failure_threshold: Количество неудачных проверок подряд до исключения бэкенда
+        """
+        self.backends = list(backends)
+        if routing not in (ROUTING_LEAST_IN_FLIGHT, ROUTING_MODEL_LOADED):
+            logger.warning(f"Неизвестная стратегия маршрутизации {routing!r}, используется {DEFAULT_OLLAMA_ROUTING}")
+            routing = DEFAULT_OLLAMA_ROUTING
+        self.routing = routing
+        self.health_check_interval = health_check_interval
+        self.failure_threshold = failure_threshold
+        self._health_task = None
+        self._checks = set()
+    
+    def select(self, model):
+        """
+        Выбор бэкенда для запроса
+        
+        Среди работоспособных бэкендов выбирается бэкенд с наименьшим числом
+        выполняющихся запросов. В режиме "model_loaded" предпочтение отдается
+        бэкендам, на которых модель уже загружена.
+        
+        :param model: Имя модели
+        :return: Объект OllamaBackend
+        """
+        candidates = [backend for backend in self.backends if backend.healthy]
+        if not candidates:
+            logger.warning("Нет работоспособных бэкендов Ollama, используем все доступные")
+            candidates = self.backends
+        
+        if self.routing == ROUTING_MODEL_LOADED:
+            with_model = [backend for backend in candidates if backend.has_model(model)]
+            if with_model:
+                candidates = with_model
+        
+        return min(candidates, key=lambda backend: backend.in_flight)
+    
+    def has_model(self, model):
+        """
+        Проверка, загружена ли модель хотя бы на одном работоспособном бэкенде
+        
+        :param model: Имя модели
+        :return: True, если модель загружена
+        """
+        return any(backend.healthy and backend.has_model(model) for backend in self.backends)
+    
+    def use_model(self, backend, model):
+        """
+        Отметка о начале запроса к модели на бэкенде
+        
+        Модель считается загруженной с момента запроса: Ollama загрузит ее, если нужно.
+        
+        :param backend: Объект OllamaBackend
+        :param model: Имя модели
+        """
+        backend.active_models[model] += 1
+    
+    def release_model(self, backend, model):
+        """
+        Отметка о завершении запроса к модели на бэкенде
+        
+        :param backend: Объект OllamaBackend
+        :param model: Имя модели
+        """
+        backend.active_models[model] -= 1
+        if backend.active_models[model] <= 0:
+            del backend.active_models[model]
+        backend.loaded_models.add(model)
+    
+    def schedule_check(self, http_client, backend):
+        """
+        Внеочередная проверка /api/ps бэкенда в фоне
+        
+        :param http_client: Общий пул соединений httpx.AsyncClient
+        :param backend: Объект OllamaBackend
+        """
+        task = asyncio.create_task(self.check_backend(http_client, backend))
+        self._checks.add(task)
+        task.add_done_callback(self._checks.discard)
+    
+    @asynccontextmanager
+    async def lease(self, model):
+        """
+        Выбор бэкенда на время выполнения запроса
+        
+        :param model: Имя модели
+        :return: Объект OllamaBackend
+        """
+        backend = self.select(model)
+        backend.in_flight += 1
+        try:
+            yield backend
+        finally:
+            backend.in_flight -= 1
+    
+    def mark_failure(self, backend, reason=""):
+        """
+        Учет неудачного обращения к бэкенду
+        
+        :param backend: Объект OllamaBackend
+        :param reason: Описание ошибки для журнала
+        """
+        backend.failures += 1
+        if backend.healthy and backend.failures >= self.failure_threshold:
+            backend.healthy = False
+            logger.warning(f"Бэкенд Ollama {backend.name} исключен из маршрутизации: {reason}")
+    
+    def mark_success(self, backend):
+        """
+        Учет успешного обращения к бэкенду
+        
+        :param backend: Объект OllamaBackend
+        """
+        backend.failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            logger.info(f"Бэкенд Ollama {backend.name} снова доступен")
+    
+    async def check_backend(self, http_client, backend):
+        """
+        Проверка бэкенда и обновление списка загруженных моделей через /api/ps
+        
+        :param http_client: Общий пул соединений httpx.AsyncClient
+        :param backend: Объект OllamaBackend
+        """
+        try:
+            response = await http_client.get(backend.get_api_url("ps"), timeout=5.0)
+            response.raise_for_status()
+            models = response.json().get("models", [])
+            backend.loaded_models = {model.get("name") or model.get("model") for model in models}
+            self.mark_success(backend)
+        except (httpx.HTTPError, ValueError) as e:
+            self.mark_failure(backend, str(e) or type(e).__name__)
+    
+    async def check_all(self, http_client):
+        """
+        Проверка всех бэкендов
+        
+        :param http_client: Общий пул соединений httpx.AsyncClient
+        """
+        await asyncio.gather(*(self.check_backend(http_client, backend) for backend in self.backends))
+    
+    async def _health_loop(self, http_client):
+        """Фоновая периодическая проверка бэкендов"""
+        while True:
+            await self.check_all(http_client)
+            await asyncio.sleep(self.health_check_interval)
+    
+    def start(self, http_client):
+        """
+        Запуск фоновых проверок бэкендов
+        
+        :param http_client: Общий пул соединений httpx.AsyncClient
+        """
+        if self._health_task is None and self.health_check_interval > 0:
+            self._health_task = asyncio.create_task(self._health_loop(http_client))
+            logger.info(f"Запущена проверка бэкендов Ollama: {', '.join(b.name for b in self.backends)} "
+                        f"(маршрутизация: {self.routing})")
+    
+    async def stop(self):
+        """Остановка фоновых проверок бэкендов"""
+        for task in list(self._checks):
+            task.cancel()
+        if self._health_task:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
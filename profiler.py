@@ -0,0 +1,148 @@
+"""
+Профилирование работающего процесса (--profile и сигнал SIGUSR1)
+
+В течение заданного окна отдельный поток снимает стек потока цикла событий
+с фиксированным интервалом, а tracemalloc отслеживает выделения памяти.
+По окончании окна в каталог журналов записываются:
+
+- profile-<время>-<pid>.folded - стеки в формате flamegraph.pl / speedscope;
+- profile-<время>-<pid>.txt - самые частые функции и прирост памяти по строкам кода.
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import tracemalloc
+from collections import Counter
+
+from config import logger
+
+# Сколько строк выводить в сводке профиля
+PROFILE_TOP = 25
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик процессора для одного потока"""
+
+    def __init__(self, interval, thread_id=None):
+        """
+        :param interval: Интервал снятия стека в секундах
+        :param thread_id: Идентификатор профилируемого потока (по умолчанию - текущий)
+        """
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запуск потока, снимающего стеки"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановка потока"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def folded(self):
+        """Стеки в свернутом формате: "корень;...;функция количество" """
+        return [";".join(stack) + f" {count}" for stack, count in self.stacks.most_common()]
+
+    def top(self, limit=PROFILE_TOP):
+        """
+        Самые частые функции
+
+        :param limit: Количество строк
+        :return: Два списка пар (функция, сэмплы): по собственному времени и с вложенными вызовами
+        """
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        return own.most_common(limit), total.most_common(limit)
+
+
+async def run_profile(duration, output_dir, interval, memory_frames):
+    """
+    Профилирование процесса в течение окна
+
+    Вызывается из цикла событий: профилируется поток, в котором он работает.
+
+    :param duration: Длительность окна в секундах
+    :param output_dir: Каталог для файлов профиля
+    :param interval: Интервал снятия стека в секундах
+    :param memory_frames: Глубина стека, запоминаемого tracemalloc для каждого выделения
+    :return: Пути к файлам (свернутые стеки, сводка)
+    """
+    logger.info(f"Профилирование на {duration} сек (интервал {interval * 1000:.0f} мс)")
+    profiler = SamplingProfiler(interval)
+    # Если tracemalloc уже запущен (например, PYTHONTRACEMALLOC), он не останавливается
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(memory_frames)
+    memory_before = tracemalloc.take_snapshot()
+    profiler.start()
+    started = time.perf_counter()
+    cancelled = False
+    try:
+        await asyncio.sleep(duration)
+    except asyncio.CancelledError:
+        # При остановке клиента записывается то, что успели собрать
+        cancelled = True
+    profiler.stop()
+    elapsed = time.perf_counter() - started
+    memory_after = tracemalloc.take_snapshot()
+    # Выделения самого профилировщика в сводку не попадают
+    own_allocations = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    memory_before = memory_before.filter_traces(own_allocations)
+    memory_after = memory_after.filter_traces(own_allocations)
+    current, peak = tracemalloc.get_traced_memory()
+    if started_tracemalloc:
+        tracemalloc.stop()
+
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+    folded_path, summary_path = base + ".folded", base + ".txt"
+    with open(folded_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(profiler.folded()) + "\n")
+
+    lines = [f"Окно: {elapsed:.1f} сек, сэмплов: {profiler.samples} (интервал {interval * 1000:.0f} мс)"]
+    own, total = profiler.top()
+    for title, functions in (("Процессор, собственное время функции:", own),
+                             ("Процессор, вместе с вложенными вызовами:", total)):
+        lines += ["", title]
+        for function, samples in functions:
+            lines.append(f"  {samples:6d} {samples / max(1, profiler.samples) * 100:5.1f}%  {function}")
+    lines += ["", f"Память: отслеживается {current / 2**20:.1f} МБ, пик {peak / 2**20:.1f} МБ",
+              "Прирост за окно по строкам кода:"]
+    for stat in memory_after.compare_to(memory_before, "lineno")[:PROFILE_TOP]:
+        lines.append(f"  {stat}")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+    logger.info(f"Профиль записан: {summary_path}, стеки для flamegraph: {folded_path}")
+    if cancelled:
+        raise asyncio.CancelledError()
+    return folded_path, summary_path
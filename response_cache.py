@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from config import logger
+
+# Поля запроса, которые не влияют на текст ответа и не входят в ключ кэша
+NON_KEY_FIELDS = ("stream", "keep_alive", "keep_alive_timeout", "context")
+
+class ResponseCache:
+    """Класс для кэширования ответов Ollama на точно совпадающие запросы"""
+    
+    def __init__(self, path, max_entries=1000, ttl=86400, allow_sampled=False, save_interval=60):
+        """
+        Инициализация кэша ответов
+        
+        :param path: Путь к файлу, в котором кэш сохраняется между запусками
+        :param max_entries: Максимальное количество записей (вытесняются давно неиспользуемые)
+        :param ttl: Время жизни записи в секундах
+        :param allow_sampled: Кэшировать ответы, полученные со случайной выборкой токенов
+        :param save_interval: Интервал фонового сохранения на диск в секундах
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.allow_sampled = allow_sampled
+        self.save_interval = save_interval
+        
+        self.entries = OrderedDict()  # ключ -> (время создания, текст ответа)
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self._save_task = None
+        self._stopping = asyncio.Event()
+        
+        self.load()
+    
+    @staticmethod
+    def get_options(request_data):
+        """
+        Получение параметров генерации из данных запроса
+        
+        :param request_data: Данные запроса к Ollama API
+        :return: Словарь параметров генерации
+        """
+        return request_data.get("options", request_data)
+    
+    def is_cacheable(self, request_data):
+        """
+        Проверка, можно ли кэшировать ответ на запрос
+        
+        Детерминированные запросы (temperature 0 или фиксированный seed) кэшируются
+        всегда, запросы со случайной выборкой - только если это разрешено явно.
+        Продолжения бесед с переданным context не кэшируются.
+        
+        :param request_data: Данные запроса к Ollama API
+        :return: True, если ответ можно кэшировать
+        """
+        # Продолжение беседы зависит от сохраненного контекста, а не только от текста запроса
+        if request_data.get("context"):
+            return False
+        options = self.get_options(request_data)
+        seed = options.get("seed")
+        deterministic = options.get("temperature") == 0 or (seed is not None and seed != -1)
+        return deterministic or self.allow_sampled
+    
+    @staticmethod
+    def make_key(request_data):
+        """
+        Формирование ключа кэша по модели, запросу и итоговым параметрам генерации
+        
+        :param request_data: Данные запроса к Ollama API
+        :return: Строковый ключ
+        """
+        key_data = {k: v for k, v in request_data.items() if k not in NON_KEY_FIELDS}
+        encoded = json.dumps(key_data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+    
+    def get(self, key):
+        """
+        Получение ответа из кэша
+        
+        :param key: Ключ кэша
+        :return: Текст ответа или None
+        """
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            del self.entries[key]
+            self.dirty = True
+            entry = None
+        
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, key, response):
+        """
+        Сохранение ответа в кэш
+        
+        :param key: Ключ кэша
+        :param response: Текст ответа
+        """
+        if not response:
+            return
+        self.entries[key] = (time.time(), response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        # На диск запись попадает из фоновой задачи, а не из обработки запроса
+        self.dirty = True
+    
+    def stats(self):
+        """
+        Статистика работы кэша
+        
+        :return: Словарь с количеством записей, попаданий и промахов
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+    
+    def load(self):
+        """Загрузка кэша с диска"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Не удалось загрузить кэш ответов из {self.path}: {str(e)}")
+            return
+        
+        now = time.time()
+        for key, created, response in data.get("entries", []):
+            if now - created <= self.ttl:
+                self.entries[key] = (created, response)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.hits = data.get("hits", 0)
+        self.misses = data.get("misses", 0)
+        logger.info(f"Загружен кэш ответов: {len(self.entries)} записей")
+    
+    def snapshot(self):
+        """
+        Снимок кэша для записи на диск
+        
+        Выполняется в цикле событий, чтобы запись в отдельном потоке не видела
+        изменяющийся словарь записей.
+        
+        :return: Данные для сохранения или None, если с прошлого сохранения ничего не изменилось
+        """
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": [[key, created, response] for key, (created, response) in self.entries.items()]
+        }
+    
+    def write(self, data):
+        """
+        Запись снимка кэша на диск
+        
+        :param data: Результат snapshot()
+        :return: True, если запись удалась
+        """
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            logger.debug(f"Кэш ответов сохранен: {len(data['entries'])} записей")
+            return True
+        except OSError as e:
+            logger.error(f"Не удалось сохранить кэш ответов в {self.path}: {str(e)}")
+            return False
+    
+    def save(self):
+        """Сохранение кэша на диск"""
+        data = self.snapshot()
+        if data is not None and not self.write(data):
+            self.dirty = True
+    
+    async def save_async(self):
+        """Сохранение кэша на диск без блокировки цикла событий"""
+        data = self.snapshot()
+        if data is not None and not await asyncio.to_thread(self.write, data):
+            self.dirty = True
+    
+    async def _save_loop(self):
+        """Периодическое сохранение измененного кэша до вызова stop()"""
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.save_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.save_async()
+    
+    def start(self):
+        """Запуск фонового сохранения"""
+        if self._save_task is None and self.save_interval > 0:
+            self._stopping.clear()
+            self._save_task = asyncio.create_task(self._save_loop())
+    
+    async def stop(self):
+        """Остановка фонового сохранения и запись последних изменений"""
+        if self._save_task:
+            # Задача дописывает начатое сохранение и сохраняет последние изменения сама
+            self._stopping.set()
+            await self._save_task
+            self._save_task = None
+        else:
+            await self.save_async()
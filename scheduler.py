@@ -0,0 +1,512 @@
+import time
+import asyncio
+from collections import Counter
+from config import (
+    logger, DEFAULT_MAX_CONCURRENT_REQUESTS, DEFAULT_SCHEDULER_MAX_WAIT,
+    DEFAULT_BUYER_RATE_LIMIT, DEFAULT_BUYER_RATE_BURST, DEFAULT_MODEL,
+    DEFAULT_ADAPTIVE_MIN_CONCURRENCY, DEFAULT_ADAPTIVE_MAX_CONCURRENCY, DEFAULT_ADAPTIVE_LATENCY_TARGET,
+    DEFAULT_ADAPTIVE_COOLDOWN, DEFAULT_SCHEDULER_MODEL_AFFINITY
+)
+from metrics import MODE_STREAM, MODE_NON_STREAM, QUEUE_WAIT_SECONDS, CONCURRENCY_LIMIT
+from tracing import tracer
+
+# Поля buyer_message, в которых может передаваться идентификатор покупателя
+BUYER_ID_FIELDS = ("buyerId", "buyer_id", "userId")
+ANONYMOUS_BUYER = "anonymous"
+
+
+class QueuedRequest:
+    """Запрос покупателя, ожидающий обработки"""
+    
+    __slots__ = ("message", "message_id", "buyer_id", "model", "priority", "prompt_size", "enqueued_at",
+                 "dispatched_at", "finish_tag")
+    
+    def __init__(self, message, model=DEFAULT_MODEL):
+        """
+        :param message: Сообщение buyer_message
+        :param model: Модель, которой будет обработан запрос
+        """
+        self.message = message
+        self.message_id = message.get("messageId", -1)
+        self.buyer_id = next((str(message[f]) for f in BUYER_ID_FIELDS if message.get(f) is not None), ANONYMOUS_BUYER)
+        self.model = model
+        try:
+            self.priority = float(message.get("priority", 0) or 0)
+        except (TypeError, ValueError):
+            self.priority = 0.0
+        self.prompt_size = len(message.get("content") or "")
+        self.enqueued_at = time.monotonic()
+        self.dispatched_at = None
+        self.finish_tag = None  # Виртуальное время завершения в политике fair
+    
+    @property
+    def queue_wait(self):
+        """Время ожидания в очереди в секундах"""
+        end = self.dispatched_at if self.dispatched_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+
+class TokenBucket:
+    """Ограничение частоты запросов покупателя по алгоритму token bucket"""
+    
+    def __init__(self, rate, burst):
+        """
+        :param rate: Скорость пополнения (запросов в секунду)
+        :param burst: Емкость корзины (максимальная пачка запросов)
+        """
+        self.rate = rate
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+    
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def wait_time(self, now):
+        """Через сколько секунд будет доступен один токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+    
+    def consume(self, now):
+        """Списание одного токена"""
+        self._refill(now)
+        self.tokens -= 1.0
+    
+    def is_full(self, now):
+        """Корзина полна: она ничем не отличается от новой"""
+        return self.tokens + (now - self.updated_at) * self.rate >= self.burst
+
+
+class FifoPolicy:
+    """Обработка запросов в порядке поступления"""
+    
+    name = "fifo"
+    
+    def select(self, candidates):
+        return min(candidates, key=lambda request: request.enqueued_at)
+    
+    def on_dispatch(self, request):
+        pass
+
+
+class FairPolicy:
+    """
+    Справедливое распределение между покупателями (weighted fair queuing)
+    
+    Каждый покупатель получает долю обработки, пропорциональную его весу.
+    При равных весах это циклический обход покупателей. Виртуальное время
+    завершения назначается запросу один раз, когда политика впервые его видит,
+    поэтому покупатель с большим весом не может бесконечно опережать остальных.
+    """
+    
+    name = "fair"
+    
+    def __init__(self, weights=None):
+        """
+        :param weights: Словарь весов покупателей {buyer_id: вес}, по умолчанию вес 1
+        """
+        self.weights = weights or {}
+        self.virtual_time = 0.0
+        self.finish_times = {}
+    
+    def _cost(self, buyer_id):
+        return 1.0 / max(float(self.weights.get(buyer_id, 1.0)), 1e-6)
+    
+    def _tag(self, request):
+        """Виртуальное время завершения запроса"""
+        if request.finish_tag is None:
+            start = max(self.virtual_time, self.finish_times.get(request.buyer_id, 0.0))
+            request.finish_tag = self.finish_times[request.buyer_id] = start + self._cost(request.buyer_id)
+        return request.finish_tag
+    
+    def select(self, candidates):
+        return min(candidates, key=lambda request: (self._tag(request), request.enqueued_at))
+    
+    def on_dispatch(self, request):
+        self.virtual_time = max(self.virtual_time, self._tag(request) - self._cost(request.buyer_id))
+        # Покупатели, отставшие от виртуального времени, эквивалентны новым
+        if len(self.finish_times) > 1024:
+            self.finish_times = {b: t for b, t in self.finish_times.items() if t > self.virtual_time}
+
+
+class PriorityPolicy:
+    """Обработка запросов по убыванию поля priority, при равенстве - по времени поступления"""
+    
+    name = "priority"
+    
+    def select(self, candidates):
+        return min(candidates, key=lambda request: (-request.priority, request.enqueued_at))
+    
+    def on_dispatch(self, request):
+        pass
+
+
+class ShortestPromptFirstPolicy:
+    """Первыми обрабатываются запросы с самым коротким текстом"""
+    
+    name = "shortest_prompt"
+    
+    def select(self, candidates):
+        return min(candidates, key=lambda request: (request.prompt_size, request.enqueued_at))
+    
+    def on_dispatch(self, request):
+        pass
+
+
+SCHEDULER_POLICIES = {
+    policy.name: policy for policy in (FifoPolicy, FairPolicy, PriorityPolicy, ShortestPromptFirstPolicy)
+}
+
+
+def create_policy(name, buyer_weights=None):
+    """
+    Создание политики планирования по имени
+    
+    :param name: Имя политики (fifo, fair, priority, shortest_prompt)
+    :param buyer_weights: Веса покупателей для политики fair
+    :return: Объект политики
+    """
+    policy_class = SCHEDULER_POLICIES.get(name)
+    if policy_class is None:
+        logger.warning(f"Неизвестная политика планирования '{name}', используется fifo")
+        policy_class = FifoPolicy
+    if policy_class is FairPolicy:
+        return FairPolicy(buyer_weights)
+    return policy_class()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Подстройка лимита параллельных запросов по наблюдаемой задержке (AIMD)
+    
+    Пока время до первого токена укладывается в целевое значение и все слоты
+    заняты, лимит растет примерно на единицу за "поколение" запросов. При
+    превышении цели лимит уменьшается в decrease_factor раз, но не чаще одного
+    раза за cooldown секунд, чтобы один медленный запрос не обрушил лимит.
+    """
+    
+    def __init__(self, initial_limit, min_limit=DEFAULT_ADAPTIVE_MIN_CONCURRENCY,
+                 max_limit=DEFAULT_ADAPTIVE_MAX_CONCURRENCY, latency_target=DEFAULT_ADAPTIVE_LATENCY_TARGET,
+                 decrease_factor=0.75, cooldown=DEFAULT_ADAPTIVE_COOLDOWN):
+        """
+        :param initial_limit: Начальный лимит
+        :param min_limit: Минимальный лимит
+        :param max_limit: Максимальный лимит
+        :param latency_target: Целевое время до первого токена в секундах
+        :param decrease_factor: Во сколько раз уменьшать лимит при превышении цели
+        :param cooldown: Минимальный интервал между уменьшениями лимита в секундах
+        """
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.last_decrease = 0.0
+    
+    @property
+    def current(self):
+        """Текущий целочисленный лимит"""
+        return max(self.min_limit, int(self.limit))
+    
+    def observe(self, latency, in_flight):
+        """
+        Учет задержки завершившегося запроса
+        
+        :param latency: Время до первого токена в секундах
+        :param in_flight: Количество выполняющихся запросов
+        """
+        previous = self.current
+        now = time.monotonic()
+        if latency > self.latency_target:
+            if now - self.last_decrease >= self.cooldown:
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                self.last_decrease = now
+        elif in_flight >= previous:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+        
+        if self.current != previous:
+            logger.info(f"Лимит параллельных запросов изменен: {previous} -> {self.current} "
+                        f"(задержка {latency:.2f} сек, цель {self.latency_target:.2f} сек)")
+        CONCURRENCY_LIMIT.set(self.current)
+
+
+class RequestScheduler:
+    """Планировщик запросов покупателей между приемом сообщений и их обработкой"""
+    
+    def __init__(self, processor=None, policy=None, max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 max_wait=DEFAULT_SCHEDULER_MAX_WAIT, rate_limit=DEFAULT_BUYER_RATE_LIMIT,
+                 rate_burst=DEFAULT_BUYER_RATE_BURST, default_model=DEFAULT_MODEL, limiter=None,
+                 model_affinity=DEFAULT_SCHEDULER_MODEL_AFFINITY, model_resident=None, model_resolver=None,
+                 is_rejected=None):
+        """
+        Инициализация планировщика
+        
+        :param processor: Корутина обработки сообщения
+        :param policy: Политика выбора следующего запроса (по умолчанию FIFO)
+        :param max_concurrent_requests: Глобальный лимит одновременно выполняемых запросов
+        :param max_wait: Запросы, ожидающие дольше этого времени (сек), обрабатываются вне очереди политики (0 - отключено)
+        :param rate_limit: Ограничение частоты запросов одного покупателя в секунду (0 - отключено)
+        :param rate_burst: Допустимая пачка запросов покупателя сверх ограничения частоты
+        :param default_model: Модель запросов, в которых она не указана
+        :param limiter: Адаптивный ограничитель AdaptiveConcurrencyLimiter (None - фиксированный лимит)
+        :param model_affinity: Выдавать первыми запросы к уже загруженным моделям
+        :param model_resident: Функция (модель), возвращающая True, если модель загружена в Ollama
+        :param model_resolver: Функция (поле model сообщения), возвращающая модель запроса или None, если она не разрешена
+        :param is_rejected: Функция (сообщение), возвращающая True, если запрос будет отклонен без генерации
+        """
+        self.processor = processor
+        self.policy = policy or FifoPolicy()
+        self.max_concurrent_requests = max(1, int(max_concurrent_requests))
+        self.max_wait = max_wait
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.default_model = default_model
+        self.limiter = limiter
+        self.model_affinity = model_affinity
+        self.model_resident = model_resident
+        self.model_resolver = model_resolver
+        self.is_rejected = is_rejected
+        
+        self.pending = []
+        self.running_models = Counter()
+        self.buckets = {}
+        self.buckets_checked_at = time.monotonic()
+        self.active_tasks = set()
+        self.in_flight = 0
+        
+        self._changed = asyncio.Event()
+        self._dispatch_task = None
+    
+    @property
+    def concurrency_limit(self):
+        """Текущий лимит одновременно выполняемых запросов"""
+        return self.limiter.current if self.limiter else self.max_concurrent_requests
+    
+    def observe_latency(self, latency):
+        """
+        Передача задержки завершившегося запроса адаптивному ограничителю
+        
+        :param latency: Время до первого токена в секундах
+        """
+        if self.limiter:
+            self.limiter.observe(latency, self.in_flight)
+            self._changed.set()
+    
+    @property
+    def queued_requests(self):
+        """Количество запросов в очереди"""
+        return len(self.pending)
+    
+    @property
+    def queued_messages(self):
+        """Сообщения в очереди по messageId"""
+        return {request.message_id: request.message for request in self.pending}
+    
+    def submit(self, message):
+        """
+        Постановка запроса в очередь
+        
+        :param message: Сообщение buyer_message
+        :return: Объект QueuedRequest или None, если запрос отклоняется без очереди
+        """
+        if self.is_rejected and self.is_rejected(message):
+            # Отказ отправляется сразу и не занимает слот генерации
+            self._start_rejection(message)
+            return None
+        model = message.get("model")
+        if self.model_resolver:
+            model = self.model_resolver(model)
+        request = QueuedRequest(message, model or self.default_model)
+        self.pending.append(request)
+        if self._dispatch_task is None or self._dispatch_task.done():
+            self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+        self._changed.set()
+        logger.debug("Запрос в очереди (messageId: %s, покупатель: %s, выполняется: %d, в очереди: %d)",
+                     request.message_id, request.buyer_id, self.in_flight, len(self.pending))
+        return request
+    
+    def reject_pending(self):
+        """
+        Передача всех ожидающих запросов на обработку вне очереди
+        
+        Используется, когда запросы будут отклонены (например, при штатной остановке клиента).
+        
+        :return: Количество переданных запросов
+        """
+        pending, self.pending = self.pending, []
+        for request in pending:
+            self._start_rejection(request.message)
+        self._changed.set()
+        return len(pending)
+    
+    def cancel(self, message_id=None):
+        """
+        Удаление запросов из очереди
+        
+        :param message_id: ID сообщения (None - удалить все запросы)
+        :return: True, если был удален хотя бы один запрос
+        """
+        before = len(self.pending)
+        self.pending = [r for r in self.pending if message_id is not None and r.message_id != message_id]
+        return len(self.pending) != before
+    
+    async def stop(self):
+        """Остановка планировщика и очистка очереди"""
+        self.cancel()
+        if self._dispatch_task:
+            self._dispatch_task.cancel()
+            try:
+                await self._dispatch_task
+            except asyncio.CancelledError:
+                pass
+            self._dispatch_task = None
+    
+    def _get_bucket(self, buyer_id):
+        bucket = self.buckets.get(buyer_id)
+        if bucket is None:
+            bucket = self.buckets[buyer_id] = TokenBucket(self.rate_limit, self.rate_burst)
+        return bucket
+    
+    def _evict_idle_buckets(self, now):
+        """
+        Удаление корзин покупателей, которые давно не присылали запросов
+        
+        Идентификатор покупателя задает сервер, поэтому корзины не должны копиться
+        без предела. Полная корзина ничем не отличается от новой, и ее можно удалить.
+        Проверка выполняется не чаще, чем наполняется пустая корзина.
+        
+        :param now: Текущее время time.monotonic()
+        :return: Количество удаленных корзин
+        """
+        # За это время наполняется пустая корзина
+        refill_time = max(1.0, float(self.rate_burst)) / self.rate_limit
+        if now - self.buckets_checked_at < refill_time:
+            return 0
+        self.buckets_checked_at = now
+        idle = [buyer_id for buyer_id, bucket in self.buckets.items() if bucket.is_full(now)]
+        for buyer_id in idle:
+            del self.buckets[buyer_id]
+        if idle:
+            logger.debug("Удалено корзин ограничения частоты: %d, осталось: %d", len(idle), len(self.buckets))
+        return len(idle)
+    
+    def _select(self, now):
+        """
+        Выбор следующего запроса
+        
+        :return: (запрос или None, через сколько секунд появится доступный по лимиту запрос)
+        """
+        candidates = self.pending
+        retry_after = None
+        if self.rate_limit > 0:
+            candidates = []
+            for request in self.pending:
+                wait = self._get_bucket(request.buyer_id).wait_time(now)
+                if wait <= 0:
+                    candidates.append(request)
+                elif retry_after is None or wait < retry_after:
+                    retry_after = wait
+        
+        if not candidates:
+            return None, retry_after
+        
+        # Защита от голодания: слишком долго ожидающие запросы идут первыми
+        if self.max_wait > 0:
+            starving = [r for r in candidates if now - r.enqueued_at >= self.max_wait]
+            if starving:
+                return min(starving, key=lambda request: request.enqueued_at), retry_after
+        
+        # Запросы к загруженным моделям идут первыми, чтобы Ollama реже переключала модели;
+        # остальные ждут не дольше max_wait
+        if self.model_affinity:
+            resident = [r for r in candidates if self._is_resident(r.model)]
+            if resident:
+                candidates = resident
+        
+        return self.policy.select(candidates), retry_after
+    
+    def _is_resident(self, model):
+        """
+        Проверка, загружена ли модель или будет загружена выполняющимися запросами
+        
+        :param model: Имя модели
+        :return: True, если запрос к модели не потребует ее загрузки
+        """
+        if self.running_models[model] > 0:
+            return True
+        return bool(self.model_resident and self.model_resident(model))
+    
+    def _dispatch_ready(self):
+        """
+        Запуск запросов, пока есть свободные слоты
+        
+        :return: Через сколько секунд проверить очередь повторно (None - ждать событий)
+        """
+        while self.pending and self.in_flight < self.concurrency_limit:
+            now = time.monotonic()
+            request, retry_after = self._select(now)
+            if request is None:
+                return retry_after
+            
+            self.pending.remove(request)
+            if self.rate_limit > 0:
+                self._get_bucket(request.buyer_id).consume(now)
+                self._evict_idle_buckets(now)
+            self.policy.on_dispatch(request)
+            request.dispatched_at = now
+            
+            self.in_flight += 1
+            self.running_models[request.model] += 1
+            task = asyncio.create_task(self._run(request))
+            self.active_tasks.add(task)
+            task.add_done_callback(self.active_tasks.discard)
+        return None
+    
+    async def _dispatch_loop(self):
+        """Цикл выдачи запросов на обработку"""
+        while True:
+            self._changed.clear()
+            retry_after = self._dispatch_ready()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=retry_after)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _start_rejection(self, message):
+        """Запуск обработки отклоняемого запроса отдельной задачей"""
+        task = asyncio.create_task(self._reject(message))
+        self.active_tasks.add(task)
+        task.add_done_callback(self.active_tasks.discard)
+    
+    async def _reject(self, message):
+        """Обработка запроса, который будет отклонен, вне очереди"""
+        try:
+            await self.processor(message)
+        except Exception as e:
+            logger.error(f"Ошибка при отклонении запроса (messageId: {message.get('messageId', -1)}): {str(e)}")
+    
+    async def _run(self, request):
+        """Обработка запроса с учетом времени ожидания в очереди"""
+        message = request.message
+        wait = request.queue_wait
+        tracer.record("queue", request.message_id, time.perf_counter() - wait, model=request.model,
+                      policy=self.policy.name)
+        QUEUE_WAIT_SECONDS.observe(
+            wait,
+            model=request.model,
+            mode=MODE_STREAM if message.get("stream", False) else MODE_NON_STREAM
+        )
+        logger.info(f"Запрос передан в обработку (messageId: {request.message_id}, покупатель: {request.buyer_id}, "
+                    f"модель: {request.model}, ожидание в очереди: {wait:.3f} сек, политика: {self.policy.name})")
+        try:
+            await self.processor(message)
+        except Exception as e:
+            logger.error(f"Ошибка в задаче обработки запроса (messageId: {request.message_id}): {str(e)}")
+        finally:
+            self.in_flight -= 1
+            self.running_models[request.model] -= 1
+            if self.running_models[request.model] <= 0:
+                del self.running_models[request.model]
+            self._changed.set()
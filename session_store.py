@@ -0,0 +1,225 @@
+import time
+import asyncio
+from collections import OrderedDict
+from config import logger, DEFAULT_SESSION_MAX_SESSIONS, DEFAULT_SESSION_MAX_TOKENS, DEFAULT_SESSION_TTL
+from metrics import SESSION_PROMPT_EVAL_SAVED_SECONDS, SESSION_REUSED_TOKENS, SESSION_TURNS
+
+# Поля buyer_message, в которых может передаваться идентификатор беседы
+CONVERSATION_ID_FIELDS = ("conversationId", "conversation_id", "sessionId")
+
+# Какую долю окна контекста может занимать сохраненный контекст
+CONTEXT_FILL_LIMIT = 0.9
+
+# Сколько символов может стоять между предыдущим запросом и ответом (подпись роли, переводы строк)
+RESPONSE_LABEL_LIMIT = 64
+
+
+def get_conversation_id(message):
+    """
+    Получение идентификатора беседы из сообщения покупателя
+    
+    :param message: Сообщение buyer_message
+    :return: Строковый идентификатор или None
+    """
+    for field in CONVERSATION_ID_FIELDS:
+        if message.get(field) is not None:
+            return str(message[field])
+    return None
+
+
+class Session:
+    """Состояние беседы: контекст Ollama и текст, который он покрывает"""
+    
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.context = None          # Массив context из последнего ответа Ollama
+        self.model = None            # Модель, которая вернула context
+        self.prompt = ""             # Полный текст последнего запроса покупателя
+        self.response = ""           # Текст последнего ответа
+        self.turns = 0
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()   # Ходы одной беседы выполняются по очереди
+    
+    @property
+    def size(self):
+        """Размер сохраненного контекста в токенах"""
+        return len(self.context) if self.context else 0
+    
+    def reset(self):
+        self.context = None
+        self.model = None
+        self.prompt = ""
+        self.response = ""
+
+
+class SessionTurn:
+    """Один ход беседы: что отправлено в Ollama вместо полного запроса"""
+    
+    __slots__ = ("session", "full_prompt", "prompt", "context")
+    
+    def __init__(self, session, full_prompt, prompt, context):
+        self.session = session
+        self.full_prompt = full_prompt
+        self.prompt = prompt
+        self.context = context
+
+
+class SessionStore:
+    """Хранилище бесед с вытеснением давно неиспользуемых (LRU) по числу бесед и объему контекста"""
+    
+    def __init__(self, max_sessions=DEFAULT_SESSION_MAX_SESSIONS, max_tokens=DEFAULT_SESSION_MAX_TOKENS,
+                 ttl=DEFAULT_SESSION_TTL):
+        """
+        Инициализация хранилища
+        
+        :param max_sessions: Максимальное число бесед
+        :param max_tokens: Максимальный суммарный размер контекстов всех бесед в токенах
+        :param ttl: Время жизни беседы без обращений в секундах
+        """
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.total_tokens = 0
+        self.evictions = 0
+    
+    def get(self, conversation_id):
+        """
+        Получение беседы (создается при первом обращении)
+        
+        :param conversation_id: Идентификатор беседы
+        :return: Объект Session
+        """
+        session = self.sessions.get(conversation_id)
+        if session is not None and time.monotonic() - session.last_used > self.ttl:
+            self._remove(conversation_id)
+            session = None
+        if session is None:
+            session = Session(conversation_id)
+            self.sessions[conversation_id] = session
+        else:
+            self.sessions.move_to_end(conversation_id)
+        session.last_used = time.monotonic()
+        self._evict()
+        return session
+    
+    def prepare_turn(self, session, prompt, num_ctx, model=None):
+        """
+        Определение части запроса, которую Ollama еще не обработала
+        
+        Если покупатель повторно присылает всю историю, из запроса убирается уже
+        обработанный префикс (предыдущий запрос и ответ на него), а вместо него
+        передается сохраненный context. Если присланный текст не продолжает
+        историю (история изменена или это другой разговор), сохраненный context
+        к нему не относится, и беседа начинается заново.
+        
+        :param session: Объект Session
+        :param prompt: Текст запроса покупателя
+        :param num_ctx: Размер окна контекста модели в токенах
+        :param model: Модель запроса (context другой модели не переиспользуется)
+        :return: Объект SessionTurn
+        """
+        if session.context and model and session.model and model != session.model:
+            logger.info(f"Беседа {session.conversation_id} продолжается моделью {model} вместо {session.model}, контекст сброшен")
+            self._forget_context(session)
+        
+        if session.context and session.size > num_ctx * CONTEXT_FILL_LIMIT:
+            logger.info(f"Контекст беседы {session.conversation_id} заполнил окно модели ({session.size} токенов), начинаем заново")
+            self._forget_context(session)
+        
+        if not session.context:
+            return SessionTurn(session, prompt, prompt, None)
+        
+        if session.prompt and prompt.startswith(session.prompt):
+            # Покупатель прислал всю историю: отправляем только новую часть
+            remainder = prompt[len(session.prompt):]
+            # Предыдущий ответ уже есть в context, вместе с подписью роли перед ним
+            response = session.response.strip()
+            position = remainder.find(response) if response else -1
+            if 0 <= position <= RESPONSE_LABEL_LIMIT:
+                remainder = remainder[position + len(response):]
+            remainder = remainder.strip()
+            if not remainder:
+                return SessionTurn(session, prompt, prompt, None)
+            return SessionTurn(session, prompt, remainder, session.context)
+        
+        head = session.prompt[:64]
+        if head and prompt.startswith(head):
+            logger.info(f"История беседы {session.conversation_id} изменилась, контекст сброшен")
+        else:
+            logger.info(f"Запрос не продолжает историю беседы {session.conversation_id}, контекст сброшен")
+        self._forget_context(session)
+        return SessionTurn(session, prompt, prompt, None)
+    
+    def complete_turn(self, turn, response, final_data, model, mode):
+        """
+        Сохранение контекста после успешного ответа и учет сэкономленного времени
+        
+        :param turn: Объект SessionTurn
+        :param response: Полный текст ответа (None, если он не сохранен)
+        :param final_data: Последний объект ответа Ollama
+        :param model: Имя модели
+        :param mode: Режим запроса (stream / non-stream)
+        :return: Оценка сэкономленного времени обработки запроса в секундах
+        """
+        session = turn.session
+        if response is None:
+            # Без текста ответа следующий запрос нельзя сопоставить с context
+            logger.info(f"Ответ в беседе {session.conversation_id} не сохранен целиком, контекст сброшен")
+            self._forget_context(session)
+            return 0.0
+        final_data = final_data or {}
+        context = final_data.get("context")
+        
+        self.total_tokens -= session.size
+        session.context = context or None
+        session.model = model
+        session.prompt = turn.full_prompt
+        session.response = response or ""
+        session.turns += 1
+        session.last_used = time.monotonic()
+        self.total_tokens += session.size
+        if session.conversation_id not in self.sessions:
+            self.sessions[session.conversation_id] = session
+        self.sessions.move_to_end(session.conversation_id)
+        self._evict()
+        
+        saved = 0.0
+        reused = len(turn.context) if turn.context else 0
+        prompt_eval_count = final_data.get("prompt_eval_count") or 0
+        prompt_eval_duration = (final_data.get("prompt_eval_duration") or 0) / 1e9
+        if reused and prompt_eval_count:
+            # Переиспользованные токены Ollama обработала бы с той же скоростью
+            saved = reused * prompt_eval_duration / prompt_eval_count
+            SESSION_PROMPT_EVAL_SAVED_SECONDS.observe(saved, model=model, mode=mode)
+            SESSION_REUSED_TOKENS.inc(reused, model=model, mode=mode)
+        SESSION_TURNS.inc(model=model, mode=mode, reused="true" if reused else "false")
+        
+        logger.info(f"Беседа {session.conversation_id}, ход {session.turns}: переиспользовано {reused} токенов "
+                    f"контекста, обработано {prompt_eval_count} новых, сэкономлено ~{saved:.3f} сек")
+        return saved
+    
+    def _forget_context(self, session):
+        self.total_tokens -= session.size
+        session.reset()
+    
+    def _remove(self, conversation_id):
+        session = self.sessions.pop(conversation_id, None)
+        if session is not None:
+            self.total_tokens -= session.size
+    
+    def _evict(self):
+        """Вытеснение давно неиспользуемых бесед при превышении лимитов"""
+        while self.sessions and (len(self.sessions) > self.max_sessions or self.total_tokens > self.max_tokens):
+            conversation_id = next(iter(self.sessions))
+            self._remove(conversation_id)
+            self.evictions += 1
+            logger.debug("Беседа %s вытеснена из хранилища", conversation_id)
+    
+    def stats(self):
+        """
+        Статистика хранилища
+        
+        :return: Словарь с количеством бесед, объемом контекста и вытеснений
+        """
+        return {"sessions": len(self.sessions), "tokens": self.total_tokens, "evictions": self.evictions}
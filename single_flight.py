@@ -0,0 +1,250 @@
+"""
+Объединение одинаковых запросов, выполняющихся одновременно (single-flight)
+
+Если запрос с той же моделью, текстом и итоговыми параметрами генерации
+приходит, пока первый еще выполняется (повтор со стороны сервера или
+несколько покупателей с одним вопросом), он присоединяется к идущей
+генерации, а не запускает новую. В потоковом режиме фрагменты рассылаются
+всем присоединенным messageId; опоздавший сначала получает уже отправленные
+фрагменты. Генерация выполняется отдельной задачей и прерывается, только
+когда отменены все ожидающие ее запросы.
+"""
+import asyncio
+from config import logger, DEFAULT_STREAM_MAX_RESPONSE_CHARS
+from response_cache import ResponseCache
+from metrics import MODE_STREAM, MODE_NON_STREAM, SINGLE_FLIGHT_JOINS
+from stream_replay import FRAME_BUFFERED
+
+
+class StreamSubscriber:
+    """Получатель фрагментов общей генерации"""
+
+    __slots__ = ("message_id", "sent", "lock", "catch_up")
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+        self.sent = 0  # Номер следующего фрагмента для отправки
+        self.lock = asyncio.Lock()
+        self.catch_up = None
+
+
+class StreamFanout:
+    """
+    Рассылка фрагментов одной потоковой генерации нескольким messageId
+
+    Передается в StreamHandler.process_stream вместо WebSocketHandler.
+    Отправленные фрагменты хранятся, чтобы опоздавшие получатели могли их
+    догнать; когда история превышает max_history_chars, присоединение
+    закрывается и история больше не хранится.
+    """
+
+    def __init__(self, websocket_handler, max_history_chars=DEFAULT_STREAM_MAX_RESPONSE_CHARS):
+        """
+        :param websocket_handler: Объект WebSocketHandler для отправки
+        :param max_history_chars: Максимальный размер истории фрагментов в символах (0 - без ограничения)
+        """
+        self.websocket_handler = websocket_handler
+        self.max_history_chars = max_history_chars
+        self.subscribers = []
+        self.history = []
+        self.base = 0  # Номер первого хранимого фрагмента
+        self.history_chars = 0
+        self.joinable = True
+        self.finished = False
+        self._retry = None
+
+    @property
+    def end(self):
+        """Номер следующего фрагмента"""
+        return self.base + len(self.history)
+
+    def attach(self, message_id):
+        """
+        Присоединение получателя
+
+        :param message_id: ID сообщения получателя
+        :return: Объект StreamSubscriber
+        """
+        subscriber = StreamSubscriber(message_id)
+        self.subscribers.append(subscriber)
+        if self.history:
+            subscriber.catch_up = asyncio.create_task(self._deliver(subscriber))
+        return subscriber
+
+    def detach(self, subscriber):
+        """Отсоединение получателя: ему больше не отправляются фрагменты"""
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        if subscriber.catch_up:
+            subscriber.catch_up.cancel()
+
+    async def _deliver(self, subscriber):
+        """
+        Отправка получателю всех еще не отправленных ему фрагментов по порядку
+
+        :return: False, если отправка не удалась (фрагмент будет отправлен позже);
+            FRAME_BUFFERED, если последний фрагмент ждет переподключения; иначе True
+        """
+        async with subscriber.lock:
+            status = True
+            while subscriber.sent < self.end and subscriber in self.subscribers:
+                text = self.history[subscriber.sent - self.base]
+                result = await self.websocket_handler.send_stream_chunk(text, subscriber.message_id)
+                if result is False:
+                    return False
+                status = FRAME_BUFFERED if result == FRAME_BUFFERED else True
+                subscriber.sent += 1
+            return status
+
+    async def send_stream_chunk(self, text, message_id=-1):
+        """
+        Отправка фрагмента всем получателям
+
+        :param text: Текст фрагмента
+        :param message_id: Не используется (фрагмент отправляется всем получателям)
+        :return: False, если фрагмент не удалось отправить ни одному получателю;
+            FRAME_BUFFERED, если он только сохранен до переподключения
+        """
+        # При повторной попытке тот же фрагмент не добавляется в историю еще раз
+        if text is not self._retry:
+            self.history.append(text)
+            self.history_chars += len(text)
+            if self.max_history_chars and self.history_chars > self.max_history_chars:
+                self.joinable = False
+        self._retry = None
+
+        delivered = not self.subscribers
+        buffered = False
+        for subscriber in list(self.subscribers):
+            result = await self._deliver(subscriber)
+            if result == FRAME_BUFFERED:
+                buffered = True
+            elif result:
+                delivered = True
+        if not delivered and not buffered:
+            self._retry = text
+            return False
+
+        if not self.joinable and all(subscriber.sent == self.end for subscriber in self.subscribers):
+            self.base = self.end
+            self.history.clear()
+        return True if delivered else FRAME_BUFFERED
+
+    async def send_stream_finished(self, message_id=-1, cancelled=False, error=None):
+        """
+        Досылка оставшихся фрагментов и сообщение о завершении потока каждому получателю
+
+        :param message_id: Не используется
+        :param cancelled: Признак того, что генерация была отменена
+        :param error: Описание ошибки, из-за которой поток завершен
+        :return: True
+        """
+        self.finished = True
+        self.joinable = False
+        for subscriber in list(self.subscribers):
+            if not await self._deliver(subscriber):
+                logger.warning(f"Не все фрагменты общей генерации отправлены (messageId: {subscriber.message_id})")
+            await self.websocket_handler.send_stream_finished(subscriber.message_id, cancelled, error)
+        return True
+
+
+class Flight:
+    """Выполняющаяся генерация и ожидающие ее запросы"""
+
+    __slots__ = ("key", "task", "fanout", "members")
+
+    def __init__(self, key, fanout=None):
+        self.key = key
+        self.task = None
+        self.fanout = fanout
+        self.members = 0
+
+
+class SingleFlight:
+    """Реестр выполняющихся генераций по ключу запроса"""
+
+    def __init__(self, max_history_chars=DEFAULT_STREAM_MAX_RESPONSE_CHARS):
+        """
+        :param max_history_chars: Сколько символов потокового ответа хранить для опоздавших получателей
+        """
+        self.max_history_chars = max_history_chars
+        self.flights = {}
+        self.joins = 0
+
+    @staticmethod
+    def make_key(request_data):
+        """
+        Ключ запроса: режим, модель, текст и итоговые параметры генерации
+
+        :param request_data: Данные запроса к Ollama API
+        :return: Строковый ключ
+        """
+        mode = MODE_STREAM if request_data.get("stream") else MODE_NON_STREAM
+        return f"{mode}:{ResponseCache.make_key(request_data)}"
+
+    async def run(self, key, message_id, factory):
+        """
+        Выполнение непотокового запроса или присоединение к такому же выполняющемуся
+
+        :param key: Ключ запроса
+        :param message_id: ID сообщения
+        :param factory: Функция без аргументов, возвращающая корутину генерации
+        :return: Результат генерации
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self._start(Flight(key), factory())
+        else:
+            self._joined(flight, message_id, MODE_NON_STREAM)
+        return await self._wait(flight)
+
+    async def stream(self, key, message_id, websocket_handler, factory):
+        """
+        Выполнение потокового запроса или присоединение к такому же выполняющемуся
+
+        :param key: Ключ запроса
+        :param message_id: ID сообщения
+        :param websocket_handler: Объект WebSocketHandler для отправки фрагментов
+        :param factory: Функция (sender), возвращающая корутину генерации, которая отправляет фрагменты через sender
+        :return: Результат генерации
+        """
+        flight = self.flights.get(key)
+        if flight is None or not flight.fanout.joinable:
+            # К генерации, которая уже не хранит историю, присоединиться нельзя
+            fanout = StreamFanout(websocket_handler, self.max_history_chars)
+            flight = self._start(Flight(key, fanout), factory(fanout))
+        else:
+            self._joined(flight, message_id, MODE_STREAM)
+        subscriber = flight.fanout.attach(message_id)
+        try:
+            return await self._wait(flight)
+        finally:
+            flight.fanout.detach(subscriber)
+
+    def _start(self, flight, coroutine):
+        """Запуск генерации отдельной задачей"""
+        flight.task = asyncio.create_task(coroutine)
+        self.flights[flight.key] = flight
+        flight.task.add_done_callback(lambda _: self._forget(flight))
+        return flight
+
+    def _joined(self, flight, message_id, mode):
+        self.joins += 1
+        SINGLE_FLIGHT_JOINS.inc(mode=mode)
+        logger.info(f"Такой же запрос уже выполняется, ответ будет общим (messageId: {message_id}, "
+                    f"ожидающих: {flight.members + 1})")
+
+    def _forget(self, flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    async def _wait(self, flight):
+        """Ожидание результата; генерация прерывается, когда ее перестали ждать все запросы"""
+        flight.members += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.members -= 1
+            if flight.members == 0 and not flight.task.done():
+                logger.info("Все запросы, ожидавшие общую генерацию, отменены, генерация прерывается")
+                flight.task.cancel()
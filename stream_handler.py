@@ -1,109 +1,388 @@
-import json
+import re
 import time
 import httpx
+import asyncio
 import traceback
-from config import logger
+from contextlib import AsyncExitStack
+from config import (
+    logger, DEFAULT_STREAM_COALESCE_MS, DEFAULT_STREAM_COALESCE_BYTES, DEFAULT_OLLAMA_STREAM_TIMEOUT,
+    DEFAULT_STREAM_MAX_RESPONSE_CHARS, DEFAULT_STREAM_QUEUE_HIGH_WATERMARK, DEFAULT_STREAM_QUEUE_LOW_WATERMARK,
+    DEFAULT_STREAM_STALL_TIMEOUT, DEFAULT_STREAM_MAX_LINE_BYTES
+)
+from chunk_coalescer import ChunkCoalescer
+from json_codec import JSONDecodeError, parse_chunk
+from ndjson_reader import iter_lines
+from stream_pipeline import StreamPipeline, StreamWriterError
+from stream_replay import FRAME_BUFFERED
+from tracing import tracer
+from metrics import (
+    MODE_STREAM, TIME_TO_FIRST_TOKEN, INTER_TOKEN_LATENCY, WEBSOCKET_SEND_SECONDS, STREAM_FRAMES_SAVED,
+    STREAM_QUEUE_DEPTH, STREAM_BACKPRESSURE_SECONDS, STREAM_WRITER_STALLS
+)
+
+# Пауза между повторными попытками отправить фрагмент в секундах
+SEND_RETRY_INTERVAL = 0.5
+
+class ResponseBuffer:
+    """Сборка полного текста потокового ответа с ограничением размера"""
+    
+    __slots__ = ("parts", "size", "max_chars", "truncated")
+    
+    def __init__(self, max_chars=DEFAULT_STREAM_MAX_RESPONSE_CHARS):
+        """
+        :param max_chars: Максимальный размер текста в символах (0 - без ограничения)
+        """
+        self.parts = []
+        self.size = 0
+        self.max_chars = max_chars
+        self.truncated = False
+    
+    def append(self, text):
+        """Добавление фрагмента; при превышении лимита собранный текст отбрасывается"""
+        if self.truncated:
+            return
+        self.size += len(text)
+        if self.max_chars and self.size > self.max_chars:
+            self.truncated = True
+            self.parts = []
+            return
+        self.parts.append(text)
+    
+    def text(self):
+        """Полный текст или None, если ответ превысил лимит"""
+        if self.truncated:
+            return None
+        return "".join(self.parts)
+
 
 class StreamHandler:
     """Класс для обработки потоковых запросов к Ollama API"""
     
-    def __init__(self, websocket_handler):
+    def __init__(self, websocket_handler, coalesce_ms=DEFAULT_STREAM_COALESCE_MS,
+                 coalesce_bytes=DEFAULT_STREAM_COALESCE_BYTES,
+                 max_response_chars=DEFAULT_STREAM_MAX_RESPONSE_CHARS,
+                 queue_high_watermark=DEFAULT_STREAM_QUEUE_HIGH_WATERMARK,
+                 queue_low_watermark=DEFAULT_STREAM_QUEUE_LOW_WATERMARK,
+                 stall_timeout=DEFAULT_STREAM_STALL_TIMEOUT,
+                 max_line_bytes=DEFAULT_STREAM_MAX_LINE_BYTES):
         """
         Инициализация обработчика потокового режима
         
         :param websocket_handler: Объект WebSocketHandler для отправки потоковых данных
+        :param coalesce_ms: Временное окно объединения токенов в мс (0 - каждый токен отдельным фреймом)
+        :param coalesce_bytes: Порог размера буфера объединения в байтах
+        :param max_response_chars: Максимальный размер собираемого полного ответа в символах (0 - без ограничения)
+        :param queue_high_watermark: Глубина очереди отправки, при которой чтение Ollama приостанавливается
+        :param queue_low_watermark: Глубина очереди отправки, при которой чтение Ollama продолжается
+        :param stall_timeout: Сколько секунд отправка может не продвигаться до прерывания генерации
+        :param max_line_bytes: Максимальная длина строки NDJSON от Ollama в байтах (0 - без ограничения)
         """
         self.websocket_handler = websocket_handler
+        self.coalesce_ms = coalesce_ms
+        self.coalesce_bytes = coalesce_bytes
+        self.max_response_chars = max_response_chars
+        self.queue_high_watermark = queue_high_watermark
+        self.queue_low_watermark = queue_low_watermark
+        self.stall_timeout = stall_timeout
+        self.max_line_bytes = max_line_bytes
+        self.frames_saved_total = 0
         
-    async def process_stream(self, ollama_url, request_data, message_id=-1):
+    async def process_stream(self, ollama_url, request_data, message_id=-1, http_client=None, on_complete=None,
+                             timeout=DEFAULT_OLLAMA_STREAM_TIMEOUT, collect_response=True, sender=None,
+                             on_failure=None):
         """
         Обработка потокового запроса к Ollama API
         
+        Строки NDJSON выделяются прямо из байтовых буферов ответа. Полный текст
+        собирается, только если он нужен (collect_response), и не больше
+        max_response_chars символов.
+        
+        Чтение Ollama и отправка в WebSocket выполняются разными задачами через
+        ограниченную очередь (StreamPipeline), поэтому медленная отправка не
+        задерживает чтение, пока очередь не заполнится. Если отправка не
+        продвигается stall_timeout секунд, генерация прерывается.
+        
         :param ollama_url: URL для запроса к Ollama API
         :param request_data: Данные запроса
         :param message_id: ID сообщения для отслеживания
-        :return: Полный ответ от Ollama API
+        :param http_client: Общий пул соединений httpx.AsyncClient (если не задан, создается временный)
+        :param on_complete: Функция (full_response, final_data), вызываемая после успешного завершения потока;
+                            full_response равен None, если текст не собирался или превысил лимит
+        :param timeout: Таймаут ожидания очередного фрагмента в секундах
+        :param collect_response: Собирать полный текст ответа
+        :param sender: Объект с методами send_stream_chunk и send_stream_finished (по умолчанию - websocket_handler)
+        :param on_failure: Функция (reason), вызываемая, если Ollama недоступна или не ответила вовремя
+        :return: Полный ответ от Ollama API (None, если текст не собирался или превысил лимит)
         """
+        sender = sender or self.websocket_handler
+        model = request_data.get("model", "")
+        observe_ttft = TIME_TO_FIRST_TOKEN.labels(model=model, mode=MODE_STREAM)
+        observe_inter_token = INTER_TOKEN_LATENCY.labels(model=model, mode=MODE_STREAM)
+        observe_send = WEBSOCKET_SEND_SECONDS.labels(model=model, mode=MODE_STREAM)
+        
+        pipeline = StreamPipeline(self.queue_high_watermark, self.queue_low_watermark, self.stall_timeout)
+        
+        async def send_chunk(text, chunk_message_id):
+            # Отправка фрагмента с замером задержки WebSocket; неудачная отправка
+            # повторяется (соединение может восстановиться), пока писатель не завис
+            while pipeline.error is None:
+                send_start = time.perf_counter()
+                result = await sender.send_stream_chunk(text, chunk_message_id)
+                if result == FRAME_BUFFERED:
+                    # Фрагмент ждет переподключения в буфере: время без соединения считается
+                    # временем без продвижения, и генерацию, которую некому получить, пора прервать
+                    if pipeline.blocked():
+                        pipeline.abort(StreamWriterError(f"Нет соединения с сервером дольше {self.stall_timeout} сек"))
+                        return False
+                    return result
+                if result is not False:
+                    if result:
+                        observe_send(time.perf_counter() - send_start)
+                        tracer.record("ws_send", chunk_message_id, send_start, chars=len(text))
+                    pipeline.progress()
+                    return result
+                if pipeline.blocked():
+                    pipeline.abort(StreamWriterError(f"Не удалось отправить фрагмент за {self.stall_timeout} сек"))
+                    break
+                await asyncio.sleep(SEND_RETRY_INTERVAL)
+            return False
+        
+        coalescer = None
+        if self.coalesce_ms > 0:
+            coalescer = ChunkCoalescer(
+                send_chunk=send_chunk,
+                message_id=message_id,
+                window_ms=self.coalesce_ms,
+                max_bytes=self.coalesce_bytes
+            )
+        
+        async def write_chunks():
+            # Писатель: отправка фрагментов из очереди в WebSocket
+            try:
+                while True:
+                    text = await pipeline.get()
+                    if text is None:
+                        return
+                    if coalescer:
+                        await coalescer.add(text)
+                    else:
+                        await send_chunk(text, message_id)
+                        logger.debug("Отправлен чанк (messageId: %s): %.50s...", message_id, text)
+            except Exception as e:
+                pipeline.abort(StreamWriterError(f"Ошибка отправки фрагментов: {e}"))
+        
+        writer = asyncio.create_task(write_chunks())
+        
         try:
             start_time = time.time()
-            full_response = ""
+            response_buffer = ResponseBuffer(self.max_response_chars) if collect_response else None
             bytes_received = 0
-            raw_chunks = 0
+            lines_received = 0
             json_chunks = 0
             text_chunks = 0
+            final_data = {}
+            last_token_time = None
             
             logger.info(f"Начало потоковой передачи (messageId: {message_id})")
             print(f"Начало потоковой передачи (messageId: {message_id})")
             
-            async with httpx.AsyncClient() as client:
-                async with client.stream('POST', ollama_url, json=request_data, timeout=30.0) as response:
+            async with AsyncExitStack() as stack:
+                client = http_client
+                if client is None:
+                    client = await stack.enter_async_context(httpx.AsyncClient())
+                
+                request_start = time.perf_counter()
+                async with client.stream('POST', ollama_url, json=request_data, timeout=timeout) as response:
+                    tracer.record("http_request", message_id, request_start, status=response.status_code)
                     response.raise_for_status()
                     
-                    async for line in response.aiter_lines():
-                        if line.strip():
-                            bytes_received += len(line.encode('utf-8'))
-                            raw_chunks += 1
+                    async for line in iter_lines(response.aiter_bytes(), self.max_line_bytes):
+                        lines_received += 1
+                        
+                        try:
+                            response_text, done, data = parse_chunk(line)
+                            json_chunks += 1
+                            
+                            # Последний объект потока содержит статистику генерации
+                            if done:
+                                final_data = data
+                                tracer.record_generation(message_id, data, time.perf_counter())
                             
-                            try:
-                                data = json.loads(line)
-                                json_chunks += 1
+                            if response_text is not None:
                                 
-                                if "response" in data:
-                                    response_text = data["response"]
+                                # Время до первого токена и интервал между токенами
+                                if response_text:
+                                    token_time = time.perf_counter()
+                                    if last_token_time is None:
+                                        observe_ttft(token_time - request_start)
+                                    else:
+                                        observe_inter_token(token_time - last_token_time)
+                                    last_token_time = token_time
+                                
+                                # Фильтруем специальные токены
+                                if response_text in ["<think>", "</think>"]:
+                                    continue
                                     
-                                    # Фильтруем специальные токены
-                                    if response_text in ["<think>", "</think>"]:
-                                        continue
-                                        
-                                    # Добавляем в полный ответ
-                                    full_response += response_text
+                                # Добавляем в полный ответ
+                                if response_buffer is not None:
+                                    response_buffer.append(response_text)
+                                
+                                # Передаем писателю непустой текст (при объединении - все токены)
+                                if response_text.strip():
+                                    text_chunks += 1
+                                    await pipeline.put(response_text)
+                                elif coalescer:
+                                    await pipeline.put(response_text)
                                     
-                                    # Обрабатываем только непустой текст
-                                    if response_text.strip():
-                                        text_chunks += 1
-                                        
-                                        # Отправляем чанк через WebSocket
-                                        await self.websocket_handler.send_stream_chunk(response_text, message_id)
-                                        
-                                        # Логируем каждый чанк
-                                        logger.debug(f"Отправлен чанк (messageId: {message_id}): {response_text[:50]}...")
-                                        
-                            except json.JSONDecodeError:
-                                # Если не JSON, но имеет текст, отправляем как есть
-                                if line.strip():
-                                    logger.debug(f"Отправка не-JSON строки: {line[:30]}...")
-                                    await self.websocket_handler.send_stream_chunk(line, message_id)
+                        except JSONDecodeError:
+                            # Если не JSON, но имеет текст, отправляем как есть
+                            text = line.decode("utf-8", "replace")
+                            logger.debug("Отправка не-JSON строки: %.30s...", text)
+                            await pipeline.put(text)
+                    
+                    # Объем данных по счетчику транспорта
+                    bytes_received = response.num_bytes_downloaded
+            
+            # Ждем, пока писатель отправит оставшиеся фрагменты
+            pipeline.close()
+            await pipeline.join(writer)
+            
+            # Отправляем остаток буфера до сообщения о завершении
+            if coalescer:
+                await coalescer.close()
                     
             # Финальная статистика
             elapsed_time = time.time() - start_time
-            logger.info(f"Поток завершен за {elapsed_time:.2f} сек. Получено {bytes_received} байт в {raw_chunks} сырых чанках")
+            logger.info(f"Поток завершен за {elapsed_time:.2f} сек. Получено {bytes_received} байт, {lines_received} строк NDJSON")
             logger.info(f"Обработано {json_chunks} JSON-объектов, отправлено {text_chunks} текстовых фрагментов")
+            self.report_pipeline(pipeline, model, message_id)
+            if coalescer:
+                self.frames_saved_total += coalescer.frames_saved
+                STREAM_FRAMES_SAVED.inc(coalescer.frames_saved, model=model)
+                logger.info(f"Объединение фрагментов: отправлено {coalescer.frames_out} фреймов вместо "
+                            f"{coalescer.tokens_in}, сэкономлено {coalescer.frames_saved} "
+                            f"(всего с запуска: {self.frames_saved_total})")
             print(f"\n✅ Потоковая передача завершена ({text_chunks} фрагментов за {elapsed_time:.2f} сек)")
             
             # Отправляем сообщение о завершении потока
-            finished_data = {
-                "type": "finished_message_stream",
-                "content": "",
-                "messageId": message_id,
-                "timestamp": int(time.time() * 1000)
-            }
-            await self.websocket_handler.websocket.send(json.dumps(finished_data))
-            logger.info(f"Отправлено сообщение о завершении потока (messageId: {message_id})")
+            with tracer.span("ws_send", message_id, finished=True):
+                await sender.send_stream_finished(message_id)
+            
+            full_response = response_buffer.text() if response_buffer is not None else None
+            if response_buffer is not None and response_buffer.truncated:
+                logger.warning(f"Ответ длиннее {self.max_response_chars} символов, полный текст не сохраняется (messageId: {message_id})")
+            
+            if on_complete:
+                # Поток уже завершен у покупателя: ошибка сохранения (кэш, беседа) не должна
+                # приводить ко второму завершающему фрейму с ошибкой
+                try:
+                    on_complete(full_response, final_data)
+                except Exception as e:
+                    logger.error(f"Ошибка при сохранении результата потока (messageId: {message_id}): {e}")
+                    logger.debug(f"Трассировка ошибки:\n{traceback.format_exc()}")
             
             return full_response
             
-        except httpx.TimeoutException:
+        except StreamWriterError as e:
+            # Выход из контекста запроса закрывает HTTP-поток, и Ollama прекращает генерацию
+            logger.warning(f"Генерация прервана: {e} (messageId: {message_id})")
+            STREAM_WRITER_STALLS.inc(model=model)
+            self.report_pipeline(pipeline, model, message_id)
+            error_text = f"Ошибка отправки потокового ответа: {e}"
+            
+        except httpx.TimeoutException as e:
             error_msg = "Таймаут при ожидании ответа от Ollama API в потоковом режиме"
             logger.error(error_msg)
-            return "Ошибка: время ожидания ответа от Ollama истекло. Возможно, запрос слишком сложный или модель недоступна."
+            if on_failure:
+                on_failure(str(e) or type(e).__name__)
+            error_text = "Ошибка: время ожидания ответа от Ollama истекло. Возможно, запрос слишком сложный или модель недоступна."
             
-        except httpx.ConnectError:
+        except httpx.ConnectError as e:
             error_msg = "Не удалось подключиться к Ollama API"
             logger.error(error_msg)
-            return "Ошибка подключения к Ollama. Убедитесь, что Ollama запущена и доступна."
+            if on_failure:
+                on_failure(str(e) or type(e).__name__)
+            error_text = "Ошибка подключения к Ollama. Убедитесь, что Ollama запущена и доступна."
             
         except Exception as e:
             error_msg = f"Ошибка при обработке потокового ответа от Ollama API: {str(e)}"
             logger.error(error_msg)
             logger.debug(f"Трассировка ошибки:\n{traceback.format_exc()}")
-            return f"Ошибка обработки потокового ответа: {str(e)}" 
\ No newline at end of file
+            error_text = f"Ошибка обработки потокового ответа: {str(e)}"
+        
+        finally:
+            writer.cancel()
+            if coalescer:
+                await coalescer.discard()
+        
+        # Писатель останавливается до завершающего фрейма, чтобы фрагмент не пришел после него
+        await asyncio.gather(writer, return_exceptions=True)
+        await self.send_stream_error(error_text, message_id, sender)
+        return error_text
+    
+    async def send_stream_error(self, error_text, message_id=-1, sender=None):
+        """
+        Завершение потока с ошибкой
+        
+        Без завершающего фрейма поток messageId остается открытым у сервера до
+        его таймаута, а буфер повторной отправки считает ответ незавершенным.
+        
+        :param error_text: Описание ошибки для покупателя
+        :param message_id: ID сообщения
+        :param sender: Объект с методами send_stream_chunk и send_stream_finished (по умолчанию - websocket_handler)
+        """
+        sender = sender or self.websocket_handler
+        try:
+            await sender.send_stream_finished(message_id, error=error_text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить сообщение об ошибке потока (messageId: {message_id}): {e}")
+    
+    def report_pipeline(self, pipeline, model, message_id):
+        """
+        Учет глубины очереди отправки и времени ожидания писателя для запроса
+        
+        :param pipeline: Объект StreamPipeline завершенного запроса
+        :param model: Имя модели
+        :param message_id: ID сообщения
+        """
+        STREAM_QUEUE_DEPTH.observe(pipeline.max_depth, model=model)
+        STREAM_BACKPRESSURE_SECONDS.observe(pipeline.stall_seconds, model=model)
+        if pipeline.stall_seconds:
+            logger.info(f"Очередь отправки (messageId: {message_id}): максимум {pipeline.max_depth} фрагментов, "
+                        f"чтение Ollama приостанавливалось на {pipeline.stall_seconds:.3f} сек")
+        else:
+            logger.debug("Очередь отправки (messageId: %s): максимум %d фрагментов", message_id, pipeline.max_depth)
+    
+    async def replay_response(self, text, message_id=-1, sender=None):
+        """
+        Отправка готового ответа (например, из кэша) так же, как потокового
+        
+        Текст разбивается на фрагменты по границам слов и проходит через обычный
+        путь отправки фрагментов, после чего отправляется сообщение о завершении потока.
+        
+        :param text: Текст ответа
+        :param message_id: ID сообщения
+        :param sender: Объект с методами send_stream_chunk и send_stream_finished (по умолчанию - websocket_handler)
+        :return: Отправленный текст
+        """
+        sender = sender or self.websocket_handler
+        logger.info(f"Воспроизведение готового ответа в потоковом режиме (messageId: {message_id})")
+        max_chunk = max(1, self.coalesce_bytes)
+        chunk = []
+        chunk_size = 0
+        frames = 0
+        for word in re.findall(r"\s*\S+(?:\s+$)?", text):
+            chunk.append(word)
+            chunk_size += len(word)
+            if chunk_size >= max_chunk:
+                await sender.send_stream_chunk("".join(chunk), message_id)
+                frames += 1
+                chunk.clear()
+                chunk_size = 0
+        if chunk:
+            await sender.send_stream_chunk("".join(chunk), message_id)
+            frames += 1
+        
+        await sender.send_stream_finished(message_id)
+        logger.debug("Готовый ответ отправлен %d фрагментами (messageId: %s)", frames, message_id)
+        return text
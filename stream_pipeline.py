@@ -0,0 +1,163 @@
+"""
+Очередь между чтением потока Ollama и отправкой фрагментов в WebSocket
+
+Чтение ответа Ollama и отправка фрагментов выполняются разными задачами.
+Читатель кладет фрагменты в ограниченную очередь и приостанавливается, когда
+она заполняется до верхней отметки, пока писатель не разберет ее до нижней.
+Если писатель не продвигается дольше stall_timeout секунд, генерация
+прерывается, чтобы не тратить время GPU на ответ, который некуда отправить.
+"""
+import time
+import asyncio
+from collections import deque
+
+
+class StreamWriterError(Exception):
+    """Писатель не может отправить фрагменты, генерацию нужно прервать"""
+
+
+class StreamStalled(StreamWriterError):
+    """Писатель не продвигается дольше допустимого времени"""
+
+
+class StreamPipeline:
+    """Ограниченная очередь фрагментов одного потокового ответа"""
+
+    def __init__(self, high_watermark, low_watermark, stall_timeout):
+        """
+        :param high_watermark: Глубина очереди, при которой читатель приостанавливается
+        :param low_watermark: Глубина очереди, при которой читатель продолжает работу
+        :param stall_timeout: Сколько секунд писатель может не продвигаться до прерывания генерации
+        """
+        self.high_watermark = max(1, int(high_watermark))
+        self.low_watermark = max(0, min(int(low_watermark), self.high_watermark - 1))
+        self.stall_timeout = stall_timeout
+        self.items = deque()
+        self.closed = False
+        self.error = None
+        self.paused = False
+        self.max_depth = 0
+        self.stall_seconds = 0.0
+        self.last_progress = time.monotonic()
+        self.blocked_since = None
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    @property
+    def depth(self):
+        """Текущая глубина очереди"""
+        return len(self.items)
+
+    def blocked(self):
+        """
+        Отметка о неудачной отправке фрагмента писателем
+
+        Время отсчитывается от первой неудачной отправки после последней успешной,
+        а не от последней успешной: ожидание следующего токена (например, пока
+        модель обрабатывает запрос) не считается временем без продвижения.
+
+        :return: True, если писатель не может отправить фрагменты дольше stall_timeout
+        """
+        now = time.monotonic()
+        if self.blocked_since is None:
+            self.blocked_since = now
+        return now - self.blocked_since > self.stall_timeout
+
+    def progress(self):
+        """Отметка об успешной отправке фрагмента писателем"""
+        self.last_progress = time.monotonic()
+        self.blocked_since = None
+
+    async def put(self, item):
+        """
+        Добавление фрагмента; при заполнении очереди ожидание писателя
+
+        :param item: Фрагмент
+        :raises StreamWriterError: Если писатель завис или генерация прервана
+        """
+        if self.error is not None:
+            raise self.error
+        self.items.append(item)
+        depth = len(self.items)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        self._readable.set()
+        if depth >= self.high_watermark:
+            self.paused = True
+            self._writable.clear()
+            await self._wait_writable()
+
+    async def _wait_writable(self):
+        """Ожидание, пока писатель разберет очередь до нижней отметки"""
+        # Время ожидания отсчитывается от момента заполнения очереди
+        self.progress()
+        started = time.monotonic()
+        try:
+            while not self._writable.is_set():
+                remaining = self.last_progress + self.stall_timeout - time.monotonic()
+                if remaining <= 0:
+                    self.abort(StreamStalled(f"Отправка фрагментов не продвигается {self.stall_timeout} сек"))
+                    break
+                try:
+                    await asyncio.wait_for(self._writable.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.stall_seconds += time.monotonic() - started
+        if self.error is not None:
+            raise self.error
+
+    async def get(self):
+        """
+        Получение следующего фрагмента писателем
+
+        :return: Фрагмент или None, если поток завершен или прерван
+        """
+        while not self.items:
+            if self.closed or self.error is not None:
+                return None
+            self._readable.clear()
+            await self._readable.wait()
+        item = self.items.popleft()
+        if self.paused and len(self.items) <= self.low_watermark:
+            self.paused = False
+            self._writable.set()
+        return item
+
+    def close(self):
+        """Завершение потока: писатель разберет оставшиеся фрагменты и остановится"""
+        self.closed = True
+        self._readable.set()
+
+    def abort(self, error):
+        """
+        Прерывание потока с ошибкой
+
+        :param error: Исключение StreamWriterError, которое получит читатель
+        """
+        if self.error is None:
+            self.error = error
+        self.items.clear()
+        self._readable.set()
+        self._writable.set()
+
+    async def join(self, writer_task):
+        """
+        Ожидание, пока писатель отправит оставшиеся фрагменты
+
+        :param writer_task: Задача писателя
+        :raises StreamWriterError: Если писатель завис или генерация прервана
+        """
+        self.progress()
+        while not writer_task.done():
+            remaining = self.last_progress + self.stall_timeout - time.monotonic()
+            if remaining <= 0:
+                writer_task.cancel()
+                self.abort(StreamStalled(f"Отправка фрагментов не продвигается {self.stall_timeout} сек"))
+                break
+            await asyncio.wait({writer_task}, timeout=remaining)
+        if self.error is not None:
+            raise self.error
+        # Исключение писателя передается читателю
+        writer_task.result()
@@ -0,0 +1,156 @@
+"""
+Буфер повторной отправки фрагментов ответов после переподключения
+
+Каждый фрейм ответа получает порядковый номер seq в пределах своего messageId
+и сохраняется в ограниченном буфере запроса. Фреймы, которые не удалось
+отправить, пока соединение было разорвано, отправляются после
+переподключения; сервер может запросить и уже отправленные фреймы, начиная
+с нужного номера (resume_request), и подтвердить получение (stream_ack).
+
+Возобновление включается, только если сервер подтвердил его при подключении:
+клиент добавляет к адресу параметр stream_resume=1, сервер отвечает заголовком
+X-Stream-Resume: 1. Ответы без messageId (-1) не нумеруются и не буферизуются.
+"""
+import time
+from collections import deque, OrderedDict
+from config import logger
+
+# Результат отправки фрейма: фрейм сохранен в буфере, но не отправлен, потому что соединения нет
+FRAME_BUFFERED = "buffered"
+
+# Согласование возобновления при подключении
+STREAM_RESUME_QUERY_PARAM = "stream_resume"
+STREAM_RESUME_HEADER = "X-Stream-Resume"
+
+# messageId ответов, не привязанных к запросу
+NO_MESSAGE_ID = -1
+
+
+class ReplayFrame:
+    """Сохраненный фрейм ответа"""
+
+    __slots__ = ("seq", "message", "sent")
+
+    def __init__(self, seq, message):
+        self.seq = seq
+        self.message = message
+        self.sent = False
+
+
+class ReplayStream:
+    """Фреймы одного ответа"""
+
+    __slots__ = ("message_id", "frames", "next_seq", "finished", "updated_at")
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+        self.frames = deque()
+        self.next_seq = 0
+        self.finished = False
+        self.updated_at = time.monotonic()
+
+    @property
+    def last_seq(self):
+        """Номер последнего записанного фрейма (-1, если фреймов не было)"""
+        return self.next_seq - 1
+
+    def unsent(self):
+        """Фреймы, которые еще не удалось отправить"""
+        return [frame for frame in self.frames if not frame.sent]
+
+
+class ReplayBuffer:
+    """Буферы повторной отправки всех выполняющихся и недавно завершенных ответов"""
+
+    def __init__(self, max_frames, ttl):
+        """
+        :param max_frames: Максимальное число хранимых фреймов одного ответа
+        :param ttl: Сколько секунд хранить фреймы ответа после последнего фрейма
+        """
+        self.max_frames = max(1, int(max_frames))
+        self.ttl = ttl
+        self.streams = OrderedDict()
+
+    def record(self, message_id, message, final=False):
+        """
+        Присвоение фрейму номера и сохранение его в буфере
+
+        Уже отправленные фреймы вытесняются при заполнении буфера. Если буфер
+        заполнен неотправленными фреймами, новый фрейм не принимается.
+
+        :param message_id: ID сообщения
+        :param message: Словарь фрейма (в него добавляется поле seq)
+        :param final: Последний фрейм ответа
+        :return: Объект ReplayFrame или None, если буфер заполнен
+        """
+        stream = self.streams.get(message_id)
+        if stream is None:
+            self._expire()
+            stream = self.streams[message_id] = ReplayStream(message_id)
+        frames = stream.frames
+        while len(frames) >= self.max_frames:
+            if not frames[0].sent:
+                return None
+            frames.popleft()
+        message["seq"] = stream.next_seq
+        frame = ReplayFrame(stream.next_seq, message)
+        stream.next_seq += 1
+        frames.append(frame)
+        stream.updated_at = time.monotonic()
+        if final:
+            stream.finished = True
+        return frame
+
+    def ack(self, message_id, seq):
+        """
+        Удаление фреймов, получение которых подтвердил сервер
+
+        :param message_id: ID сообщения
+        :param seq: Номер последнего полученного фрейма
+        """
+        stream = self.streams.get(message_id)
+        if stream is None:
+            return
+        frames = stream.frames
+        while frames and frames[0].seq <= seq:
+            frames.popleft()
+        if stream.finished and not frames:
+            del self.streams[message_id]
+
+    def frames_from(self, message_id, from_seq):
+        """
+        Фреймы ответа, начиная с заданного номера
+
+        :param message_id: ID сообщения
+        :param from_seq: Номер первого нужного фрейма
+        :return: (список ReplayFrame, номер первого хранимого фрейма или None)
+        """
+        stream = self.streams.get(message_id)
+        if stream is None or not stream.frames:
+            return [], None
+        return [frame for frame in stream.frames if frame.seq >= from_seq], stream.frames[0].seq
+
+    def unsent(self):
+        """Неотправленные фреймы всех ответов в порядке номеров"""
+        return [frame for stream in self.streams.values() for frame in stream.unsent()]
+
+    def summary(self):
+        """
+        Состояние ответов для сообщения resume_streams
+
+        :return: Список словарей messageId, lastSeq, finished
+        """
+        self._expire()
+        return [
+            {"messageId": stream.message_id, "lastSeq": stream.last_seq, "finished": stream.finished}
+            for stream in self.streams.values()
+        ]
+
+    def _expire(self):
+        """Удаление ответов, срок хранения которых истек"""
+        deadline = time.monotonic() - self.ttl
+        for message_id, stream in list(self.streams.items()):
+            if stream.updated_at < deadline:
+                if stream.unsent():
+                    logger.warning(f"Фреймы ответа (messageId: {message_id}) не были доставлены до истечения срока хранения")
+                del self.streams[message_id]
@@ -0,0 +1,291 @@
+"""
+Режим нескольких рабочих процессов (--workers N)
+
+Супервизор запускает N процессов OllamaProxyClient. У каждого свое
+WebSocket-соединение (с отдельным токеном из worker_tokens или общим),
+своя часть экземпляров Ollama из ollama_backends и свой планировщик.
+Упавшие процессы перезапускаются с растущей задержкой. Журналы процессов
+пишутся супервизором в общий файл, метрики объединяются в одну выдачу
+с меткой worker.
+"""
+import os
+import json
+import time
+import queue
+import signal
+import asyncio
+import logging
+import logging.handlers
+import multiprocessing
+
+from config import (
+    logger, setup_worker_logging, RESPONSE_CACHE_FILE,
+    DEFAULT_WORKER_RESTART_DELAY, DEFAULT_WORKER_RESTART_MAX_DELAY, DEFAULT_WORKER_STABLE_SECONDS,
+    DEFAULT_WORKER_METRICS_INTERVAL, DEFAULT_DRAIN_TIMEOUT
+)
+from metrics import metrics, merge_expositions, MetricsServer, WORKER_RESTARTS, WORKERS_ALIVE
+
+# Интервал проверки рабочих процессов в секундах
+SUPERVISOR_POLL_INTERVAL = 0.5
+# Сколько секунд ждать штатного завершения процессов при остановке
+WORKER_STOP_TIMEOUT = 10.0
+
+
+def worker_config(config, index, workers):
+    """
+    Конфигурация рабочего процесса
+
+    :param config: Общая конфигурация
+    :param index: Номер процесса, начиная с 0
+    :param workers: Количество процессов
+    :return: Копия конфигурации с токеном, экземплярами Ollama, файлами кэша и трассировки процесса
+    """
+    result = dict(config)
+    tokens = config.get("worker_tokens") or []
+    if tokens:
+        result["token"] = tokens[index % len(tokens)]
+
+    # Экземпляры Ollama делятся между процессами; если их меньше, чем процессов,
+    # каждому процессу достается один экземпляр
+    backends = config.get("ollama_backends") or []
+    if len(backends) >= workers:
+        result["ollama_backends"] = backends[index::workers]
+    elif backends:
+        result["ollama_backends"] = [backends[index % len(backends)]]
+
+    # Метрики отдает супервизор, а кэш ответов и трассировка у каждого процесса свои
+    result["metrics_port"] = 0
+    base, ext = os.path.splitext(config.get("response_cache_file", RESPONSE_CACHE_FILE))
+    result["response_cache_file"] = f"{base}.worker{index}{ext}"
+    if config.get("trace_file"):
+        base, ext = os.path.splitext(config["trace_file"])
+        result["trace_file"] = f"{base}.worker{index}{ext}"
+    return result
+
+
+def run_worker(index, workers, client_options, config, log_queue, metrics_queue, metrics_interval):
+    """
+    Точка входа рабочего процесса
+
+    :param index: Номер процесса
+    :param workers: Количество процессов
+    :param client_options: Параметры конструктора OllamaProxyClient
+    :param config: Конфигурация процесса
+    :param log_queue: Очередь записей журнала для супервизора
+    :param metrics_queue: Очередь снимков метрик для супервизора
+    :param metrics_interval: Интервал передачи метрик в секундах
+    """
+    from client import OllamaProxyClient
+
+    client = OllamaProxyClient(config=config, **client_options)
+    # Перечитанная конфигурация получает тот же токен и ту же часть экземпляров Ollama
+    client.config_transform = lambda new_config: worker_config(new_config, index, workers)
+    setup_worker_logging(log_queue, f"[worker {index}] ")
+    metrics.add_collector(client.collect_metrics)
+
+    async def publish_metrics():
+        while True:
+            await asyncio.sleep(metrics_interval)
+            metrics_queue.put((index, metrics.render()))
+
+    async def main():
+        # Супервизор останавливает процесс сигналом SIGTERM: до запуска клиента процесс
+        # прерывается сразу, после - клиент дожидается выполняющихся запросов (client.run)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        publisher = asyncio.create_task(publish_metrics())
+        try:
+            await client.run()
+        finally:
+            publisher.cancel()
+
+    # Ctrl+C в терминале получает вся группа процессов; останавливать рабочие
+    # процессы должен супервизор, поэтому SIGINT здесь игнорируется
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        logger.info("Рабочий процесс остановлен")
+
+
+class WorkerProcess:
+    """Состояние одного рабочего процесса"""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started_at = None
+        self.failures = 0
+        self.restart_at = 0.0
+
+
+class Supervisor:
+    """Запуск, перезапуск и остановка рабочих процессов"""
+
+    def __init__(self, config, workers, client_options, metrics_host=None, metrics_port=0, config_file=None):
+        """
+        :param config: Общая конфигурация (после настройки токена и модели)
+        :param workers: Количество рабочих процессов
+        :param client_options: Параметры конструктора OllamaProxyClient для рабочих процессов
+        :param metrics_host: Адрес сервера объединенных метрик
+        :param metrics_port: Порт сервера объединенных метрик (0 - отключен)
+        :param config_file: Файл конфигурации: запускаемые и перезапускаемые процессы получают его текущее содержимое
+        """
+        self.config = config
+        self.config_file = config_file
+        self.workers = [WorkerProcess(index) for index in range(workers)]
+        self.client_options = client_options
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.restart_delay = config.get("worker_restart_delay", DEFAULT_WORKER_RESTART_DELAY)
+        self.restart_max_delay = config.get("worker_restart_max_delay", DEFAULT_WORKER_RESTART_MAX_DELAY)
+        self.stable_seconds = config.get("worker_stable_seconds", DEFAULT_WORKER_STABLE_SECONDS)
+        self.metrics_interval = config.get("worker_metrics_interval", DEFAULT_WORKER_METRICS_INTERVAL)
+
+        # Процессы запускаются заново, без копии состояния супервизора
+        self.context = multiprocessing.get_context("spawn")
+        self.log_queue = self.context.Queue()
+        self.metrics_queue = self.context.Queue()
+        self.log_listener = None
+        self.metrics_server = None
+        self.snapshots = {}
+        self.stopping = False
+
+    def refresh_config(self):
+        """Перечитывание файла конфигурации (при ошибке остается прежняя конфигурация)"""
+        if not self.config_file:
+            return
+        try:
+            with open(self.config_file, "r") as f:
+                config = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Не удалось перечитать конфигурацию {self.config_file}: {str(e)}")
+            return
+        # Файл трассировки задается и параметром командной строки
+        if self.config.get("trace_file") and not config.get("trace_file"):
+            config["trace_file"] = self.config["trace_file"]
+        self.config = config
+
+    def reload_config(self):
+        """Перезагрузка конфигурации супервизора и всех процессов (SIGHUP)"""
+        self.refresh_config()
+        self.forward_signal(signal.SIGHUP)
+        logger.info("Конфигурация перечитана, рабочие процессы применяют ее без перезапуска")
+
+    def start_worker(self, worker):
+        """Запуск рабочего процесса"""
+        self.refresh_config()
+        config = worker_config(self.config, worker.index, len(self.workers))
+        worker.process = self.context.Process(
+            target=run_worker,
+            name=f"ollama-proxy-worker-{worker.index}",
+            args=(worker.index, len(self.workers), self.client_options, config, self.log_queue,
+                  self.metrics_queue, self.metrics_interval),
+            daemon=False
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        logger.info(f"Запущен рабочий процесс {worker.index} (pid {worker.process.pid})")
+
+    def check_workers(self):
+        """Перезапуск завершившихся процессов с растущей задержкой"""
+        now = time.monotonic()
+        for worker in self.workers:
+            process = worker.process
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                # Процесс завершился сам: это всегда сбой, останавливает процессы только супервизор
+                if now - worker.started_at >= self.stable_seconds:
+                    worker.failures = 0
+                worker.failures += 1
+                delay = min(self.restart_max_delay, self.restart_delay * 2 ** (worker.failures - 1))
+                worker.restart_at = now + delay
+                worker.process = None
+                self.snapshots.pop(worker.index, None)
+                WORKER_RESTARTS.inc(worker=str(worker.index))
+                logger.warning(f"Рабочий процесс {worker.index} завершился с кодом {process.exitcode}, "
+                               f"перезапуск через {delay:.1f} сек")
+            if now >= worker.restart_at:
+                self.start_worker(worker)
+        WORKERS_ALIVE.set(sum(1 for worker in self.workers if worker.process is not None))
+
+    def collect_snapshots(self):
+        """Получение последних метрик рабочих процессов"""
+        while True:
+            try:
+                index, text = self.metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            if self.workers[index].process is not None:
+                self.snapshots[index] = text
+
+    def render(self):
+        """Метрики супервизора и всех рабочих процессов в формате Prometheus"""
+        self.collect_snapshots()
+        sources = [(None, metrics.render())]
+        sources.extend((str(index), text) for index, text in sorted(self.snapshots.items()))
+        return merge_expositions(sources)
+
+    async def stop_workers(self):
+        """Штатная остановка процессов (SIGTERM), по истечении таймаута - принудительная"""
+        self.stopping = True
+        processes = [worker.process for worker in self.workers if worker.process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        # Ожидание не блокирует цикл событий: сервер метрик продолжает отвечать.
+        # Процессы сначала дописывают выполняющиеся ответы (drain_timeout)
+        deadline = time.monotonic() + self.config.get("drain_timeout", DEFAULT_DRAIN_TIMEOUT) + WORKER_STOP_TIMEOUT
+        while any(process.is_alive() for process in processes) and time.monotonic() < deadline:
+            await asyncio.sleep(SUPERVISOR_POLL_INTERVAL / 5)
+        for process in processes:
+            if process.is_alive():
+                logger.warning(f"Рабочий процесс {process.name} не завершился, останавливаем принудительно")
+                process.kill()
+            process.join()
+        WORKERS_ALIVE.set(0)
+        logger.info("Все рабочие процессы остановлены")
+
+    def request_stop(self):
+        """Остановка супервизора и процессов (SIGTERM)"""
+        logger.info("Получен сигнал остановки, рабочие процессы завершают выполняющиеся запросы")
+        self.stopping = True
+
+    def forward_signal(self, signum):
+        """Передача сигнала всем работающим процессам (SIGUSR1 - профилирование, SIGHUP - перезагрузка конфигурации)"""
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signum)
+
+    async def run(self):
+        """Запуск процессов и наблюдение за ними до остановки"""
+        # Записи журнала процессов проходят через обработчики супервизора
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *logger.handlers,
+                                                           respect_handler_level=True)
+        self.log_listener.start()
+        logger.info(f"Запуск {len(self.workers)} рабочих процессов")
+        print(f"Запуск {len(self.workers)} рабочих процессов")
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self.forward_signal, signal.SIGUSR1)
+        if hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, self.reload_config)
+        # SIGTERM останавливает процессы штатно: они дописывают выполняющиеся ответы
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.request_stop)
+        except NotImplementedError:
+            # В Windows обработчики сигналов в цикле событий недоступны
+            pass
+        try:
+            if self.metrics_port:
+                self.metrics_server = MetricsServer(self.metrics_host, self.metrics_port, registry=self)
+                await self.metrics_server.start()
+            while not self.stopping:
+                self.check_workers()
+                self.collect_snapshots()
+                await asyncio.sleep(SUPERVISOR_POLL_INTERVAL)
+        finally:
+            await self.stop_workers()
+            if self.metrics_server:
+                await self.metrics_server.stop()
+            self.log_listener.stop()
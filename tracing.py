@@ -0,0 +1,200 @@
+"""
+Трассировка этапов обработки запросов
+
+Каждый запрос покупателя раскладывается на интервалы (span) по messageId:
+ожидание в очереди, HTTP-запрос к Ollama до получения заголовков ответа,
+загрузка модели, обработка запроса и генерация токенов (по статистике Ollama),
+отправка фрагментов в WebSocket. Интервалы пишутся в файл JSONL, по одному
+объекту на строку:
+
+    {"name": "queue", "messageId": 7, "ts": 1700000000123456.0, "dur": 1520.3, "pid": 4242, "args": {...}}
+
+ts - время начала в микросекундах Unix, dur - длительность в микросекундах.
+Файл преобразуется в формат Chrome trace (chrome://tracing, Perfetto):
+
+    python tracing.py client.trace.jsonl client.trace.json
+"""
+import os
+import time
+import argparse
+from contextlib import contextmanager
+
+import json_codec
+from config import logger
+
+# Как часто сбрасывать буфер файла трассировки на диск в секундах
+TRACE_FLUSH_INTERVAL = 1.0
+
+
+class Tracer:
+    """Запись интервалов обработки запросов в файл JSONL"""
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.file = None
+        self.pid = os.getpid()
+        self.spans = 0
+        self._last_flush = 0.0
+        # Время perf_counter переводится во время Unix через общую точку отсчета
+        self._epoch_offset = time.time() - time.perf_counter()
+
+    def open(self, path):
+        """
+        Включение трассировки
+
+        :param path: Путь к файлу JSONL (дописывается, если существует)
+        """
+        self.close()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+        self.path = path
+        self.pid = os.getpid()
+        self._epoch_offset = time.time() - time.perf_counter()
+        self.enabled = True
+        logger.info(f"Трассировка запросов записывается в {path}")
+
+    def close(self):
+        """Выключение трассировки и закрытие файла"""
+        self.enabled = False
+        if self.file:
+            self.file.close()
+            self.file = None
+            logger.info(f"Трассировка запросов остановлена: записано {self.spans} интервалов в {self.path}")
+
+    def record(self, name, message_id, start, end=None, **attrs):
+        """
+        Запись интервала
+
+        :param name: Название этапа
+        :param message_id: ID сообщения
+        :param start: Начало по time.perf_counter()
+        :param end: Конец по time.perf_counter() (по умолчанию - сейчас)
+        :param attrs: Дополнительные сведения об этапе
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if end is None:
+            end = now
+        span = {
+            "name": name,
+            "messageId": message_id,
+            "ts": round((start + self._epoch_offset) * 1e6, 1),
+            "dur": round(max(0.0, end - start) * 1e6, 1),
+            "pid": self.pid,
+        }
+        if attrs:
+            span["args"] = attrs
+        self.file.write(json_codec.dumps(span) + "\n")
+        self.spans += 1
+        if now - self._last_flush >= TRACE_FLUSH_INTERVAL:
+            self.file.flush()
+            self._last_flush = now
+
+    @contextmanager
+    def span(self, name, message_id, **attrs):
+        """Интервал на время выполнения блока with"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, message_id, start, **attrs)
+
+    def record_generation(self, message_id, final_data, end):
+        """
+        Интервалы загрузки модели, обработки запроса и генерации по статистике Ollama
+
+        Ollama сообщает только длительности этапов, поэтому они откладываются
+        назад от момента получения последнего объекта ответа.
+
+        :param message_id: ID сообщения
+        :param final_data: Последний объект ответа Ollama (done: true)
+        :param end: Момент получения последнего объекта по time.perf_counter()
+        """
+        if not self.enabled or not final_data:
+            return
+        eval_duration = (final_data.get("eval_duration") or 0) / 1e9
+        prompt_eval_duration = (final_data.get("prompt_eval_duration") or 0) / 1e9
+        load_duration = (final_data.get("load_duration") or 0) / 1e9
+        generation_start = end - eval_duration
+        prompt_eval_start = generation_start - prompt_eval_duration
+        if load_duration:
+            self.record("model_load", message_id, prompt_eval_start - load_duration, prompt_eval_start,
+                        source="ollama")
+        self.record("prompt_eval", message_id, prompt_eval_start, generation_start, source="ollama",
+                    tokens=final_data.get("prompt_eval_count") or 0)
+        self.record("generation", message_id, generation_start, end, source="ollama",
+                    tokens=final_data.get("eval_count") or 0)
+
+
+# Общий трассировщик процесса (выключен, пока не вызван tracer.open)
+tracer = Tracer()
+
+
+def convert_to_chrome(source, destination):
+    """
+    Преобразование трассировки JSONL в формат Chrome trace
+
+    Каждый запрос отображается отдельной строкой (tid = messageId), этапы
+    одного запроса - вложенными интервалами.
+
+    :param source: Путь к файлу JSONL
+    :param destination: Путь к файлу JSON для chrome://tracing или Perfetto
+    :return: Количество интервалов
+    """
+    events = []
+    threads = set()
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                span = json_codec.loads(line)
+            except json_codec.JSONDecodeError:
+                # Последняя строка может быть недописана, если процесс был остановлен
+                continue
+            pid = span.get("pid", 0)
+            tid = span.get("messageId", -1)
+            if not isinstance(tid, int):
+                tid = str(tid)
+            threads.add((pid, tid))
+            events.append({
+                "name": span["name"],
+                "cat": span.get("args", {}).get("source", "client"),
+                "ph": "X",
+                "ts": span["ts"],
+                "dur": span["dur"],
+                "pid": pid,
+                "tid": tid,
+                "args": span.get("args", {}),
+            })
+    # Длинные интервалы идут раньше вложенных в них при одинаковом начале
+    events.sort(key=lambda event: (event["ts"], -event["dur"]))
+    count = len(events)
+    for pid, tid in sorted(threads, key=str):
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                       "args": {"name": f"messageId {tid}"}})
+    with open(destination, "w", encoding="utf-8") as f:
+        f.write(json_codec.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Преобразование трассировки JSONL в формат Chrome trace")
+    parser.add_argument("source", help="Файл трассировки JSONL")
+    parser.add_argument("destination", nargs="?", help="Файл JSON (по умолчанию - рядом с исходным)")
+    args = parser.parse_args(argv)
+    destination = args.destination or os.path.splitext(args.source)[0] + ".json"
+    count = convert_to_chrome(args.source, destination)
+    print(f"Записано {count} интервалов в {destination}")
+
+
+if __name__ == "__main__":
+    main()
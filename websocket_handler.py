@@ -1,36 +1,133 @@
-import json
 import time
+import random
 import asyncio
+from collections import deque
 import websockets
-from config import logger, DEFAULT_HOST, DEFAULT_PATH, RECONNECT_TIMEOUT
+import json_codec
+import wire_format as wire_format_module
+from config import (
+    logger, DEFAULT_HOST, DEFAULT_PATH,
+    DISPATCH_MODE_CONCURRENT, DEFAULT_DISPATCH_MODE, DEFAULT_MAX_CONCURRENT_REQUESTS,
+    DEFAULT_DISCONNECT_ABORT_GRACE, DEFAULT_WIRE_FORMAT, DEFAULT_WS_COMPRESSION,
+    DEFAULT_STREAM_RESUME, DEFAULT_STREAM_REPLAY_FRAMES, DEFAULT_STREAM_REPLAY_TTL,
+    DEFAULT_RECONNECT_BASE_DELAY, DEFAULT_RECONNECT_MAX_DELAY,
+    DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_HEARTBEAT_TIMEOUT, DEFAULT_WS_SEND_TIMEOUT, DEFAULT_RTT_HISTORY
+)
+from metrics import WEBSOCKET_RTT_SECONDS, WEBSOCKET_DEAD_LINKS
+from scheduler import RequestScheduler
+from stream_replay import (
+    ReplayBuffer, FRAME_BUFFERED, STREAM_RESUME_QUERY_PARAM, STREAM_RESUME_HEADER, NO_MESSAGE_ID
+)
 
 class WebSocketHandler:
     """Класс для работы с WebSocket соединениями"""
     
-    def __init__(self, port, token, message_processor=None):
+    def __init__(self, port, token, message_processor=None,
+                 dispatch_mode=DEFAULT_DISPATCH_MODE,
+                 max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 on_connection_lost=None, disconnect_abort_grace=DEFAULT_DISCONNECT_ABORT_GRACE,
+                 scheduler=None, url=None, wire_format=DEFAULT_WIRE_FORMAT,
+                 compression=DEFAULT_WS_COMPRESSION, compression_level=None, compression_window_bits=None,
+                 resume=DEFAULT_STREAM_RESUME, replay_frames=DEFAULT_STREAM_REPLAY_FRAMES,
+                 replay_ttl=DEFAULT_STREAM_REPLAY_TTL, reconnect_base_delay=DEFAULT_RECONNECT_BASE_DELAY,
+                 reconnect_max_delay=DEFAULT_RECONNECT_MAX_DELAY, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT, send_timeout=DEFAULT_WS_SEND_TIMEOUT,
+                 rtt_history=DEFAULT_RTT_HISTORY):
         """
         Инициализация обработчика WebSocket
         
         :param port: Порт для подключения
         :param token: Токен аутентификации
         :param message_processor: Функция для обработки входящих сообщений
+        :param dispatch_mode: Режим обработки buyer_message ("concurrent" или "inline")
+        :param max_concurrent_requests: Глобальный лимит одновременно обрабатываемых запросов
+        :param on_connection_lost: Корутина, вызываемая, если соединение не восстановлено за disconnect_abort_grace секунд
+        :param disconnect_abort_grace: Сколько секунд ждать переподключения до вызова on_connection_lost
+        :param scheduler: Планировщик RequestScheduler (по умолчанию FIFO с лимитом max_concurrent_requests)
+        :param url: Полный адрес сервера без токена (по умолчанию wss://DEFAULT_HOST:port/DEFAULT_PATH)
+        :param wire_format: Запрашиваемый формат сообщений ("json" или "msgpack")
+        :param compression: Набор параметров сжатия permessage-deflate ("none", "default", "tuned")
+        :param compression_level: Уровень сжатия zlib (None - из набора параметров)
+        :param compression_window_bits: Размер окна сжатия в битах (None - из набора параметров)
+        :param resume: Нумеровать фреймы ответов и повторно отправлять их после переподключения,
+            если сервер подтвердит это при подключении
+        :param replay_frames: Максимальное число хранимых для повторной отправки фреймов одного ответа
+        :param replay_ttl: Сколько секунд хранить фреймы ответа после последнего фрейма
+        :param reconnect_base_delay: Начальная задержка переподключения в секундах
+        :param reconnect_max_delay: Максимальная задержка переподключения в секундах
+        :param heartbeat_interval: Интервал отправки ping в секундах (0 - встроенная проверка websockets)
+        :param heartbeat_timeout: Сколько секунд ждать pong до признания соединения мертвым
+        :param send_timeout: Сколько секунд может длиться отправка одного фрейма (0 - без ограничения)
+        :param rtt_history: Сколько последних измерений RTT хранить
         """
         self.port = port
         self.token = token
+        self.url = url
         self.websocket = None
         self.message_processor = message_processor
         self.is_connected = False
         
+        # Формат сообщений: msgpack используется, только если сервер подтвердил его при подключении
+        self.requested_wire_format = wire_format
+        if not wire_format_module.is_available(wire_format):
+            logger.warning(f"Формат сообщений '{wire_format}' недоступен (для msgpack нужен пакет msgpack), используется JSON")
+            self.requested_wire_format = wire_format_module.WIRE_FORMAT_JSON
+        self.codec = wire_format_module.JsonWireCodec
+        self.connect_options = wire_format_module.get_compression_options(
+            compression, compression_level, compression_window_bits
+        )
+        
+        # Параметры параллельной обработки запросов
+        self.dispatch_mode = dispatch_mode
+        self.max_concurrent_requests = max(1, int(max_concurrent_requests))
+        self.scheduler = scheduler or RequestScheduler(max_concurrent_requests=self.max_concurrent_requests)
+        if self.scheduler.processor is None:
+            self.scheduler.processor = message_processor
+        
+        # Прерывание генераций при окончательной потере соединения
+        self.on_connection_lost = on_connection_lost
+        self.disconnect_abort_grace = disconnect_abort_grace
+        self._abort_task = None
+        
+        # Нумерация фреймов и повторная отправка после переподключения: включается,
+        # только если сервер подтвердил возобновление при подключении
+        self.replay = ReplayBuffer(replay_frames, replay_ttl) if resume else None
+        self.resume_confirmed = False
+        self.resuming = False
+        self.reconnect_base_delay = reconnect_base_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        
+        # Проверка живости соединения: ping/pong с измерением RTT и ограничение времени отправки
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.send_timeout = send_timeout
+        self.rtt_history = deque(maxlen=max(1, int(rtt_history)))
+        self._heartbeat_task = None
+        self._reconnect_now = False
+        if self.heartbeat_interval > 0:
+            # Собственная проверка заменяет встроенную: встроенная не сообщает RTT
+            self.connect_options = dict(self.connect_options, ping_interval=None)
+        
     async def connect(self):
         """Установка соединения с WebSocket"""
         # Формируем URL с учетом порта
-        websocket_url = f"wss://{DEFAULT_HOST}:{self.port}{DEFAULT_PATH}?token={self.token}"
+        base_url = self.url or f"wss://{DEFAULT_HOST}:{self.port}{DEFAULT_PATH}"
+        websocket_url = f"{base_url}?token={self.token}"
+        if self.requested_wire_format != wire_format_module.WIRE_FORMAT_JSON:
+            websocket_url += f"&{wire_format_module.WIRE_FORMAT_QUERY_PARAM}={self.requested_wire_format}"
+        if self.replay is not None:
+            websocket_url += f"&{STREAM_RESUME_QUERY_PARAM}=1"
         logger.info(f"Подключение к: {websocket_url}")
         
         try:
-            self.websocket = await websockets.connect(websocket_url)
+            self.websocket = await websockets.connect(websocket_url, **self.connect_options)
+            self.codec = self.negotiate_codec(self.websocket)
+            self.resume_confirmed = self.negotiate_resume(self.websocket)
+            self.start_heartbeat()
             self.is_connected = True
-            logger.info("Соединение установлено успешно")
+            logger.info(f"Соединение установлено успешно (формат сообщений: {self.codec.name})")
+            if self.resume_confirmed:
+                await self.resume_after_connect()
             return True
         except ConnectionRefusedError as e:
             error_msg = f"Ошибка: Сервер отказал в подключении. Убедитесь, что сервер запущен на {DEFAULT_HOST}:{self.port}"
@@ -43,8 +140,292 @@ class WebSocketHandler:
             print(error_msg)
             raise
     
+    def negotiate_codec(self, websocket):
+        """
+        Выбор формата сообщений по ответу сервера на рукопожатие
+        
+        Сервер, не знающий о параметре wire_format, не присылает заголовок
+        X-Wire-Format, и клиент продолжает работать в JSON.
+        
+        :param websocket: Установленное соединение
+        :return: Класс кодека
+        """
+        if self.requested_wire_format == wire_format_module.WIRE_FORMAT_JSON:
+            return wire_format_module.JsonWireCodec
+        headers = getattr(websocket, "response_headers", None) or {}
+        confirmed = headers.get(wire_format_module.WIRE_FORMAT_HEADER, wire_format_module.WIRE_FORMAT_JSON)
+        if confirmed != self.requested_wire_format:
+            logger.info(f"Сервер не подтвердил формат {self.requested_wire_format}, используется JSON")
+            return wire_format_module.JsonWireCodec
+        return wire_format_module.get_codec(confirmed)
+    
+    def negotiate_resume(self, websocket):
+        """
+        Проверка, подтвердил ли сервер возобновление ответов
+        
+        Сервер, не знающий о параметре stream_resume, не присылает заголовок
+        X-Stream-Resume: фреймы отправляются без номеров, а сообщение
+        resume_streams не используется.
+        
+        :param websocket: Установленное соединение
+        :return: True, если возобновление включено
+        """
+        if self.replay is None:
+            return False
+        headers = getattr(websocket, "response_headers", None) or {}
+        if headers.get(STREAM_RESUME_HEADER) == "1":
+            return True
+        logger.info("Сервер не подтвердил возобновление ответов, фреймы отправляются без номеров")
+        if self.replay.streams:
+            logger.warning(f"Неотправленные фреймы {len(self.replay.streams)} ответов отброшены: "
+                           f"сервер не поддерживает возобновление")
+            self.replay.streams.clear()
+        return False
+    
+    def reconnect_delay(self, attempt):
+        """
+        Задержка перед попыткой переподключения
+        
+        Экспоненциальный рост со случайным разбросом, чтобы после перезапуска
+        сервера клиенты всех владельцев не переподключались одновременно.
+        
+        :param attempt: Номер попытки, начиная с 1
+        :return: Задержка в секундах
+        """
+        delay = min(self.reconnect_max_delay, self.reconnect_base_delay * 2 ** min(attempt - 1, 30))
+        return random.uniform(0, delay)
+    
+    def start_heartbeat(self):
+        """Запуск проверки живости для текущего соединения"""
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        self._heartbeat_task = None
+        if self.heartbeat_interval > 0:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat(self.websocket))
+    
+    async def _heartbeat(self, websocket):
+        """
+        Периодическая отправка ping и измерение RTT
+        
+        Если pong не пришел за heartbeat_timeout секунд (включая время отправки
+        самого ping), соединение считается мертвым.
+        
+        :param websocket: Соединение, которое проверяется
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                rtt = await asyncio.wait_for(self._ping(websocket), self.heartbeat_timeout)
+            except asyncio.TimeoutError:
+                self.mark_dead(websocket, "heartbeat", f"нет ответа на ping за {self.heartbeat_timeout} сек")
+                return
+            except websockets.ConnectionClosed:
+                return
+            self.rtt_history.append((time.time(), rtt))
+            WEBSOCKET_RTT_SECONDS.observe(rtt)
+    
+    @staticmethod
+    async def _ping(websocket):
+        """Отправка ping и ожидание pong, возвращает RTT в секундах"""
+        pong_waiter = await websocket.ping()
+        return await pong_waiter
+    
+    def rtt_stats(self):
+        """
+        Сводка по последним измерениям RTT
+        
+        :return: Словарь last, min, avg, p95, max в секундах (пустой, если измерений нет)
+        """
+        values = [rtt for _, rtt in self.rtt_history]
+        if not values:
+            return {}
+        ordered = sorted(values)
+        return {
+            "last": values[-1],
+            "min": ordered[0],
+            "avg": sum(values) / len(values),
+            "p95": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+            "max": ordered[-1],
+        }
+    
+    def mark_dead(self, websocket, reason, details):
+        """
+        Признание соединения мертвым и немедленный разрыв
+        
+        При обрыве без закрытия TCP-соединения recv() может не завершаться
+        минутами. Разрыв транспорта завершает recv() сразу, и цикл
+        прослушивания переподключается без задержки.
+        
+        :param websocket: Соединение
+        :param reason: Причина для метрики ("heartbeat", "send" или "resume")
+        :param details: Описание для журнала
+        """
+        if websocket is not self.websocket or websocket.closed:
+            return
+        stats = self.rtt_stats()
+        last_rtt = f", последний RTT {stats['last'] * 1000:.1f} мс" if stats else ""
+        logger.warning(f"Соединение с сервером признано мертвым: {details}{last_rtt}")
+        WEBSOCKET_DEAD_LINKS.inc(reason=reason)
+        self.is_connected = False
+        self._reconnect_now = True
+        websocket.transport.abort()
+    
+    async def _send(self, payload):
+        """
+        Отправка фрейма с ограничением времени
+        
+        Отправка ждет освобождения буфера сокета; если она не завершилась за
+        send_timeout секунд, соединение считается мертвым.
+        
+        :param payload: Закодированное сообщение
+        :raises websockets.ConnectionClosed: Соединение закрыто или признано мертвым
+        """
+        websocket = self.websocket
+        if not self.send_timeout:
+            await websocket.send(payload)
+            return
+        try:
+            await asyncio.wait_for(websocket.send(payload), self.send_timeout)
+        except asyncio.TimeoutError:
+            self.mark_dead(websocket, "send", f"отправка не завершилась за {self.send_timeout} сек")
+            raise websockets.ConnectionClosedError(None, None)
+    
+    def next_reconnect_delay(self, attempt):
+        """
+        Задержка перед переподключением после разрыва
+        
+        Если соединение разорвал сам клиент, признав его мертвым, первая попытка
+        выполняется сразу: ждать, пока разрыв заметит операционная система, не нужно.
+        Повторные попытки подряд (например, сервер каждый раз разрывает соединение
+        сразу после подключения) выполняются с обычной задержкой.
+        
+        :param attempt: Номер попытки, начиная с 1
+        :return: Задержка в секундах
+        """
+        reconnect_now = self._reconnect_now
+        self._reconnect_now = False
+        if reconnect_now and attempt == 1:
+            return 0.0
+        return self.reconnect_delay(attempt)
+    
+    async def resume_after_connect(self):
+        """
+        Возобновление ответов на новом соединении
+        
+        Если возобновление не удалось, соединение разрывается, и цикл прослушивания
+        подключается заново; недоставленные фреймы остаются в буфере.
+        """
+        self.resuming = True
+        try:
+            await self.resume_streams()
+        except Exception as e:
+            logger.warning(f"Не удалось возобновить ответы после подключения: {e}")
+            self.is_connected = False
+            self.mark_dead(self.websocket, "resume", "ошибка при возобновлении ответов")
+        finally:
+            self.resuming = False
+    
+    async def resume_streams(self):
+        """
+        Возобновление ответов после переподключения
+        
+        Сервер получает сообщение resume_streams с номером последнего фрейма каждого
+        хранимого ответа, после чего отправляются фреймы, которые не удалось
+        отправить, пока соединения не было. Пока идет возобновление, новые фреймы
+        только сохраняются в буфере, поэтому порядок номеров не нарушается.
+        """
+        streams = self.replay.summary()
+        if not streams:
+            return
+        await self._send(self.codec.encode({
+            "type": "resume_streams",
+            "streams": streams,
+            "timestamp": int(time.time() * 1000)
+        }))
+        resent = 0
+        while True:
+            frames = self.replay.unsent()
+            if not frames:
+                break
+            for frame in frames:
+                await self._send(self.codec.encode(frame.message))
+                frame.sent = True
+                resent += 1
+        logger.info(f"Возобновление ответов: {len(streams)} в буфере, повторно отправлено {resent} фреймов")
+    
+    async def send_frame(self, message_id, data, final=False):
+        """
+        Отправка фрейма ответа с сохранением в буфере повторной отправки
+        
+        Пока соединения нет, фрейм только сохраняется и будет отправлен после
+        переподключения. Если сервер не подтвердил возобновление или у ответа нет
+        messageId, фрейм отправляется сразу и не сохраняется.
+        
+        :param message_id: ID сообщения
+        :param data: Словарь фрейма
+        :param final: Последний фрейм ответа
+        :return: True, если фрейм отправлен; FRAME_BUFFERED, если он только сохранен для повторной
+            отправки (соединения нет); False, если буфер повторной отправки заполнен
+        :raises Exception: Ошибка отправки, если фрейм не сохраняется для повторной отправки
+        """
+        if not self.resume_confirmed or message_id == NO_MESSAGE_ID:
+            await self._send(self.codec.encode(data))
+            return True
+        
+        frame = self.replay.record(message_id, data, final)
+        if frame is None:
+            logger.warning(f"Буфер повторной отправки заполнен (messageId: {message_id})")
+            return False
+        if not self.is_connected or self.resuming:
+            # Во время возобновления фрейм отправит resume_streams, чтобы не нарушить порядок номеров
+            return FRAME_BUFFERED
+        try:
+            await self._send(self.codec.encode(data))
+        except websockets.ConnectionClosed:
+            # Фрейм будет отправлен после переподключения
+            return FRAME_BUFFERED
+        frame.sent = True
+        return True
+    
+    async def handle_resume_message(self, data):
+        """
+        Обработка служебных сообщений сервера о возобновлении ответов
+        
+        resume_request: {"messageId", "fromSeq"} - повторная отправка фреймов, начиная с номера fromSeq;
+        stream_ack: {"messageId", "seq"} - фреймы до seq включительно получены и могут быть удалены.
+        
+        :param data: Разобранное сообщение от сервера
+        :return: True, если сообщение было служебным
+        """
+        message_type = data.get("type")
+        if message_type == "stream_ack":
+            if self.replay is not None:
+                self.replay.ack(data.get("messageId"), data.get("seq", -1))
+            return True
+        if message_type != "resume_request":
+            return False
+        
+        message_id = data.get("messageId")
+        from_seq = data.get("fromSeq", 0)
+        if not self.resume_confirmed:
+            logger.warning(f"Сервер запросил повторную отправку (messageId: {message_id}), но она отключена")
+            return True
+        frames, first_seq = self.replay.frames_from(message_id, from_seq)
+        if first_seq is None or first_seq > from_seq:
+            logger.warning(f"Фреймы ответа (messageId: {message_id}) с номера {from_seq} уже не хранятся "
+                           f"(первый хранимый: {first_seq})")
+        for frame in frames:
+            await self._send(self.codec.encode(frame.message))
+            frame.sent = True
+        logger.info(f"Повторно отправлено {len(frames)} фреймов по запросу сервера (messageId: {message_id}, с номера {from_seq})")
+        return True
+    
     async def disconnect(self):
         """Закрытие соединения с WebSocket"""
+        if self._abort_task:
+            self._abort_task.cancel()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
         if self.websocket:
             await self.websocket.close()
             self.is_connected = False
@@ -56,6 +437,7 @@ class WebSocketHandler:
         
         :param content: Содержимое ответа
         :param message_id: ID сообщения, на которое отвечаем
+        :return: True, если ответ отправлен; FRAME_BUFFERED, если он ждет переподключения; False при ошибке
         """
         if not self.websocket:
             logger.error("Попытка отправить сообщение без установленного соединения")
@@ -69,9 +451,11 @@ class WebSocketHandler:
         }
         
         try:
-            await self.websocket.send(json.dumps(response_data))
-            logger.debug(f"Отправлено сообщение на сервер: {json.dumps(response_data)}")
-            return True
+            result = await self.send_frame(message_id, response_data, final=True)
+            if not result:
+                return False
+            logger.debug("Отправлено сообщение на сервер: %s", response_data)
+            return result
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения: {e}")
             return False
@@ -83,6 +467,7 @@ class WebSocketHandler:
         :param text: Текст фрагмента
         :param message_id: ID сообщения
         :param is_final: Флаг завершения потока
+        :return: True, если фрагмент отправлен; FRAME_BUFFERED, если он ждет переподключения; False при ошибке
         """
         # Проверяем, не пустой ли чанк
         if not text or not text.strip():
@@ -98,13 +483,106 @@ class WebSocketHandler:
                 "stream": True
             }
             
-            await self.websocket.send(json.dumps(response_data))
-            logger.debug(f"Отправлен чанк длиной {len(text)} символов на сервер")
-            return True
+            result = await self.send_frame(message_id, response_data)
+            if not result:
+                return False
+            logger.debug("Отправлен чанк длиной %d символов на сервер", len(text))
+            return result
         except Exception as e:
             logger.error(f"Ошибка при отправке потокового чанка: {e}")
             return False
     
+    @property
+    def queued_requests(self):
+        """Количество запросов, ожидающих свободного слота"""
+        return self.scheduler.queued_requests
+    
+    @property
+    def queued_messages(self):
+        """Сообщения, ожидающие свободного слота, по messageId"""
+        return self.scheduler.queued_messages
+    
+    @property
+    def in_flight(self):
+        """Количество выполняющихся запросов"""
+        return self.scheduler.in_flight
+    
+    @property
+    def active_tasks(self):
+        """Задачи выполняющихся запросов"""
+        return self.scheduler.active_tasks
+    
+    async def dispatch_message(self, data):
+        """
+        Передача входящего сообщения обработчику
+        
+        В режиме "concurrent" каждый buyer_message передается планировщику, который
+        выбирает порядок обработки по своей политике и ограничивает число одновременно
+        выполняемых запросов. Благодаря этому цикл прослушивания продолжает вызывать
+        recv(), пока идут генерации. Остальные типы сообщений обрабатываются сразу.
+        
+        :param data: Разобранное сообщение от сервера
+        """
+        if self.dispatch_mode != DISPATCH_MODE_CONCURRENT or data.get("type") != "buyer_message":
+            await self.message_processor(data)
+            return
+        
+        self.scheduler.submit(data)
+    
+    def cancel_queued(self, message_id=None):
+        """
+        Отмена запросов, ожидающих свободного слота
+        
+        :param message_id: ID сообщения (None - отменить все ожидающие запросы)
+        :return: True, если был отменен хотя бы один запрос
+        """
+        return self.scheduler.cancel(message_id)
+    
+    def _schedule_abort(self):
+        """Планирование прерывания генераций, если соединение не восстановится"""
+        if self.on_connection_lost and (self._abort_task is None or self._abort_task.done()):
+            self._abort_task = asyncio.create_task(self._abort_if_still_disconnected())
+    
+    async def _abort_if_still_disconnected(self):
+        """Прерывание генераций по истечении периода ожидания переподключения"""
+        await asyncio.sleep(self.disconnect_abort_grace)
+        if not self.is_connected:
+            logger.warning(f"Соединение не восстановлено за {self.disconnect_abort_grace} сек, прерываем генерации")
+            await self.on_connection_lost()
+    
+    async def send_stream_finished(self, message_id, cancelled=False, error=None):
+        """
+        Отправка сообщения о завершении потока
+        
+        :param message_id: ID сообщения
+        :param cancelled: Признак того, что генерация была отменена
+        :param error: Описание ошибки, из-за которой поток завершен (None - поток завершен штатно)
+        """
+        if not self.websocket:
+            logger.error("Попытка отправить сообщение без установленного соединения")
+            return False
+        
+        finished_data = {
+            "type": "finished_message_stream",
+            "content": "",
+            "messageId": message_id,
+            "timestamp": int(time.time() * 1000)
+        }
+        if cancelled:
+            finished_data["cancelled"] = True
+        if error:
+            finished_data["error"] = error
+        
+        try:
+            if not await self.send_frame(message_id, finished_data, final=True):
+                return False
+            status = ", отменен" if cancelled else ", с ошибкой" if error else ""
+            logger.info(f"Отправлено сообщение о завершении потока (messageId: {message_id}{status})")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения о завершении потока: {e}")
+            return False
+    
     async def listen(self):
         """Прослушивание сообщений от сервера"""
         reconnect_attempts = 0
@@ -117,22 +595,25 @@ class WebSocketHandler:
                 message = await self.websocket.recv()
                 reconnect_attempts = 0  # Сбрасываем счетчик при успешном получении сообщения
                 
-                logger.debug(f"Получено сообщение от сервера: {message}")
-                data = json.loads(message)
+                logger.debug("Получено сообщение от сервера: %s", message)
+                data = self.codec.decode(message)
+                if await self.handle_resume_message(data):
+                    continue
                 
                 # Если есть обработчик сообщений, передаем сообщение ему
                 if self.message_processor and callable(self.message_processor):
-                    await self.message_processor(data)
+                    await self.dispatch_message(data)
                 else:
                     logger.debug(f"Получено сообщение без обработчика: {data['type']}")
                 
             except websockets.ConnectionClosed:
                 self.is_connected = False
+                self._schedule_abort()
                 reconnect_attempts += 1
-                backoff_time = min(RECONNECT_TIMEOUT * reconnect_attempts, 60)  # Максимальная задержка 60 секунд
+                backoff_time = self.next_reconnect_delay(reconnect_attempts)
                 
-                logger.warning(f"Соединение закрыто. Попытка переподключения через {backoff_time} секунд (попытка {reconnect_attempts})...")
-                print(f"Соединение закрыто. Попытка переподключения через {backoff_time} секунд...")
+                logger.warning(f"Соединение закрыто. Попытка переподключения через {backoff_time:.1f} секунд (попытка {reconnect_attempts})...")
+                print(f"Соединение закрыто. Попытка переподключения через {backoff_time:.1f} секунд...")
                 
                 await asyncio.sleep(backoff_time)  # Ждем перед повторным подключением
                 
@@ -142,7 +623,7 @@ class WebSocketHandler:
                 except Exception as e:
                     logger.error(f"Не удалось переподключиться: {str(e)}")
                     
-            except json.JSONDecodeError as e:
+            except json_codec.JSONDecodeError as e:
                 logger.error(f"Ошибка при разборе JSON: {str(e)}, сообщение: {message}")
                 
             except Exception as e:
@@ -160,8 +641,10 @@ class WebSocketHandler:
                 message = await self.websocket.recv()
                 reconnect_attempts = 0  # Сбрасываем счетчик при успешном получении сообщения
                 
-                logger.debug(f"Получено сообщение от сервера: {message}")
-                data = json.loads(message)
+                logger.debug("Получено сообщение от сервера: %s", message)
+                data = self.codec.decode(message)
+                if await self.handle_resume_message(data):
+                    continue
                 
                 # Выводим сообщение на экран для наглядности
                 print(f"\n>>> Получено сообщение от сервера: {data['type']}")
@@ -170,17 +653,18 @@ class WebSocketHandler:
                     
                     # Если есть обработчик сообщений, передаем сообщение ему
                     if self.message_processor and callable(self.message_processor):
-                        await self.message_processor(data)
+                        await self.dispatch_message(data)
                     else:
                         print(">>> Запрос будет обработан в основном цикле тестового режима")
                 
             except websockets.ConnectionClosed:
                 self.is_connected = False
+                self._schedule_abort()
                 reconnect_attempts += 1
-                backoff_time = min(RECONNECT_TIMEOUT * reconnect_attempts, 60)
+                backoff_time = self.next_reconnect_delay(reconnect_attempts)
                 
-                print(f"\n>>> Соединение закрыто. Попытка переподключения через {backoff_time} секунд...")
-                logger.warning(f"Соединение закрыто в тестовом режиме. Попытка переподключения через {backoff_time} секунд...")
+                print(f"\n>>> Соединение закрыто. Попытка переподключения через {backoff_time:.1f} секунд...")
+                logger.warning(f"Соединение закрыто в тестовом режиме. Попытка переподключения через {backoff_time:.1f} секунд...")
                 
                 await asyncio.sleep(backoff_time)
                 
@@ -0,0 +1,162 @@
+"""
+Формат сообщений WebSocket между клиентом и сервером
+
+По умолчанию сообщения передаются текстовыми фреймами JSON. Если сервер
+подтверждает формат msgpack (заголовок X-Wire-Format в ответе на рукопожатие),
+клиент отправляет бинарные фреймы MessagePack с короткими кодами полей и типов.
+Входящие текстовые фреймы всегда разбираются как JSON, бинарные - как MessagePack.
+Здесь же задаются наборы параметров сжатия permessage-deflate.
+"""
+import json_codec
+from config import logger
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WIRE_FORMAT_JSON = "json"
+WIRE_FORMAT_MSGPACK = "msgpack"
+
+# Параметр запроса и заголовок ответа для согласования формата
+WIRE_FORMAT_QUERY_PARAM = "wire_format"
+WIRE_FORMAT_HEADER = "X-Wire-Format"
+
+# Короткие коды полей в формате msgpack
+FIELD_CODES = {
+    "type": "t",
+    "content": "c",
+    "messageId": "m",
+    "timestamp": "ts",
+    "stream": "s",
+    "cancelled": "x",
+    "seq": "q",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+# Короткие коды типов сообщений в формате msgpack
+TYPE_CODES = {
+    "from_owner": 1,
+    "finished_message_stream": 2,
+    "buyer_message": 3,
+    "cancel_message": 4,
+    "resume_streams": 5,
+    "resume_request": 6,
+    "stream_ack": 7,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Параметры сжатия permessage-deflate
+WS_COMPRESSION_NONE = "none"
+WS_COMPRESSION_DEFAULT = "default"
+WS_COMPRESSION_TUNED = "tuned"
+DEFLATE_PRESETS = {
+    WS_COMPRESSION_NONE: None,
+    # Параметры websockets по умолчанию: окно 32 КБ на соединение в каждую сторону
+    WS_COMPRESSION_DEFAULT: {"level": 6, "window_bits": 15, "mem_level": 5},
+    # Окно 4 КБ: для коротких фреймов токенов степень сжатия почти та же,
+    # а памяти на соединение требуется в несколько раз меньше
+    WS_COMPRESSION_TUNED: {"level": 6, "window_bits": 12, "mem_level": 5},
+}
+
+
+class JsonWireCodec:
+    """Текстовые фреймы JSON (исходный формат)"""
+
+    name = WIRE_FORMAT_JSON
+
+    @staticmethod
+    def encode(message):
+        return json_codec.dumps(message)
+
+    @staticmethod
+    def decode(frame):
+        if isinstance(frame, (bytes, bytearray)):
+            return MsgpackWireCodec.decode(frame)
+        return json_codec.loads(frame)
+
+
+class MsgpackWireCodec:
+    """Бинарные фреймы MessagePack с короткими кодами полей"""
+
+    name = WIRE_FORMAT_MSGPACK
+
+    @staticmethod
+    def encode(message):
+        packed = {FIELD_CODES.get(key, key): value for key, value in message.items()}
+        if "t" in packed:
+            packed["t"] = TYPE_CODES.get(packed["t"], packed["t"])
+        return msgpack.packb(packed)
+
+    @staticmethod
+    def decode(frame):
+        if isinstance(frame, str):
+            return json_codec.loads(frame)
+        if msgpack is None:
+            raise json_codec.JSONDecodeError("Получен бинарный фрейм, но пакет msgpack не установлен", "", 0)
+        try:
+            packed = msgpack.unpackb(frame)
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise json_codec.JSONDecodeError(f"Некорректный фрейм msgpack: {e}", "", 0) from None
+        message = {FIELD_NAMES.get(key, key): value for key, value in packed.items()}
+        if "type" in message:
+            message["type"] = TYPE_NAMES.get(message["type"], message["type"])
+        return message
+
+
+def is_available(wire_format):
+    """
+    Проверка, можно ли использовать формат
+
+    :param wire_format: Имя формата
+    :return: True, если формат поддерживается в текущем окружении
+    """
+    if wire_format == WIRE_FORMAT_MSGPACK:
+        return msgpack is not None
+    return wire_format == WIRE_FORMAT_JSON
+
+
+def get_compression_options(preset, level=None, window_bits=None):
+    """
+    Параметры websockets.connect для сжатия permessage-deflate
+
+    :param preset: Имя набора параметров из DEFLATE_PRESETS
+    :param level: Уровень сжатия zlib (None - из набора)
+    :param window_bits: Размер окна сжатия в битах (None - из набора)
+    :return: Словарь именованных аргументов для websockets.connect
+    """
+    if preset not in DEFLATE_PRESETS:
+        logger.warning(f"Неизвестный режим сжатия WebSocket '{preset}', используется '{WS_COMPRESSION_DEFAULT}'")
+        preset = WS_COMPRESSION_DEFAULT
+    settings = DEFLATE_PRESETS[preset]
+    if settings is None:
+        return {"compression": None}
+    window_bits = window_bits or settings["window_bits"]
+    return {
+        "extensions": [
+            ClientPerMessageDeflateFactory(
+                server_max_window_bits=window_bits,
+                client_max_window_bits=window_bits,
+                compress_settings={
+                    "level": settings["level"] if level is None else level,
+                    "memLevel": settings["mem_level"],
+                },
+            )
+        ],
+        "compression": None,
+    }
+
+
+def get_codec(wire_format):
+    """
+    Получение кодека по имени формата
+
+    :param wire_format: Имя формата
+    :return: Класс кодека (JSON, если формат неизвестен или недоступен)
+    """
+    if wire_format == WIRE_FORMAT_MSGPACK:
+        if msgpack is not None:
+            return MsgpackWireCodec
+        logger.warning("Пакет msgpack не установлен, используется формат JSON (pip install msgpack)")
+    return JsonWireCodec